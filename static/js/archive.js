@@ -4,13 +4,46 @@ const ARCHIVE_TYPES = {
   roleplay: { labelKey: "archive.type.rp", icon: "/static/icons/roleplay.svg", className: "roleplay", tint: "#e83b3b" },
 };
 
+const ARCHIVE_PAGE_SIZE = 50;
+
 (function () {
-  async function fetchArchiveList() {
-    const res = await fetch("/archive", { cache: "no-cache" });
+  async function fetchArchivePage({ cursor, type } = {}) {
+    const params = new URLSearchParams({ limit: String(ARCHIVE_PAGE_SIZE) });
+    if (cursor) params.set("cursor", cursor);
+    if (type && type !== "all") params.set("type", type);
+    const res = await fetch(`/archive?${params.toString()}`, { cache: "no-cache" });
+    if (!res.ok) throw new Error(`HTTP ${res.status}`);
+    return {
+      items: await res.json(),
+      // only the first page (no cursor) carries the count
+      total: res.headers.has("X-Total-Count") ? Number(res.headers.get("X-Total-Count")) : null,
+      nextCursor: res.headers.get("X-Next-Cursor"),
+    };
+  }
+
+  async function fetchArchiveSearch(query, type) {
+    const params = new URLSearchParams({ q: query });
+    if (type && type !== "all") params.set("type", type);
+    const res = await fetch(`/archive/search?${params.toString()}`, { cache: "no-cache" });
     if (!res.ok) throw new Error(`HTTP ${res.status}`);
     return res.json();
   }
 
+  // snippets mark hits with <mark>…</mark>; build nodes instead of trusting the HTML
+  function renderSnippet(el, snippet) {
+    el.textContent = "";
+    snippet.split(/(<mark>[\s\S]*?<\/mark>)/).forEach((part) => {
+      if (!part) return;
+      if (part.startsWith("<mark>")) {
+        const mark = document.createElement("mark");
+        mark.textContent = part.slice(6, -7);
+        el.appendChild(mark);
+      } else {
+        el.appendChild(document.createTextNode(part));
+      }
+    });
+  }
+
   async function fetchArchiveDetail(id) {
     const res = await fetch(`/archive/${encodeURIComponent(id)}`, { cache: "no-cache" });
     if (!res.ok) throw new Error(`HTTP ${res.status}`);
@@ -32,6 +65,10 @@ const ARCHIVE_TYPES = {
       typeof window.t === "function" ? window.t(key, fallback) : fallback || key;
 
     let items = [];
+    let searchResults = null;
+    let searchTimer = null;
+    let nextCursor = null;
+    let loadingMore = false;
     let activeId = null;
     let activeEntry = null;
     let pendingRefresh = false;
@@ -68,17 +105,8 @@ const ARCHIVE_TYPES = {
 
     function renderList() {
       listEl.innerHTML = "";
-      const query = (searchEl?.value || "").toLowerCase().trim();
-      const typeFilter = filterEl?.value || "all";
-
-      const filtered = items.filter((item) => {
-        const matchesType = typeFilter === "all" || item.type === typeFilter;
-        const matchesQuery =
-          !query ||
-          (item.name && item.name.toLowerCase().includes(query)) ||
-          (item.preview && item.preview.toLowerCase().includes(query));
-        return matchesType && matchesQuery;
-      });
+      // type filtering and full-text search both happen server-side
+      const filtered = searchResults || items;
 
       if (emptyEl) emptyEl.hidden = filtered.length > 0;
 
@@ -110,7 +138,7 @@ const ARCHIVE_TYPES = {
           saveBtn.textContent = t("archive.rename_save", "Save");
           saveBtn.addEventListener("click", (ev) => {
             ev.stopPropagation();
-            renameEntry(activeEntry || item, input.value);
+            ensureActiveDetail().then((entry) => renameEntry(entry || item, input.value));
           });
 
           const cancelBtn = document.createElement("button");
@@ -171,7 +199,11 @@ const ARCHIVE_TYPES = {
 
         const preview = document.createElement("div");
         preview.className = "archive-preview";
-        preview.textContent = item.preview || t("archive.no_preview", "No preview yet.");
+        if (item.snippet) {
+          renderSnippet(preview, item.snippet);
+        } else {
+          preview.textContent = item.preview || t("archive.no_preview", "No preview yet.");
+        }
 
         body.appendChild(title);
         body.appendChild(meta);
@@ -199,10 +231,13 @@ const ARCHIVE_TYPES = {
       if (pendingRefresh) return;
       pendingRefresh = true;
       try {
-        items = await fetchArchiveList();
+        const page = await fetchArchivePage({ type: filterEl?.value });
+        items = page.items;
+        nextCursor = page.nextCursor;
       } catch (err) {
         console.error("Failed to load archive", err);
         items = [];
+        nextCursor = null;
       }
       if (!items.find((i) => i.id === activeId)) {
         activeId = items[0]?.id || null;
@@ -211,12 +246,64 @@ const ARCHIVE_TYPES = {
       const active = items.find((i) => i.id === activeId);
       activeEntry = active || null;
       pendingRefresh = false;
+      if (active) {
+        // the list only carries summaries; load messages/text for the selected entry
+        fetchArchiveDetail(active.id)
+          .then((entry) => {
+            if (activeId === entry.id) activeEntry = entry;
+          })
+          .catch(() => {});
+      }
+    }
+
+    async function runSearch() {
+      const query = (searchEl?.value || "").trim();
+      if (!query) {
+        searchResults = null;
+        renderList();
+        return;
+      }
+      try {
+        searchResults = await fetchArchiveSearch(query, filterEl?.value);
+      } catch (err) {
+        console.error("Archive search failed", err);
+        searchResults = [];
+      }
+      renderList();
+    }
+
+    async function loadMore() {
+      if (searchResults || !nextCursor || loadingMore || pendingRefresh) return;
+      loadingMore = true;
+      try {
+        const page = await fetchArchivePage({ cursor: nextCursor, type: filterEl?.value });
+        const known = new Set(items.map((i) => i.id));
+        items = items.concat(page.items.filter((i) => !known.has(i.id)));
+        nextCursor = page.nextCursor;
+        renderList();
+      } catch (err) {
+        console.error("Failed to load more archive entries", err);
+      } finally {
+        loadingMore = false;
+      }
+    }
+
+    async function ensureActiveDetail() {
+      if (!activeEntry) return null;
+      if (activeEntry.messages || activeEntry.text !== undefined) return activeEntry;
+      try {
+        activeEntry = await fetchArchiveDetail(activeEntry.id);
+      } catch (err) {
+        console.error("Failed to load archive entry", err);
+      }
+      return activeEntry;
     }
 
     refreshBtn?.addEventListener("click", () => refresh());
 
-    restoreBtn?.addEventListener("click", () => {
+    restoreBtn?.addEventListener("click", async () => {
       if (!activeEntry) return;
+      await ensureActiveDetail();
       try {
         if (activeEntry.type === "story") {
           const payload = {
@@ -284,8 +371,19 @@ const ARCHIVE_TYPES = {
       console.debug("[archive]", fallback || key);
     }
 
-    searchEl?.addEventListener("input", () => renderList());
-    filterEl?.addEventListener("change", () => renderList());
+    searchEl?.addEventListener("input", () => {
+      clearTimeout(searchTimer);
+      searchTimer = setTimeout(runSearch, 250);
+    });
+    filterEl?.addEventListener("change", () => {
+      refresh();
+      if (searchResults) runSearch();
+    });
+    listEl.addEventListener("scroll", () => {
+      if (listEl.scrollTop + listEl.clientHeight >= listEl.scrollHeight - 80) {
+        loadMore();
+      }
+    });
 
     refresh();
   };
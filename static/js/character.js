@@ -154,7 +154,7 @@ const CHAR_ACTIVE_STORAGE_KEY = "dreamui-active-character";
       if (preview) {
         preview.innerHTML = "";
         const img = document.createElement("img");
-        img.src = iconPath;
+        img.src = window.iconVariant ? window.iconVariant(iconPath, 128) : iconPath;
         img.alt = "icon";
         img.className = "char-icon-img";
         preview.appendChild(img);
@@ -62,9 +62,24 @@ let translations = {};
 let currentLanguage = "en";
 let loadedPreferences = {};
 
+// identifies this browser's preference profile on the server
+const CLIENT_ID_KEY = "dreamui-client-id";
+
+function getClientId() {
+  let id = localStorage.getItem(CLIENT_ID_KEY);
+  if (!id) {
+    id = `${Date.now().toString(36)}-${Math.random().toString(36).slice(2, 10)}`;
+    localStorage.setItem(CLIENT_ID_KEY, id);
+  }
+  return id;
+}
+
 async function fetchPreferences() {
   try {
-    const res = await fetch("/preferences", { cache: "no-cache" });
+    const res = await fetch("/preferences", {
+      cache: "no-cache",
+      headers: { "X-Client-Id": getClientId() },
+    });
     if (!res.ok) {
       return;
     }
@@ -87,7 +102,7 @@ async function savePreferences(partial) {
   try {
     await fetch("/preferences", {
       method: "POST",
-      headers: { "Content-Type": "application/json" },
+      headers: { "Content-Type": "application/json", "X-Client-Id": getClientId() },
       body: JSON.stringify(partial),
     });
   } catch (err) {
@@ -103,6 +118,22 @@ function t(key, fallback = "") {
 }
 window.t = t;
 
+// fingerprinted URL for assets the page loads at runtime (versions are embedded by the server)
+function assetUrl(path) {
+  const version = (window.ASSET_VERSIONS || {})[path];
+  return version ? `${path}?v=${version}` : path;
+}
+window.assetUrl = assetUrl;
+
+// uploaded avatars are stored as <hash>_<size>.<ext> in 64/128/256 px, PNG and WebP
+const ICON_VARIANT_RE = /^(\/static\/userdata\/character_icons\/[0-9a-f]{16})_\d+\.png$/;
+
+function iconVariant(path, size, ext = "webp") {
+  const match = typeof path === "string" ? path.match(ICON_VARIANT_RE) : null;
+  return match ? `${match[1]}_${size}.${ext}` : path;
+}
+window.iconVariant = iconVariant;
+
 function normalizeLanguageCode(code) {
   if (code === "uk") return "ua"; // legacy stored value
   return code || "en";
@@ -120,7 +151,7 @@ function detectLanguageFromText(text) {
 
 async function loadTranslations(lang) {
   async function fetchLang(target) {
-    const res = await fetch(`/static/lang/${target}.json`, { cache: "no-cache" });
+    const res = await fetch(assetUrl(`/static/lang/${target}.json`));
     if (!res.ok) throw new Error(`HTTP ${res.status}`);
     return res.json();
   }
@@ -178,7 +209,7 @@ function blockSwipeBack() {
 function setTheme(themeId) {
   const safeTheme = AVAILABLE_THEMES.includes(themeId) ? themeId : AVAILABLE_THEMES[0];
   if (themeLinkEl) {
-    themeLinkEl.href = `/static/css/themes/${safeTheme}.css`;
+    themeLinkEl.href = assetUrl(`/static/css/themes/${safeTheme}.css`);
   }
   localStorage.setItem(THEME_KEY, safeTheme);
   return safeTheme;
@@ -391,6 +422,15 @@ modeListEl.addEventListener("click", (e) => {
 
 // ----- mode loading -----
 
+// the bundled build inlines the partials (window.PARTIALS); otherwise fetch them
+async function loadPartial(file) {
+  const inline = window.PARTIALS && window.PARTIALS[file];
+  if (typeof inline === "string") return inline;
+  const res = await fetch(assetUrl(file));
+  if (!res.ok) throw new Error("HTTP " + res.status);
+  return res.text();
+}
+
 async function loadMode(modeId) {
   const meta = modesMeta[modeId];
   if (!meta) return;
@@ -400,9 +440,7 @@ async function loadMode(modeId) {
   modeSubtitleEl.textContent = meta.subtitle;
 
   try {
-    const res = await fetch(meta.file, { cache: "no-cache" });
-    if (!res.ok) throw new Error("HTTP " + res.status);
-    const html = await res.text();
+    const html = await loadPartial(meta.file);
     modeContainer.innerHTML = html;
     applyTranslationsToDom(modeContainer);
   } catch (err) {
@@ -528,6 +566,8 @@ function initChatMode() {
   const currentCharacterId = Number.isFinite(storedId) ? storedId : 1;
   const archiveKey = `dreamui-chat-archive-${currentCharacterId}`;
   let currentArchiveId = localStorage.getItem(archiveKey) || null;
+  // turns the server has stored for currentArchiveId; lets requests send only what changed
+  let serverTurns = null;
   const RESTORE_KEY = "dreamui-restore-chat";
   let restoredFromArchive = false;
   let conversation = [];
@@ -601,6 +641,7 @@ function initChatMode() {
 
   function resetArchiveId() {
     currentArchiveId = null;
+    serverTurns = null;
     localStorage.removeItem(archiveKey);
   }
 
@@ -646,6 +687,7 @@ function initChatMode() {
         }));
         messageSeq = conversation.length;
         currentArchiveId = data.archive_id || currentArchiveId;
+        serverTurns = null;
         restoredFromArchive = true;
         saveConversationHistory(currentCharacterId, conversation);
         chatHistory.innerHTML = "";
@@ -678,17 +720,46 @@ function initChatMode() {
     }
   }
 
+  // the turns `keep` and edit indexes count: non-empty user/assistant messages, the same
+  // filter the server applies to its stored messages before using them
+  function storedTurns(historyTurns) {
+    return (historyTurns || [])
+      .filter((turn) => (turn?.role === "user" || turn?.role === "assistant") && turn.content)
+      .map((turn) => ({ role: turn.role, content: turn.content }));
+  }
+
+  // how `turns` differs from what the server stored: a prefix length plus in-place edits,
+  // or null when only the full history can describe it
+  function historyDelta(turns) {
+    if (!serverTurns || turns.length > serverTurns.length) return null;
+    const edits = [];
+    for (let i = 0; i < turns.length; i += 1) {
+      if (turns[i].role !== serverTurns[i].role) return null;
+      if (turns[i].content !== serverTurns[i].content) {
+        edits.push({ index: i, content: turns[i].content });
+      }
+    }
+    if (edits.length > turns.length / 2) return null;
+    return { keep: turns.length, edits };
+  }
+
   function buildChatPayload(prompt, historyTurns) {
+    const turns = storedTurns(historyTurns);
     const payload = {
       prompt,
       character_id: parseInt(currentCharacter.id, 10) || 1,
       mode: currentCharacter.mode || "chat",
-      history: (historyTurns || []).map((turn) => ({
-        role: turn.role,
-        content: turn.content,
-      })),
       archive_id: currentArchiveId,
+      // text-only deltas, merged server-side into ~40ms batches
+      stream_format: "compact",
     };
+    const delta = currentArchiveId ? historyDelta(turns) : null;
+    if (delta) {
+      payload.keep = delta.keep;
+      if (delta.edits.length) payload.edits = delta.edits;
+    } else {
+      payload.history = turns;
+    }
 
     const detectedLang =
       detectLanguageFromText(prompt) ||
@@ -718,7 +789,9 @@ function initChatMode() {
 
     if (isImageSource) {
       const img = document.createElement("img");
-      img.src = source;
+      const small = iconVariant(source, 64);
+      img.src = small;
+      if (small !== source) img.srcset = `${small} 1x, ${iconVariant(source, 128)} 2x`;
       img.alt = name;
       img.className = "msg-label-icon";
       return img;
@@ -815,7 +888,7 @@ function initChatMode() {
   }
 
   async function streamAssistantResponse({ prompt, historyTurns, statusKey }) {
-    const payload = buildChatPayload(prompt, historyTurns);
+    let payload = buildChatPayload(prompt, historyTurns);
     const assistantTurn = { id: nextMessageId(), role: "assistant", content: "" };
     const assistantRendered = addMessage(assistantTurn);
     const bodyEl = assistantRendered?.bodyEl;
@@ -829,11 +902,19 @@ function initChatMode() {
     }
 
     try {
-      const res = await fetch(API_URL, {
-        method: "POST",
-        headers: { "Content-Type": "application/json" },
-        body: JSON.stringify(payload),
-      });
+      const post = () =>
+        fetch(API_URL, {
+          method: "POST",
+          headers: { "Content-Type": "application/json" },
+          body: JSON.stringify(payload),
+        });
+      let res = await post();
+      if (res.status === 409) {
+        // the server no longer has this conversation; resend the full history
+        serverTurns = null;
+        payload = buildChatPayload(prompt, historyTurns);
+        res = await post();
+      }
 
       if (!res.ok) {
         throw new Error("HTTP " + res.status);
@@ -842,6 +923,19 @@ function initChatMode() {
       const reader = res.body.getReader();
       const decoder = new TextDecoder("utf-8");
       let buffer = "";
+      let queued = false;
+      let renderPending = false;
+
+      // re-render at most once per frame, however many deltas arrive
+      const scheduleRender = () => {
+        if (renderPending) return;
+        renderPending = true;
+        requestAnimationFrame(() => {
+          renderPending = false;
+          if (bodyEl) bodyEl.innerHTML = renderInlineFormatting(assistantBuffer);
+          chatHistory.scrollTop = chatHistory.scrollHeight;
+        });
+      };
 
       while (true) {
         const { value, done } = await reader.read();
@@ -858,12 +952,27 @@ function initChatMode() {
 
           try {
             const json = JSON.parse(trimmed);
-            const delta = json.choices?.[0]?.delta?.content;
+            if (json.queue) {
+              // waiting for a free upstream slot
+              queued = true;
+              if (statusText) {
+                statusText.textContent = t(
+                  "chat.status.queued",
+                  "Waiting in queue (#{position})…"
+                ).replace("{position}", json.queue.position);
+              }
+              continue;
+            }
+            // compact frames carry the text in "d"; raw ones are OpenAI chunks
+            const delta = json.d ?? json.choices?.[0]?.delta?.content;
             if (delta) {
+              if (queued) {
+                queued = false;
+                setStatus(statusKey || "chat.status.thinking", fallbackStatus);
+              }
               assistantBuffer += delta;
               assistantTurn.content = assistantBuffer;
-              if (bodyEl) bodyEl.innerHTML = renderInlineFormatting(assistantBuffer);
-              chatHistory.scrollTop = chatHistory.scrollHeight;
+              scheduleRender();
             }
           } catch {
             // ignore partial/unparsable chunks
@@ -871,6 +980,13 @@ function initChatMode() {
         }
       }
 
+      if (bodyEl) bodyEl.innerHTML = renderInlineFormatting(assistantBuffer);
+      serverTurns = storedTurns(
+        (historyTurns || []).concat([
+          { role: "user", content: prompt },
+          { role: "assistant", content: assistantBuffer },
+        ])
+      );
       setStatus("chat.status.ready", "Ready");
       assistantTurn.content = assistantBuffer;
       conversation.push(assistantTurn);
@@ -880,6 +996,7 @@ function initChatMode() {
       return assistantTurn;
     } catch (err) {
       console.error(err);
+      serverTurns = null;
       addMessage({ id: nextMessageId(), role: "system", content: "Stream error: " + err.message });
       setStatus("chat.status.error", "Error");
       return null;
@@ -198,8 +198,13 @@ const NB_MODEL_STORAGE_KEY = "dreamui-active-model";
             if (!trimmed) continue;
             try {
               const json = JSON.parse(trimmed);
-              const delta = json.choices?.[0]?.delta?.content;
+              if (json.queue) {
+                setStatus(`Queued (#${json.queue.position})...`);
+                continue;
+              }
+              const delta = json.d ?? json.choices?.[0]?.delta?.content;
               if (delta) {
+                if (statusEl?.textContent.startsWith("Queued")) setStatus("Continuing...");
                 textEl.value += delta;
                 updateTokens();
               }
@@ -232,6 +237,7 @@ const NB_MODEL_STORAGE_KEY = "dreamui-active-model";
       const payload = {
         text: baseText,
         style: style || null,
+        stream_format: "compact",
       };
       const storedModel = localStorage.getItem(NB_MODEL_STORAGE_KEY);
       if (storedModel) {
@@ -3,6 +3,7 @@ const WORLD_API_BASE = "/world";
 (function () {
   const NEW_ENTRY_PREFIX = "world-";
 
+  // live editor hint only; saved entries carry the server's count in `tokens`
   function estimateTokens(text) {
     if (!text) return 0;
     return Math.max(0, Math.round(text.length / 4));
@@ -24,6 +25,8 @@ const WORLD_API_BASE = "/world";
     const nameEl = document.getElementById("worldName");
     const descEl = document.getElementById("worldDescription");
     const enabledEl = document.getElementById("worldEnabled");
+    const keysEl = document.getElementById("worldKeys");
+    const priorityEl = document.getElementById("worldPriority");
     const addBtn = document.getElementById("worldAddBtn");
     const saveBtn = document.getElementById("worldSaveBtn");
     const deleteBtn = document.getElementById("worldDeleteBtn");
@@ -81,6 +84,8 @@ const WORLD_API_BASE = "/world";
         nameEl.value = "";
         descEl.value = "";
         enabledEl.checked = false;
+        if (keysEl) keysEl.value = "";
+        if (priorityEl) priorityEl.value = "0";
         updateCounters();
         return;
       }
@@ -88,9 +93,18 @@ const WORLD_API_BASE = "/world";
       nameEl.value = note.name || "";
       descEl.value = note.description || "";
       enabledEl.checked = Boolean(note.enabled);
+      if (keysEl) keysEl.value = (note.keys || []).join(", ");
+      if (priorityEl) priorityEl.value = String(note.priority || 0);
       updateCounters();
     }
 
+    function parseKeys(raw) {
+      return (raw || "")
+        .split(",")
+        .map((k) => k.trim())
+        .filter(Boolean);
+    }
+
     async function loadNotes() {
       try {
         notes = await apiFetch(WORLD_API_BASE);
@@ -202,12 +216,10 @@ const WORLD_API_BASE = "/world";
         name: partial.name,
         description: partial.description || "",
         enabled: Boolean(partial.enabled),
-        tokens:
-          typeof partial.tokens === "number"
-            ? partial.tokens
-            : estimateTokens(partial.description || ""),
         slug: partial.slug || undefined,
         previous_slug: previousSlug,
+        keys: partial.keys || [],
+        priority: Number(partial.priority) || 0,
       };
 
       const saved = await apiFetch(WORLD_API_BASE, {
@@ -243,14 +255,14 @@ const WORLD_API_BASE = "/world";
       const name = nameEl.value.trim() || translate("world.untitled", "Untitled entry");
       const description = descEl.value;
       const enabled = Boolean(enabledEl.checked);
-      const tokens = estimateTokens(description);
       const payload = {
         name,
         description,
         enabled,
-        tokens,
         slug: currentSlug || undefined,
         previous_slug: currentSlug || undefined,
+        keys: parseKeys(keysEl?.value),
+        priority: Number(priorityEl?.value) || 0,
       };
       const saved = await saveNote(payload, quiet);
       renderList();
@@ -278,6 +290,8 @@ const WORLD_API_BASE = "/world";
       nameEl.value = translate("world.new_entry_name", "New entry");
       descEl.value = "";
       enabledEl.checked = true;
+      if (keysEl) keysEl.value = "";
+      if (priorityEl) priorityEl.value = "0";
       currentSlug = `${NEW_ENTRY_PREFIX}${now}`;
       updateCounters();
       await saveCurrent(false);
@@ -348,6 +362,8 @@ const WORLD_API_BASE = "/world";
     enabledEl.addEventListener("change", () => {
       saveCurrent(true).catch((err) => setStatus(err.message));
     });
+    keysEl?.addEventListener("input", () => queueSave());
+    priorityEl?.addEventListener("change", () => queueSave());
 
     // initial load
     updateCounters();
@@ -1,15 +1,43 @@
+from collections import OrderedDict
 from pathlib import Path
 import json
+import os
 import re
+import threading
 import time
 from typing import List, Optional, Dict, Any
 
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 
+from . import archive_index
+from .chat_log import append_records, log_path_for, make_record, read_records, replay
+from .etags import not_modified, set_validator, store_etag
+from .preferences import config_section
+from .storage import STORAGE_DEFAULTS, atomic_write_json, path_lock
+
 router = APIRouter()
 
 ARCHIVE_DIR = Path("static/userdata/archive")
+ARCHIVE_TYPES = ("chat", "roleplay", "story")
+ARCHIVE_PAGE_MAX = 500
+# how often the summary index is checked against file mtimes when the directory itself is unchanged
+INDEX_REVALIDATE_INTERVAL = 5.0
+# a chat's turn log is folded back into its header once it is at least this big
+# and larger than the header itself, which keeps compaction cost amortized O(1) per turn
+CHAT_LOG_COMPACT_MIN_BYTES = 64 * 1024
+# full message lists (and append state) of recently active chats, so incremental chat
+# requests don't re-read and replay the archive on every turn
+CHAT_SESSION_CACHE_SIZE = 32
+
+
+def storage_settings() -> Dict[str, Any]:
+    return config_section("storage", STORAGE_DEFAULTS)
+
+
+def _fsync() -> bool:
+    return bool(storage_settings()["fsync"])
 
 
 def _safe_id(raw: str) -> str:
@@ -59,6 +87,8 @@ def _load_entry(path: Path) -> Optional[Dict[str, Any]]:
     try:
         data = json.loads(path.read_text(encoding="utf-8"))
         if isinstance(data, dict):
+            if data.get("type") != "story":
+                replay(data, read_records(log_path_for(path)))
             data.setdefault("id", path.stem)
             data.setdefault("type", "chat")
             data.setdefault("preview", "")
@@ -72,17 +102,127 @@ def _load_entry(path: Path) -> Optional[Dict[str, Any]]:
     return None
 
 
-def list_archive_entries() -> List[Dict[str, Any]]:
-    _ensure_dir()
-    items: List[Dict[str, Any]] = []
-    for path in ARCHIVE_DIR.glob("*.json"):
-        if not path.is_file():
-            continue
-        entry = _load_entry(path)
-        if entry:
-            items.append(entry)
-    items.sort(key=lambda x: x.get("updated_at") or 0, reverse=True)
-    return items
+def _summary_from_entry(entry_id: str, data: Dict[str, Any], size: Optional[int]) -> Dict[str, Any]:
+    # keyed by file stem, which is what /archive/{entry_id} resolves
+    return {
+        "id": entry_id,
+        "type": data.get("type") or "chat",
+        "name": data.get("name") or "Untitled",
+        "preview": _generate_story_preview(data.get("preview") or ""),
+        "model": data.get("model") or "",
+        "character_id": data.get("character_id"),
+        "created_at": data.get("created_at"),
+        "updated_at": data.get("updated_at"),
+        "size": size,
+    }
+
+
+def _searchable_text(data: Dict[str, Any]) -> str:
+    if data.get("type") == "story":
+        return data.get("text") or ""
+    return "\n".join(
+        str(m.get("content") or "") for m in (data.get("messages") or []) if isinstance(m, dict)
+    )
+
+
+_index_lock = threading.Lock()
+_index_dir_mtime: Optional[int] = None
+_index_checked_at = 0.0
+# set when a summary was updated without its full-text row
+_index_stale = False
+
+
+def _entry_signature(path: Path) -> Optional[tuple[int, int]]:
+    """(latest mtime_ns, total bytes) over an entry's header and turn log."""
+    try:
+        st = path.stat()
+    except OSError:
+        return None
+    mtime_ns, size = st.st_mtime_ns, st.st_size
+    try:
+        log_st = log_path_for(path).stat()
+    except OSError:
+        return mtime_ns, size
+    return max(mtime_ns, log_st.st_mtime_ns), size + log_st.st_size
+
+
+def _dir_mtime() -> Optional[int]:
+    try:
+        return ARCHIVE_DIR.stat().st_mtime_ns
+    except OSError:
+        return None
+
+
+def _index_written(path: Path, data: Dict[str, Any], text: bool = True) -> None:
+    """Record a freshly written archive file in the summary index.
+
+    With text=False only the summary is updated; the entry is left without an
+    mtime so the next sync reparses it and refreshes its full-text row once,
+    rather than on every appended turn.
+    """
+    global _index_dir_mtime, _index_stale
+    signature = _entry_signature(path)
+    if signature is None:
+        return
+    mtime_ns, size = signature
+    summary = _summary_from_entry(path.stem, data, size)
+    if text:
+        archive_index.upsert_summary(summary, mtime_ns, _searchable_text(data))
+    else:
+        archive_index.upsert_summary(summary, None, None)
+        _index_stale = True
+    if _index_dir_mtime is not None:
+        # our own write should not trigger a full rescan
+        _index_dir_mtime = _dir_mtime()
+
+
+def sync_archive_index(force: bool = False) -> None:
+    """Bring the summary index in line with the archive files, reparsing only changed ones."""
+    global _index_dir_mtime, _index_checked_at, _index_stale
+    with _index_lock:
+        now = time.monotonic()
+        dir_mtime = _dir_mtime()
+        if (
+            not force
+            and not _index_stale
+            and _index_dir_mtime is not None
+            and dir_mtime == _index_dir_mtime
+            and now - _index_checked_at < INDEX_REVALIDATE_INTERVAL
+        ):
+            return
+        _ensure_dir()
+        indexed = archive_index.indexed_signatures()
+        on_disk = set()
+        changed = []
+        with os.scandir(ARCHIVE_DIR) as it:
+            for item in it:
+                if not item.name.endswith(".json") or not item.is_file():
+                    continue
+                entry_id = item.name[: -len(".json")]
+                on_disk.add(entry_id)
+                signature = _entry_signature(Path(item.path))
+                if signature is None or indexed.get(entry_id) == signature:
+                    continue
+                data = _load_entry(Path(item.path))
+                if data:
+                    mtime_ns, size = signature
+                    changed.append(
+                        (_summary_from_entry(entry_id, data, size), mtime_ns, _searchable_text(data))
+                    )
+        stale = [entry_id for entry_id in indexed if entry_id not in on_disk]
+        if changed:
+            archive_index.upsert_summaries(changed)
+        if stale:
+            archive_index.remove_summaries(stale)
+        _index_dir_mtime = dir_mtime
+        _index_checked_at = now
+        _index_stale = False
+
+
+def query_archive_entries(**filters: Any) -> tuple[List[Dict[str, Any]], Optional[int], Optional[str]]:
+    """Paged/filtered summaries; see archive_index.query_summaries for the arguments."""
+    sync_archive_index()
+    return archive_index.query_summaries(**filters)
 
 
 def load_archive_entry(entry_id: str) -> Optional[Dict[str, Any]]:
@@ -124,6 +264,108 @@ def _generate_story_preview(text: str) -> str:
     return snippet
 
 
+# per-chat state kept between turns so saves can append instead of re-reading the archive;
+# an entry's state is only used while holding its storage.path_lock. Least recently used
+# states are evicted and rebuilt from the file on the next save.
+_chat_states: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_states_lock = threading.Lock()
+
+
+def _remember_chat_state(entry_id: str, state: Dict[str, Any]) -> None:
+    with _states_lock:
+        _chat_states[entry_id] = state
+        _chat_states.move_to_end(entry_id)
+        while len(_chat_states) > CHAT_SESSION_CACHE_SIZE:
+            _chat_states.popitem(last=False)
+
+
+def _message_key(message: dict) -> int:
+    return hash((message.get("role"), message.get("content")))
+
+
+def _chat_state_from(data: Dict[str, Any], header_bytes: int, log_bytes: int) -> Dict[str, Any]:
+    return {
+        "keys": [_message_key(m) for m in data.get("messages") or []],
+        "name": data.get("name"),
+        "model": data.get("model"),
+        "character_id": data.get("character_id"),
+        "created_at": _normalize_ts(data.get("created_at")),
+        "header_bytes": header_bytes,
+        "log_bytes": log_bytes,
+    }
+
+
+def _load_chat_state(entry_id: str, path: Path) -> Optional[Dict[str, Any]]:
+    with _states_lock:
+        state = _chat_states.get(entry_id)
+        if state is not None:
+            _chat_states.move_to_end(entry_id)
+            return state
+    if not path.exists():
+        return None
+    existing = _load_entry(path)
+    if not existing:
+        return None
+    log_path = log_path_for(path)
+    log_bytes = log_path.stat().st_size if log_path.exists() else 0
+    state = _chat_state_from(existing, path.stat().st_size, log_bytes)
+    _remember_chat_state(entry_id, state)
+    return state
+
+
+def _write_chat_header(path: Path, data: Dict[str, Any]) -> None:
+    """Write the full entry as a header and drop its turn log (initial save or compaction).
+
+    A crash between the two steps is harmless: log records carry absolute "keep"
+    offsets, so replaying a leftover log over the compacted header is idempotent.
+    """
+    header_bytes = atomic_write_json(path, data, fsync=_fsync())
+    log_path_for(path).unlink(missing_ok=True)
+    _remember_chat_state(data["id"], _chat_state_from(data, header_bytes, 0))
+
+
+def _forget_chat(path: Path) -> None:
+    log_path_for(path).unlink(missing_ok=True)
+    with _states_lock:
+        _chat_states.pop(path.stem, None)
+    with _sessions_lock:
+        _chat_sessions.pop(path.stem, None)
+
+
+_chat_sessions: "OrderedDict[str, List[dict]]" = OrderedDict()
+_sessions_lock = threading.Lock()
+
+
+def _remember_session(entry_id: str, messages: List[dict]) -> None:
+    with _sessions_lock:
+        _chat_sessions[entry_id] = list(messages)
+        _chat_sessions.move_to_end(entry_id)
+        while len(_chat_sessions) > CHAT_SESSION_CACHE_SIZE:
+            _chat_sessions.popitem(last=False)
+
+
+def load_chat_history(archive_id: str) -> Optional[List[dict]]:
+    """Stored messages of a chat/roleplay entry, from the session cache when possible."""
+    entry_id = _safe_id(archive_id)
+    with _sessions_lock:
+        cached = _chat_sessions.get(entry_id)
+        if cached is not None:
+            _chat_sessions.move_to_end(entry_id)
+            return list(cached)
+    path = _entry_path(entry_id)
+    with path_lock(path):
+        data = load_archive_entry(entry_id)
+        if not data or data.get("type") == "story":
+            return None
+        messages = [m for m in data.get("messages") or [] if isinstance(m, dict)]
+        _remember_session(entry_id, messages)
+    return list(messages)
+
+
+async def load_chat_history_async(archive_id: str) -> Optional[List[dict]]:
+    return await run_in_threadpool(load_chat_history, archive_id)
+
+
 def save_chat_archive(
     archive_id: Optional[str],
     messages: list[dict],
@@ -131,32 +373,75 @@ def save_chat_archive(
     character_id: Optional[int],
     entry_type: str = "chat",
 ) -> str:
-    """Create or update a chat/roleplay archive entry."""
+    """Create or update a chat/roleplay archive entry.
+
+    Existing chats only append the turns that differ from what is already stored.
+    """
     _ensure_dir()
-    entry_id = archive_id or f"chat_{int(time.time()*1000)}"
+    entry_id = _safe_id(archive_id or f"chat_{int(time.time()*1000)}")
     path = _entry_path(entry_id)
-    existing = load_archive_entry(entry_id) or {}
-
-    created_at = _normalize_ts(existing.get("created_at")) or int(time.time() * 1000)
-    preview = messages[-1]["content"] if messages else existing.get("preview", "")
-    name = existing.get("name") or _generate_chat_name(messages, model)
-
-    data = {
-        "id": _safe_id(entry_id),
-        "type": entry_type or "chat",
-        "name": name,
-        "preview": preview,
-        "model": model or existing.get("model") or "",
-        "updated_at": int(time.time() * 1000),
-        "created_at": created_at,
-        "messages": messages,
-        "character_id": character_id or existing.get("character_id"),
-    }
-    path.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
-    return data["id"]
+    now = int(time.time() * 1000)
+    with path_lock(path):
+        state = _load_chat_state(entry_id, path) or {}
+        data = {
+            "id": entry_id,
+            "type": entry_type or "chat",
+            "name": state.get("name") or _generate_chat_name(messages, model),
+            "preview": messages[-1]["content"] if messages else "",
+            "model": model or state.get("model") or "",
+            "updated_at": now,
+            "created_at": state.get("created_at") or now,
+            "messages": messages,
+            "character_id": character_id or state.get("character_id"),
+        }
+        header_written = not state
+        if header_written:
+            _write_chat_header(path, data)
+        else:
+            keys = [_message_key(m) for m in messages]
+            stored = state["keys"]
+            keep = 0
+            while keep < len(stored) and keep < len(keys) and stored[keep] == keys[keep]:
+                keep += 1
+            meta = {k: v for k, v in data.items() if k not in ("id", "name", "created_at", "messages")}
+            written = append_records(
+                log_path_for(path), [make_record(keep, messages[keep:], meta)], fsync=_fsync()
+            )
+            state.update(
+                keys=keys,
+                model=data["model"],
+                character_id=data["character_id"],
+                log_bytes=state["log_bytes"] + written,
+            )
+            if state["log_bytes"] >= max(CHAT_LOG_COMPACT_MIN_BYTES, state["header_bytes"]):
+                _write_chat_header(path, data)
+                header_written = True
+        # appended turns reach the full-text index lazily, on the next list or search
+        _index_written(path, data, text=header_written)
+        _remember_session(entry_id, messages)
+    return entry_id
+
+
+async def save_chat_archive_async(
+    archive_id: Optional[str],
+    messages: list[dict],
+    model: Optional[str],
+    character_id: Optional[int],
+    entry_type: str = "chat",
+) -> str:
+    """save_chat_archive for async routes, run in the worker thread pool."""
+    return await run_in_threadpool(
+        save_chat_archive, archive_id, messages, model, character_id, entry_type
+    )
 
 
-def save_story_archive(text: str, model: Optional[str], name: Optional[str] = None, preview: Optional[str] = None) -> str:
+def save_story_archive(
+    text: str,
+    model: Optional[str],
+    name: Optional[str] = None,
+    preview: Optional[str] = None,
+    truncated: bool = False,
+) -> str:
     """Create a story archive entry with text content."""
     _ensure_dir()
     entry_id = f"story-{int(time.time()*1000)}"
@@ -173,18 +458,103 @@ def save_story_archive(text: str, model: Optional[str], name: Optional[str] = No
         "created_at": now,
         "text": text or "",
     }
+    if truncated:
+        # generation was cut short (client disconnected)
+        data["truncated"] = True
     path = _entry_path(entry_id)
-    path.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+    atomic_write_json(path, data, fsync=_fsync())
+    _index_written(path, data)
     return data["id"]
 
 
+async def save_story_archive_async(
+    text: str,
+    model: Optional[str],
+    name: Optional[str] = None,
+    preview: Optional[str] = None,
+    truncated: bool = False,
+) -> str:
+    return await run_in_threadpool(save_story_archive, text, model, name, preview, truncated)
+
+
 @router.get("/archive")
-def api_list_archive():
-    return list_archive_entries()
+def api_list_archive(
+    request: Request,
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=ARCHIVE_PAGE_MAX),
+    cursor: Optional[str] = None,
+    type: Optional[str] = None,
+    character_id: Optional[int] = None,
+    model: Optional[str] = None,
+    since: Optional[int] = None,
+    until: Optional[int] = None,
+    sort: str = "updated_at",
+    order: str = "desc",
+):
+    if type is not None and type not in ARCHIVE_TYPES:
+        raise HTTPException(status_code=400, detail=f"Unknown archive type: {type}")
+    if sort not in archive_index.SORT_FIELDS:
+        raise HTTPException(status_code=400, detail=f"Unsupported sort field: {sort}")
+    if order not in ("asc", "desc"):
+        raise HTTPException(status_code=400, detail=f"Unsupported sort order: {order}")
+    sync_archive_index()
+    # one validator for every page and filter: it is the global index version, so any
+    # archive change revalidates all cached listings, including ones it did not touch
+    etag = store_etag("archive", archive_index.index_version())
+    cached = not_modified(request, etag)
+    if cached:
+        return cached
+    set_validator(response, etag)
+    try:
+        items, total, next_cursor = query_archive_entries(
+            limit=limit,
+            cursor=cursor,
+            entry_type=type,
+            character_id=character_id,
+            model=model,
+            since=_normalize_ts(since),
+            until=_normalize_ts(until),
+            sort=sort,
+            order=order,
+        )
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail="Invalid cursor") from exc
+    if total is not None:
+        response.headers["X-Total-Count"] = str(total)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return items
+
+
+@router.get("/archive/search")
+def api_search_archive(
+    request: Request,
+    response: Response,
+    q: str = Query(..., min_length=1),
+    limit: int = Query(20, ge=1, le=100),
+    type: Optional[str] = None,
+):
+    if type is not None and type not in ARCHIVE_TYPES:
+        raise HTTPException(status_code=400, detail=f"Unknown archive type: {type}")
+    sync_archive_index()
+    # global index version, as for the listing
+    etag = store_etag("archive", archive_index.index_version())
+    cached = not_modified(request, etag)
+    if cached:
+        return cached
+    set_validator(response, etag)
+    return archive_index.search(q, limit=limit, entry_type=type)
 
 
 @router.get("/archive/{entry_id}")
-def api_get_archive(entry_id: str):
+def api_get_archive(entry_id: str, request: Request, response: Response):
+    signature = _entry_signature(_entry_path(entry_id))
+    if signature is not None:
+        etag = store_etag("entry", "{}-{}".format(*signature))
+        cached = not_modified(request, etag)
+        if cached:
+            return cached
+        set_validator(response, etag)
     data = load_archive_entry(entry_id)
     if not data:
         raise HTTPException(status_code=404, detail="Archive entry not found")
@@ -196,23 +566,26 @@ def api_save_archive(entry: ArchiveEntry):
     _ensure_dir()
     entry_id = entry.id or f"arch_{int(time.time()*1000)}"
     path = _entry_path(entry_id)
-    existing = load_archive_entry(entry_id) or {}
-    created_at = (
-        _normalize_ts(existing.get("created_at"))
-        or _normalize_ts(entry.created_at)
-        or int(time.time() * 1000)
-    )
-    data = {
-        "id": _safe_id(entry_id),
-        "type": entry.type or "chat",
-        "name": entry.name or existing.get("name") or "Untitled",
-        "preview": entry.preview or existing.get("preview") or "",
-        "model": entry.model or existing.get("model") or "",
-        "updated_at": int(time.time() * 1000),
-        "created_at": created_at,
-        "messages": entry.messages or existing.get("messages") or [],
-    }
-    path.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+    with path_lock(path):
+        existing = load_archive_entry(entry_id) or {}
+        created_at = (
+            _normalize_ts(existing.get("created_at"))
+            or _normalize_ts(entry.created_at)
+            or int(time.time() * 1000)
+        )
+        data = {
+            "id": _safe_id(entry_id),
+            "type": entry.type or "chat",
+            "name": entry.name or existing.get("name") or "Untitled",
+            "preview": entry.preview or existing.get("preview") or "",
+            "model": entry.model or existing.get("model") or "",
+            "updated_at": int(time.time() * 1000),
+            "created_at": created_at,
+            "messages": entry.messages or existing.get("messages") or [],
+        }
+        atomic_write_json(path, data, fsync=_fsync())
+        _forget_chat(path)
+        _index_written(path, data)
     return data
 
 
@@ -228,7 +601,10 @@ def api_delete_archive(entry_id: str):
     if not path.exists():
         raise HTTPException(status_code=404, detail="Archive entry not found")
     try:
-        path.unlink()
+        with path_lock(path):
+            path.unlink()
+            _forget_chat(path)
     except Exception as exc:
         raise HTTPException(status_code=500, detail=f"Failed to delete archive: {exc}") from exc
+    archive_index.remove_summary(_safe_id(entry_id))
     return {"status": "deleted", "id": _safe_id(entry_id)}
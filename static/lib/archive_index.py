@@ -0,0 +1,310 @@
+import base64
+import re
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from .db_core import get_db
+
+SUMMARY_FIELDS = (
+    "id",
+    "type",
+    "name",
+    "preview",
+    "model",
+    "character_id",
+    "created_at",
+    "updated_at",
+    "size",
+)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS archive_index (
+    -- explicit rowid alias: VACUUM keeps it stable, and archive_fts rows are keyed by it
+    rowid_key INTEGER PRIMARY KEY,
+    id TEXT NOT NULL UNIQUE,
+    type TEXT NOT NULL,
+    name TEXT NOT NULL,
+    preview TEXT,
+    model TEXT,
+    character_id INTEGER,
+    created_at INTEGER,
+    updated_at INTEGER,
+    size INTEGER,
+    mtime_ns INTEGER
+);
+CREATE INDEX IF NOT EXISTS archive_index_updated ON archive_index (updated_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS archive_index_created ON archive_index (created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS archive_index_type ON archive_index (type, updated_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS archive_index_character ON archive_index (character_id, updated_at DESC, id DESC);
+"""
+
+# full-text index: one row per archive entry holding its name and all message/story text.
+# Its rowid is the archive_index rowid_key, so rows are found by key rather than by scanning
+# (rowid_key never changes: writes go through an upsert, never REPLACE, and VACUUM keeps
+# INTEGER PRIMARY KEY values).
+_FTS_SCHEMA = """
+CREATE VIRTUAL TABLE archive_fts USING fts5(
+    name,
+    body,
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+"""
+
+SNIPPET_OPEN = "<mark>"
+SNIPPET_CLOSE = "</mark>"
+
+_schema_ready = False
+
+
+def _ensure_schema(conn) -> None:
+    global _schema_ready
+    if _schema_ready:
+        return
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(archive_index)")}
+    if columns and "rowid_key" not in columns:
+        # earlier layout keyed text rows by the implicit rowid, which VACUUM may renumber;
+        # both tables only mirror the archive files, so the next sync rebuilds them
+        conn.execute("DROP TABLE IF EXISTS archive_fts")
+        conn.execute("DROP TABLE archive_index")
+    conn.executescript(_SCHEMA)
+    has_fts = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'archive_fts'"
+    ).fetchone()
+    if has_fts and "entry_id" in {row[1] for row in conn.execute("PRAGMA table_info(archive_fts)")}:
+        # earlier layout keyed text rows by an unindexed entry_id column
+        conn.execute("DROP TABLE archive_fts")
+        has_fts = None
+    if not has_fts:
+        conn.executescript(_FTS_SCHEMA)
+        # summaries indexed before this full-text layout have no text rows yet;
+        # dropping them makes the next sync reparse and index every entry
+        conn.execute("DELETE FROM archive_index")
+        conn.commit()
+    _schema_ready = True
+
+
+# grows on every write, so listings can be revalidated without querying
+_version = 0
+
+
+def index_version() -> int:
+    return _version
+
+
+def _bump_version() -> None:
+    global _version
+    _version += 1
+
+
+def _row_values(summary: Dict[str, Any], mtime_ns: Optional[int]) -> Tuple:
+    return tuple(summary.get(field) for field in SUMMARY_FIELDS) + (mtime_ns,)
+
+
+def _rowids(conn, entry_ids: Iterable[str]) -> List[int]:
+    rowids = []
+    for entry_id in entry_ids:
+        row = conn.execute("SELECT rowid_key FROM archive_index WHERE id = ?", (entry_id,)).fetchone()
+        if row is not None:
+            rowids.append(row[0])
+    return rowids
+
+
+def upsert_summaries(rows: Iterable[Tuple[Dict[str, Any], Optional[int], Optional[str]]]) -> None:
+    """Insert or replace (summary, file mtime_ns, searchable body) triples.
+
+    A body of None updates the summary only and leaves the entry's text rows as they are.
+    """
+    rows = list(rows)
+    placeholders = ", ".join("?" for _ in range(len(SUMMARY_FIELDS) + 1))
+    columns = ", ".join(SUMMARY_FIELDS + ("mtime_ns",))
+    updates = ", ".join(f"{field} = excluded.{field}" for field in SUMMARY_FIELDS[1:] + ("mtime_ns",))
+    with get_db() as conn:
+        _ensure_schema(conn)
+        conn.executemany(
+            f"INSERT INTO archive_index ({columns}) VALUES ({placeholders}) "
+            f"ON CONFLICT(id) DO UPDATE SET {updates}",
+            [_row_values(summary, mtime_ns) for summary, mtime_ns, _ in rows],
+        )
+        texts = [(summary, body) for summary, _, body in rows if body is not None]
+        rowids = _rowids(conn, [summary["id"] for summary, _ in texts])
+        conn.executemany("DELETE FROM archive_fts WHERE rowid = ?", [(rowid,) for rowid in rowids])
+        conn.executemany(
+            "INSERT INTO archive_fts (rowid, name, body) VALUES (?, ?, ?)",
+            [
+                (rowid, summary.get("name") or "", body)
+                for rowid, (summary, body) in zip(rowids, texts)
+            ],
+        )
+        conn.commit()
+    _bump_version()
+
+
+def upsert_summary(summary: Dict[str, Any], mtime_ns: Optional[int], body: Optional[str]) -> None:
+    upsert_summaries([(summary, mtime_ns, body)])
+
+
+def remove_summaries(entry_ids: Iterable[str]) -> None:
+    entry_ids = list(entry_ids)
+    with get_db() as conn:
+        _ensure_schema(conn)
+        rowids = _rowids(conn, entry_ids)
+        conn.executemany("DELETE FROM archive_fts WHERE rowid = ?", [(rowid,) for rowid in rowids])
+        conn.executemany("DELETE FROM archive_index WHERE id = ?", [(i,) for i in entry_ids])
+        conn.commit()
+    _bump_version()
+
+
+def remove_summary(entry_id: str) -> None:
+    remove_summaries([entry_id])
+
+
+def indexed_signatures() -> Dict[str, Tuple[Optional[int], Optional[int]]]:
+    """Return id -> (mtime_ns, size) for every indexed entry."""
+    with get_db() as conn:
+        _ensure_schema(conn)
+        rows = conn.execute("SELECT id, mtime_ns, size FROM archive_index").fetchall()
+    return {row["id"]: (row["mtime_ns"], row["size"]) for row in rows}
+
+
+SORT_FIELDS = ("updated_at", "created_at")
+
+
+def encode_cursor(sort_value: Optional[int], entry_id: str) -> str:
+    raw = f"{sort_value or 0}:{entry_id}".encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[int, str]:
+    """Raise ValueError on malformed cursors."""
+    padded = cursor + "=" * (-len(cursor) % 4)
+    raw = base64.urlsafe_b64decode(padded.encode("ascii")).decode("utf-8")
+    sort_value, _, entry_id = raw.partition(":")
+    if not entry_id:
+        raise ValueError("malformed cursor")
+    return int(sort_value), entry_id
+
+
+def query_summaries(
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    entry_type: Optional[str] = None,
+    character_id: Optional[int] = None,
+    model: Optional[str] = None,
+    since: Optional[int] = None,
+    until: Optional[int] = None,
+    sort: str = "updated_at",
+    order: str = "desc",
+) -> Tuple[List[Dict[str, Any]], Optional[int], Optional[str]]:
+    """Filtered keyset page of summaries: (items, total matching, next cursor).
+
+    The total is only counted for the first page (no cursor) and is None otherwise;
+    the filter set is the same for every page, so later pages would only repeat it.
+    """
+    if sort not in SORT_FIELDS:
+        raise ValueError(f"unsupported sort field: {sort}")
+    descending = order != "asc"
+
+    where: List[str] = []
+    params: List[Any] = []
+    if entry_type:
+        where.append("type = ?")
+        params.append(entry_type)
+    if character_id is not None:
+        where.append("character_id = ?")
+        params.append(character_id)
+    if model:
+        where.append("model = ?")
+        params.append(model)
+    if since is not None:
+        where.append(f"{sort} >= ?")
+        params.append(since)
+    if until is not None:
+        where.append(f"{sort} < ?")
+        params.append(until)
+
+    count_sql = "SELECT COUNT(*) FROM archive_index"
+    if where:
+        count_sql += " WHERE " + " AND ".join(where)
+    count_params = list(params)
+
+    if cursor:
+        sort_value, last_id = decode_cursor(cursor)
+        op = "<" if descending else ">"
+        where.append(f"({sort} {op} ? OR ({sort} = ? AND id {op} ?))")
+        params.extend([sort_value, sort_value, last_id])
+
+    direction = "DESC" if descending else "ASC"
+    columns = ", ".join(SUMMARY_FIELDS)
+    sql = f"SELECT {columns} FROM archive_index"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += f" ORDER BY {sort} {direction}, id {direction}"
+    if limit is not None:
+        # fetch one extra row to know whether another page exists
+        sql += " LIMIT ?"
+        params.append(limit + 1)
+
+    with get_db() as conn:
+        _ensure_schema(conn)
+        rows = [dict(row) for row in conn.execute(sql, params).fetchall()]
+        total = None if cursor else conn.execute(count_sql, count_params).fetchone()[0]
+
+    next_cursor = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(last.get(sort), last["id"])
+    return rows, total, next_cursor
+
+
+_QUERY_TERM = re.compile(r'"([^"]*)"|(\S+)')
+
+
+def build_match_query(raw: str) -> str:
+    """Turn user input into a safe FTS5 query.
+
+    "quoted text" becomes a phrase, a trailing * makes a prefix term, and every
+    other character is quoted so FTS5 operators in user input cannot break the query.
+    """
+    terms: List[str] = []
+    for phrase, word in _QUERY_TERM.findall(raw or ""):
+        if phrase:
+            text = phrase.strip()
+            if text:
+                terms.append('"' + text.replace('"', '""') + '"')
+            continue
+        prefix = word.endswith("*")
+        text = word.rstrip("*").replace('"', "")
+        if not text:
+            continue
+        terms.append('"' + text + '"' + ("*" if prefix else ""))
+    return " ".join(terms)
+
+
+def search(
+    raw_query: str,
+    limit: int = 20,
+    entry_type: Optional[str] = None,
+    snippet_tokens: int = 16,
+) -> List[Dict[str, Any]]:
+    """Ranked (bm25) matches joined with their summaries, each with a highlighted snippet."""
+    match = build_match_query(raw_query)
+    if not match:
+        return []
+    columns = ", ".join(f"a.{field}" for field in SUMMARY_FIELDS)
+    sql = (
+        f"SELECT {columns}, "
+        "snippet(archive_fts, 1, ?, ?, '…', ?) AS snippet, "
+        "bm25(archive_fts, 4.0, 1.0) AS score "
+        "FROM archive_fts JOIN archive_index a ON a.rowid_key = archive_fts.rowid "
+        "WHERE archive_fts MATCH ?"
+    )
+    params: List[Any] = [SNIPPET_OPEN, SNIPPET_CLOSE, snippet_tokens, match]
+    if entry_type:
+        sql += " AND a.type = ?"
+        params.append(entry_type)
+    sql += " ORDER BY score LIMIT ?"
+    params.append(limit)
+    with get_db() as conn:
+        _ensure_schema(conn)
+        rows = conn.execute(sql, params).fetchall()
+    return [dict(row) for row in rows]
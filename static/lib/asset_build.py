@@ -0,0 +1,290 @@
+"""Offline frontend build: bundles, minifies and precompresses the page assets.
+
+Run from the project root:
+
+    python -m static.lib.asset_build
+
+Writes static/dist/app.<hash>.css and app.<hash>.js (the partials from
+static/inc are inlined into the JS bundle as window.PARTIALS), a .gz and,
+when the `brotli` package is installed, a .br next to each, and
+manifest.json. The server switches to the bundles while every source still
+matches the manifest (see http_cache.current_bundles); edit a source and it
+falls back to the individual files until the next build.
+"""
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+import gzip
+import hashlib
+import json
+import re
+import sys
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from .http_cache import INDEX_PATH, asset_version
+from .storage import atomic_write_bytes
+
+DIST_DIR = Path("static/dist")
+MANIFEST_PATH = DIST_DIR / "manifest.json"
+PARTIALS_DIR = Path("static/inc")
+
+STYLESHEET_RE = re.compile(r'<link\s+rel="stylesheet"\s+href="(/static/[^"?#]+)"([^>]*)>')
+SCRIPT_RE = re.compile(r'<script\s+src="(/static/[^"?#]+)"></script>')
+
+JS_REGEX_AFTER = set("(,=:[!&|?{};+-*%<>~^")
+JS_REGEX_KEYWORDS = {
+    "return", "typeof", "case", "do", "else", "in", "of", "new", "delete",
+    "void", "throw", "yield", "await", "instanceof",
+}
+# a newline after these can go without changing automatic semicolon insertion
+JS_JOIN_AFTER = set(";{,([")
+# whitespace next to these is insignificant in CSS; spaces around + and - are kept,
+# since they matter inside calc()
+CSS_TIGHT = set("{};,>")
+
+
+def page_assets(index_html: str) -> Tuple[List[str], List[str]]:
+    """Stylesheet and script URLs of the page, in document order.
+
+    The theme stylesheet is swapped at runtime, so it stays a separate file.
+    """
+    styles = [m.group(1) for m in STYLESHEET_RE.finditer(index_html) if "themeStylesheet" not in m.group(2)]
+    scripts = [m.group(1) for m in SCRIPT_RE.finditer(index_html)]
+    return styles, scripts
+
+
+def _local(url: str) -> Path:
+    return Path(url.lstrip("/"))
+
+
+def _is_word(ch: str) -> bool:
+    return ch.isalnum() or ch in "_$" or ord(ch) > 127
+
+
+def minify_css(source: str) -> str:
+    """Drop comments and collapse whitespace; string contents are copied untouched."""
+    out: List[str] = []
+    space = False  # whitespace seen since the last emitted token
+
+    def emit(text: str) -> None:
+        nonlocal space
+        if space and out and out[-1][-1] not in CSS_TIGHT and text[0] not in CSS_TIGHT:
+            out.append(" ")
+        space = False
+        if text == "}" and out and out[-1] == ";":
+            out.pop()
+        out.append(text)
+
+    i, n = 0, len(source)
+    while i < n:
+        ch = source[i]
+        if ch in "\"'":
+            end = i + 1
+            while end < n and source[end] != ch:
+                end += 2 if source[end] == "\\" else 1
+            emit(source[i : end + 1])
+            i = end + 1
+        elif source.startswith("/*", i):
+            end = source.find("*/", i + 2)
+            i = n if end < 0 else end + 2
+        elif ch.isspace():
+            space = True
+            i += 1
+        else:
+            emit(ch)
+            i += 1
+    return "".join(out)
+
+
+def minify_js(source: str) -> str:
+    """Drop comments and indentation; keep a newline wherever ASI could depend on it."""
+    out: List[str] = []
+    pending = ""  # whitespace seen since the last emitted token: "", " " or "\n"
+    last = ""  # last emitted significant character
+    tail = ""  # last two emitted characters, to tell a postfix ++/-- from a binary +/-
+    last_word = ""  # last emitted identifier/keyword, for regex detection
+    braces: List[str] = []  # "{" for blocks, "`" for ${...} inside template literals
+    i, n = 0, len(source)
+
+    def emit(text: str, word: str = "") -> None:
+        nonlocal pending, last, last_word, tail
+        if pending == "\n" and last and last not in JS_JOIN_AFTER:
+            out.append("\n")
+        elif pending and last and (
+            (_is_word(last) and _is_word(text[0])) or (last in "+-" and text[0] == last)
+        ):
+            out.append(" ")
+        out.append(text)
+        pending = ""
+        last = text[-1]
+        last_word = word
+        tail = (out[-2][-1:] + text)[-2:] if len(out) > 1 else text[-2:]
+
+    def template_from(start: int) -> int:
+        """Copy template text from `start` (just past a backtick or `}`) up to the closing backtick or a `${`."""
+        j = start
+        while j < n:
+            if source[j] == "\\":
+                j += 2
+            elif source[j] == "`":
+                emit(source[start - 1 : j + 1])
+                return j + 1
+            elif source.startswith("${", j):
+                emit(source[start - 1 : j + 2])
+                braces.append("`")
+                return j + 2
+            else:
+                j += 1
+        raise ValueError("unterminated template literal")
+
+    while i < n:
+        ch = source[i]
+        if ch.isspace():
+            while i < n and source[i].isspace():
+                if source[i] == "\n":
+                    pending = "\n"
+                elif not pending:
+                    pending = " "
+                i += 1
+        elif source.startswith("//", i):
+            end = source.find("\n", i)
+            i = n if end < 0 else end
+        elif source.startswith("/*", i):
+            end = source.find("*/", i + 2)
+            if end < 0:
+                raise ValueError("unterminated comment")
+            if "\n" in source[i:end]:
+                pending = "\n"
+            elif not pending:
+                pending = " "
+            i = end + 2
+        elif ch in "\"'":
+            end = i + 1
+            while end < n and source[end] != ch:
+                if source[end] == "\n":
+                    raise ValueError("unterminated string literal")
+                end += 2 if source[end] == "\\" else 1
+            emit(source[i : end + 1])
+            i = end + 1
+        elif ch == "`":
+            i = template_from(i + 1)
+        elif ch == "/" and (
+            not last
+            or (last in JS_REGEX_AFTER and tail not in ("++", "--"))
+            or last_word in JS_REGEX_KEYWORDS
+        ):
+            end, in_class = i + 1, False
+            while end < n and (source[end] != "/" or in_class):
+                if source[end] == "\n":
+                    raise ValueError("unterminated regex literal")
+                if source[end] == "\\":
+                    end += 1
+                elif source[end] == "[":
+                    in_class = True
+                elif source[end] == "]":
+                    in_class = False
+                end += 1
+            end += 1
+            while end < n and _is_word(source[end]):
+                end += 1  # flags
+            emit(source[i:end])
+            i = end
+        elif _is_word(ch):
+            end = i
+            while end < n and _is_word(source[end]):
+                end += 1
+            word = source[i:end]
+            emit(word, word)
+            i = end
+        elif ch == "{":
+            braces.append("{")
+            emit(ch)
+            i += 1
+        elif ch == "}" and braces and braces[-1] == "`":
+            braces.pop()
+            pending = ""
+            i = template_from(i + 1)
+        else:
+            if ch == "}" and braces:
+                braces.pop()
+            emit(ch)
+            i += 1
+    return "".join(out).strip() + "\n"
+
+
+def _partials_script() -> Tuple[str, Dict[str, str]]:
+    partials: Dict[str, str] = {}
+    sources: Dict[str, str] = {}
+    for path in sorted(PARTIALS_DIR.glob("*.html")):
+        url = "/" + path.as_posix()
+        partials[url] = path.read_text(encoding="utf-8")
+        sources[url] = asset_version(path) or ""
+    script = "window.PARTIALS = " + json.dumps(partials, ensure_ascii=False, separators=(",", ":")) + ";\n"
+    return script, sources
+
+
+def _write(name: str, suffix: str, text: str) -> Dict[str, int]:
+    """Write a content-hashed bundle plus its precompressed variants; returns sizes."""
+    data = text.encode("utf-8")
+    digest = hashlib.sha256(data).hexdigest()[:12]
+    path = DIST_DIR / f"{name}.{digest}{suffix}"
+    # atomic: a rebuild with unchanged content rewrites files that may be being served
+    atomic_write_bytes(path, data, fsync=False)
+    sizes = {"file": path.name, "raw": len(data)}
+    gz = gzip.compress(data, compresslevel=9, mtime=0)
+    atomic_write_bytes(Path(f"{path}.gz"), gz, fsync=False)
+    sizes["gzip"] = len(gz)
+    if brotli is not None:
+        br = brotli.compress(data, quality=11)
+        atomic_write_bytes(Path(f"{path}.br"), br, fsync=False)
+        sizes["br"] = len(br)
+    return sizes
+
+
+def build(log=print) -> Dict[str, dict]:
+    index_html = INDEX_PATH.read_text(encoding="utf-8")
+    styles, scripts = page_assets(index_html)
+    DIST_DIR.mkdir(parents=True, exist_ok=True)
+
+    css = "\n".join(minify_css(_local(url).read_text(encoding="utf-8")) for url in styles) + "\n"
+    partials, partial_sources = _partials_script()
+    # each file keeps its own statement boundary, as separate <script> tags had
+    js = partials + ";\n".join(minify_js(_local(url).read_text(encoding="utf-8")) for url in scripts)
+
+    manifest: Dict[str, dict] = {}
+    written = {MANIFEST_PATH.name}
+    for kind, name, suffix, text, urls, extra in (
+        ("css", "app", ".css", css, styles, {}),
+        ("js", "app", ".js", js, scripts, partial_sources),
+    ):
+        sizes = _write(name, suffix, text)
+        written.update(sizes["file"] + ext for ext in ("", ".gz", ".br"))
+        sources = {url: asset_version(_local(url)) or "" for url in urls}
+        sources.update(extra)
+        manifest[kind] = {"url": "/static/dist/" + sizes["file"], "sources": sources}
+        original = sum(_local(url).stat().st_size for url in urls)
+        log(f"{sizes['file']}: {len(urls)} files, {original} -> {sizes['raw']} bytes"
+            f" (gzip {sizes['gzip']}" + (f", br {sizes['br']}" if "br" in sizes else "") + ")")
+    atomic_write_bytes(MANIFEST_PATH, json.dumps(manifest, indent=2).encode("utf-8"), fsync=False)
+    # old bundles go only now: until the new manifest is in place, the server may still
+    # be pointing pages at them
+    for old in DIST_DIR.iterdir():
+        if old.is_file() and old.name not in written:
+            old.unlink()
+    return manifest
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    try:
+        build()
+    except (OSError, ValueError) as exc:
+        print(f"asset build failed: {exc}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,313 @@
+from contextlib import asynccontextmanager, contextmanager
+from fnmatch import fnmatchcase
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import asyncio
+import itertools
+import time
+
+from fastapi import APIRouter, HTTPException
+import httpx
+
+from .preferences import config_section
+from .upstream import get_client, request_timeout, stream_timeout
+
+LM_URL = "http://127.0.0.1:1234/v1/chat/completions"
+
+# defaults, overridable via the "backends" section of config.json, e.g.
+#   "backends": {"servers": [
+#     {"url": "http://gpu-a:1234/v1/chat/completions"},
+#     {"url": "http://gpu-b:8080/v1/chat/completions", "models": ["qwen*"], "weight": 2}
+#   ]}
+BACKEND_DEFAULTS: Dict[str, Any] = {
+    # url: chat completions endpoint; models: glob patterns of served model ids;
+    # weight: relative capacity used for least-outstanding balancing
+    "servers": [{"url": LM_URL}],
+    # seconds between health probes (GET <base>/models); 0 disables probing
+    "health_interval": 15.0,
+    # consecutive failures that open the circuit, and how long it stays open
+    "failure_threshold": 3,
+    "cooldown": 30.0,
+    # extra attempts on other backends when connecting fails before any output
+    "retries": 2,
+}
+
+# failures worth retrying elsewhere: the request never reached the model (connect phase),
+# or a proxy/server refused it up front. Anything later (a dropped connection, a read
+# timeout, 504) may mean the model already ran it, so it is not sent a second time.
+RETRYABLE_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+RETRYABLE_STATUS = {502, 503}
+
+router = APIRouter()
+
+
+class Backend:
+    """One inference server plus its load and circuit-breaker state."""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.models: List[str] = ["*"]
+        self.weight = 1.0
+        self.outstanding = 0
+        self.failures = 0
+        self.open_until = 0.0
+        self.healthy = True
+        self.trial = False
+
+    def serves(self, model: Optional[str]) -> bool:
+        return not model or any(fnmatchcase(model, pattern) for pattern in self.models)
+
+    def available(self, now: float) -> bool:
+        if not self.healthy:
+            return False
+        if self.open_until > now:
+            return False
+        # half-open: once the cooldown ends, let a single trial request through
+        return not (self.open_until and self.trial)
+
+    def load(self) -> float:
+        return self.outstanding / self.weight
+
+    def models_url(self) -> str:
+        base = self.url
+        for suffix in ("/chat/completions", "/completions"):
+            if base.endswith(suffix):
+                base = base[: -len(suffix)]
+                break
+        return base.rstrip("/") + "/models"
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.open_until = 0.0
+        self.trial = False
+        self.healthy = True
+
+    def record_failure(self, cfg: Dict[str, Any]) -> None:
+        self.failures += 1
+        self.trial = False
+        if self.failures >= int(cfg["failure_threshold"]) or self.open_until:
+            self.open_until = time.monotonic() + float(cfg["cooldown"])
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "url": self.url,
+            "models": self.models,
+            "weight": self.weight,
+            "outstanding": self.outstanding,
+            "healthy": self.healthy,
+            "failures": self.failures,
+            "circuit": "open" if self.open_until > time.monotonic() else ("half-open" if self.open_until else "closed"),
+        }
+
+
+_backends: Dict[str, Backend] = {}
+_rotation = itertools.count()
+_health_task: Optional[asyncio.Task] = None
+
+
+def backend_settings() -> Dict[str, Any]:
+    return config_section("backends", BACKEND_DEFAULTS)
+
+
+def _sync_backends(cfg: Dict[str, Any]) -> List[Backend]:
+    """Backends from the config, keeping runtime state for servers that stayed listed."""
+    listed: List[Backend] = []
+    for server in cfg.get("servers") or []:
+        if isinstance(server, str):
+            server = {"url": server}
+        if not isinstance(server, dict) or not server.get("url"):
+            continue
+        backend = _backends.get(server["url"]) or Backend(server["url"])
+        models = server.get("models")
+        backend.models = [str(m) for m in models] if isinstance(models, list) and models else ["*"]
+        backend.weight = max(0.1, float(server.get("weight") or 1))
+        listed.append(backend)
+    if not listed:
+        listed = [_backends.get(LM_URL) or Backend(LM_URL)]
+    _backends.clear()
+    _backends.update((b.url, b) for b in listed)
+    return listed
+
+
+def backend_capacity() -> int:
+    """Number of backends currently able to take requests (at least 1)."""
+    now = time.monotonic()
+    return max(1, sum(1 for b in _sync_backends(backend_settings()) if b.available(now)))
+
+
+def pick_backend(model: Optional[str], exclude: Optional[set] = None, cfg: Optional[Dict[str, Any]] = None) -> Backend:
+    """Least outstanding requests (per weight) among available backends serving the model."""
+    cfg = cfg or backend_settings()
+    backends = [b for b in _sync_backends(cfg) if b.url not in (exclude or ())]
+    candidates = [b for b in backends if b.serves(model)] or backends
+    now = time.monotonic()
+    ready = [b for b in candidates if b.available(now)]
+    if not ready:
+        # probes can lag behind a server that just came up; try anything not circuit-broken
+        ready = [b for b in candidates if b.open_until <= now]
+    if not ready:
+        raise HTTPException(status_code=503, detail="No inference backend is available")
+    lowest = min(b.load() for b in ready)
+    tied = [b for b in ready if b.load() == lowest]
+    backend = tied[next(_rotation) % len(tied)]
+    if backend.open_until:
+        backend.trial = True
+    return backend
+
+
+def _attempts(model: Optional[str]) -> Iterator[Tuple[Backend, bool]]:
+    """(backend, is_trial) to try in order: first pick, then up to `retries` others."""
+    cfg = backend_settings()
+    tried: set = set()
+    for _ in range(1 + max(0, int(cfg["retries"]))):
+        try:
+            backend = pick_backend(model, tried, cfg)
+        except HTTPException:
+            if tried:
+                return
+            raise
+        tried.add(backend.url)
+        # a pick while the circuit is still marked open is the half-open trial
+        yield backend, bool(backend.open_until)
+
+
+@contextmanager
+def _in_flight(backend: Backend, trial: bool) -> Iterator[None]:
+    """Count an attempt as outstanding; however it ends, a trial slot is given back.
+
+    Outcomes are recorded by the caller. Exits that record none (4xx, cancellation)
+    must not leave `trial` set, or the backend would never be picked again.
+    """
+    backend.outstanding += 1
+    try:
+        yield
+    finally:
+        backend.outstanding -= 1
+        if trial:
+            backend.trial = False
+
+
+async def post_completion(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Non-streaming completion on the best backend, failing over on connect errors."""
+    cfg = backend_settings()
+    client = get_client()
+    last_error: Optional[Exception] = None
+    for backend, trial in _attempts(payload.get("model")):
+        with _in_flight(backend, trial):
+            request = client.build_request("POST", backend.url, json=payload, timeout=request_timeout())
+            try:
+                # headers only: the status decides about a retry before any body is read
+                response = await client.send(request, stream=True)
+            except RETRYABLE_ERRORS as exc:
+                backend.record_failure(cfg)
+                last_error = exc
+                continue
+            except httpx.TransportError:
+                # the model may have been generating; not retried, but it counts against the backend
+                backend.record_failure(cfg)
+                raise
+            try:
+                if response.status_code in RETRYABLE_STATUS:
+                    backend.record_failure(cfg)
+                    last_error = httpx.HTTPStatusError("backend unavailable", request=request, response=response)
+                    continue
+                try:
+                    await response.aread()
+                except httpx.TransportError:
+                    backend.record_failure(cfg)
+                    raise
+            finally:
+                await response.aclose()
+            if response.status_code >= 500:
+                backend.record_failure(cfg)
+            elif response.is_success:
+                backend.record_success()
+            response.raise_for_status()
+            return response.json()
+    raise HTTPException(status_code=502, detail=f"All inference backends failed: {last_error}")
+
+
+@asynccontextmanager
+async def open_stream(payload: Dict[str, Any]):
+    """Open a streaming completion, failing over until a backend answers with 200.
+
+    Once the response is handed to the caller tokens may have been sent to the
+    client, so later errors are not retried.
+    """
+    cfg = backend_settings()
+    client = get_client()
+    last_error: Optional[Exception] = None
+    for backend, trial in _attempts(payload.get("model")):
+        with _in_flight(backend, trial):
+            request = client.build_request("POST", backend.url, json=payload, timeout=stream_timeout())
+            try:
+                response = await client.send(request, stream=True)
+            except RETRYABLE_ERRORS as exc:
+                backend.record_failure(cfg)
+                last_error = exc
+                continue
+            except httpx.TransportError:
+                backend.record_failure(cfg)
+                raise
+            try:
+                if response.status_code in RETRYABLE_STATUS:
+                    backend.record_failure(cfg)
+                    last_error = httpx.HTTPStatusError("backend unavailable", request=request, response=response)
+                    continue
+                if response.status_code >= 500:
+                    backend.record_failure(cfg)
+                elif response.is_success:
+                    backend.record_success()
+                try:
+                    yield response
+                except httpx.TransportError:
+                    # stalled or dropped mid-stream
+                    backend.record_failure(cfg)
+                    raise
+                return
+            finally:
+                await response.aclose()
+    raise HTTPException(status_code=502, detail=f"All inference backends failed: {last_error}")
+
+
+async def _probe(backend: Backend) -> None:
+    try:
+        response = await get_client().get(backend.models_url(), timeout=5.0)
+        backend.healthy = response.status_code < 500
+    except httpx.HTTPError:
+        backend.healthy = False
+
+
+async def _health_loop() -> None:
+    while True:
+        cfg = backend_settings()
+        interval = float(cfg["health_interval"])
+        if interval <= 0:
+            return
+        await asyncio.gather(*(_probe(b) for b in _sync_backends(cfg)))
+        await asyncio.sleep(interval)
+
+
+def start_health_checks() -> None:
+    global _health_task
+    if _health_task is None or _health_task.done():
+        _health_task = asyncio.get_running_loop().create_task(_health_loop())
+
+
+async def stop_health_checks() -> None:
+    global _health_task
+    if _health_task is not None:
+        _health_task.cancel()
+        try:
+            await _health_task
+        except (asyncio.CancelledError, Exception):
+            pass
+        _health_task = None
+
+
+def backend_status() -> List[Dict[str, Any]]:
+    return [b.snapshot() for b in _sync_backends(backend_settings())]
+
+
+@router.get("/upstream/backends")
+async def get_backend_status():
+    return backend_status()
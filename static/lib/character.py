@@ -2,18 +2,31 @@ from pathlib import Path
 from typing import Any, Dict, Optional, Callable, List
 import json
 import re
+import threading
 import time
 
 from fastapi import APIRouter, UploadFile, File, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-import secrets
-from PIL import Image, ImageDraw
+import asyncio
+import hashlib
+from PIL import Image, ImageChops, ImageDraw, ImageOps, features
+
+from .storage import atomic_write_bytes, atomic_write_json, path_lock
 
 router = APIRouter()
 
 CHAR_DIR = Path("static/userdata/characters")
 ICON_DIR = Path("static/userdata/character_icons")
+# avatar variants in px; the largest is also the "path" stored on characters
+ICON_SIZES = (64, 128, 256)
+ICON_MAX_BYTES = 20 * 1024 * 1024
+ICON_MAX_PIXELS = 64_000_000
+# Pillow releases the GIL while decoding/resampling; a small pool bounds memory
+# when several large photos arrive at once
+_icon_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="icon")
 
 
 class CharacterFile(BaseModel):
@@ -36,11 +49,125 @@ def _safe_id(raw: str) -> str:
     return re.sub(r"[^a-zA-Z0-9_-]+", "_", raw.strip()) or "character"
 
 
+# in-memory index of character files: path -> (stat signature, record) and id -> record
+REVALIDATE_INTERVAL = 2.0
+
+_index_lock = threading.RLock()
+_files: Dict[Path, tuple[tuple[int, int], Dict[str, Any]]] = {}
+_by_id: Dict[int, Dict[str, Any]] = {}
+_versions: Dict[int, Optional[tuple[int, int]]] = {}
+_generation = 0
+_dir_mtime: Optional[int] = None
+_checked_at = 0.0
+_loaded = False
+
+
+def _stat_signature(path: Path) -> Optional[tuple[int, int]]:
+    try:
+        st = path.stat()
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+def _dir_signature() -> Optional[int]:
+    try:
+        return CHAR_DIR.stat().st_mtime_ns
+    except OSError:
+        return None
+
+
+def _read_character(path: Path) -> Optional[Dict[str, Any]]:
+    try:
+        data = json.loads(path.read_text(encoding="utf-8"))
+    except Exception:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def _record_id(data: Dict[str, Any]) -> Optional[int]:
+    try:
+        return int(data.get("id", -1))
+    except (TypeError, ValueError):
+        return None
+
+
+def _rebuild_by_id() -> None:
+    global _generation
+    _generation += 1
+    _by_id.clear()
+    _versions.clear()
+    for sig, record in _files.values():
+        char_id = _record_id(record)
+        if char_id is not None:
+            _by_id[char_id] = record
+            _versions[char_id] = sig
+
+
+def _revalidate(force: bool = False) -> None:
+    """Sync the index with disk, reparsing only files whose mtime/size changed."""
+    global _dir_mtime, _checked_at, _loaded
+    with _index_lock:
+        now = time.monotonic()
+        dir_mtime = _dir_signature()
+        if (
+            not force
+            and _loaded
+            and dir_mtime == _dir_mtime
+            and now - _checked_at < REVALIDATE_INTERVAL
+        ):
+            return
+        seen = set()
+        changed = False
+        for path in _list_character_files():
+            seen.add(path)
+            sig = _stat_signature(path)
+            cached = _files.get(path)
+            if cached and cached[0] == sig:
+                continue
+            data = _read_character(path)
+            if data is None:
+                if _files.pop(path, None) is not None:
+                    changed = True
+                continue
+            _files[path] = (sig, data)
+            changed = True
+        for path in list(_files):
+            if path not in seen:
+                del _files[path]
+                changed = True
+        if changed or not _loaded:
+            _rebuild_by_id()
+        _dir_mtime = dir_mtime
+        _checked_at = now
+        _loaded = True
+
+
+def _index_put(path: Path, data: Dict[str, Any]) -> None:
+    global _dir_mtime
+    with _index_lock:
+        _revalidate()
+        _files[path] = (_stat_signature(path), data)
+        _rebuild_by_id()
+        _dir_mtime = _dir_signature()
+
+
+def _index_drop(path: Path) -> None:
+    global _dir_mtime
+    with _index_lock:
+        _revalidate()
+        if _files.pop(path, None) is not None:
+            _rebuild_by_id()
+        _dir_mtime = _dir_signature()
+
+
 def delete_character_file(char_id: str) -> bool:
     target = CHAR_DIR / f"{_safe_id(str(char_id))}.json"
-    if target.exists():
-        target.unlink()
-        return True
+    with path_lock(target):
+        if target.exists():
+            target.unlink()
+            _index_drop(target)
+            return True
     return False
 
 def _list_character_files() -> List[Path]:
@@ -49,30 +176,42 @@ def _list_character_files() -> List[Path]:
     return [p for p in CHAR_DIR.glob("*.json") if p.is_file()]
 
 def fetch_character_file(char_id: int) -> Optional[Dict[str, Any]]:
-    for path in _list_character_files():
-        try:
-            data = json.loads(path.read_text(encoding="utf-8"))
-            if int(data.get("id", -1)) == int(char_id):
-                return data
-        except Exception:
-            continue
-    return None
+    _revalidate()
+    try:
+        record = _by_id.get(int(char_id))
+    except (TypeError, ValueError):
+        return None
+    # callers may tweak the result (e.g. chat overrides "mode"), so hand out a copy
+    return dict(record) if record is not None else None
 
 
 def fetch_character(char_id: int, db_provider: Optional[Callable[[], Any]] = None) -> Optional[Dict[str, Any]]:
     return fetch_character_file(char_id)
 
 
+def character_version(char_id: int) -> Optional[tuple[int, int]]:
+    """File signature of the indexed record; changes whenever the character is saved."""
+    try:
+        return _versions.get(int(char_id))
+    except (TypeError, ValueError):
+        return None
+
+
+def characters_version() -> int:
+    """Grows whenever any character file is added, changed or removed."""
+    _revalidate()
+    return _generation
+
+
+async def fetch_character_async(char_id: int) -> Optional[Dict[str, Any]]:
+    """fetch_character for async routes; index revalidation may hit the disk."""
+    return await run_in_threadpool(fetch_character_file, char_id)
+
+
 def list_characters(db_provider: Optional[Callable[[], Any]] = None) -> list[Dict[str, Any]]:
-    items: List[Dict[str, Any]] = []
-    for path in _list_character_files():
-        try:
-            data = json.loads(path.read_text(encoding="utf-8"))
-            if isinstance(data, dict):
-                items.append(data)
-        except Exception:
-            continue
-    return items
+    _revalidate()
+    with _index_lock:
+        return [dict(record) for _, record in _files.values()]
 
 
 @router.post("/characters/file", response_model=CharacterFile)
@@ -83,7 +222,9 @@ def save_character_file(payload: CharacterFile):
     CHAR_DIR.mkdir(parents=True, exist_ok=True)
     target = CHAR_DIR / f"{_safe_id(str(payload.id))}.json"
     data = payload.model_dump()
-    target.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+    with path_lock(target):
+        atomic_write_json(target, data)
+        _index_put(target, data)
     return payload
 
 
@@ -93,40 +234,78 @@ def remove_character_file(char_id: str):
     return {"deleted": deleted}
 
 
-@router.post("/characters/file/upload_icon")
-async def upload_icon(file: UploadFile = File(...)):
-    if not file.filename:
-        raise HTTPException(status_code=400, detail="No file provided")
-    ICON_DIR.mkdir(parents=True, exist_ok=True)
-    # always store as PNG and round-mask the avatar
-    safe_stem = re.sub(r"[^a-zA-Z0-9_-]+", "_", Path(file.filename).stem) or "icon"
-    unique_suffix = secrets.token_hex(4)
-    filename = f"{safe_stem}_{unique_suffix}.png"
-    target = ICON_DIR / filename
-    content = await file.read()
+def _icon_url(name: str) -> str:
+    return f"/static/userdata/character_icons/{name}"
+
+
+def _icon_mask(size: int) -> Image.Image:
+    """Anti-aliased circle: drawn at 4x and scaled down."""
+    big = Image.new("L", (size * 4, size * 4), 0)
+    ImageDraw.Draw(big).ellipse((0, 0, size * 4 - 1, size * 4 - 1), fill=255)
+    return big.resize((size, size), Image.LANCZOS)
+
 
+def _icon_formats() -> List[str]:
+    return ["png", "webp"] if features.check("webp") else ["png"]
+
+
+def process_icon(content: bytes) -> Dict[str, Dict[str, str]]:
+    """Round-masked avatar variants for an upload, named by its content hash.
+
+    Returns {size: {format: url}}. Blocking; run in the icon worker pool.
+    """
+    digest = hashlib.sha256(content).hexdigest()[:16]
+    formats = _icon_formats()
+    names = {size: {fmt: f"{digest}_{size}.{fmt}" for fmt in formats} for size in ICON_SIZES}
+    variants = {str(size): {fmt: _icon_url(name) for fmt, name in by_fmt.items()} for size, by_fmt in names.items()}
+    if all((ICON_DIR / name).exists() for by_fmt in names.values() for name in by_fmt.values()):
+        # same upload as before: the files are immutable, reuse them
+        return variants
+
+    largest = max(ICON_SIZES)
     try:
-        image = Image.open(BytesIO(content)).convert("RGBA")
-    except Exception:
+        image = Image.open(BytesIO(content))
+        if image.width * image.height > ICON_MAX_PIXELS:
+            raise HTTPException(status_code=413, detail="Image dimensions too large")
+        # JPEG can decode at 1/2..1/8 scale; keeps at least `largest` px on each side
+        image.draft("RGB", (largest, largest))
+        image = ImageOps.exif_transpose(image).convert("RGBA")
+    except HTTPException:
+        raise
+    except (OSError, ValueError, Image.DecompressionBombError):
         raise HTTPException(status_code=400, detail="Unsupported image file")
 
-    size = min(image.width, image.height)
     # center-crop to square
-    left = (image.width - size) // 2
-    top = (image.height - size) // 2
-    right = left + size
-    bottom = top + size
-    square = image.crop((left, top, right, bottom))
-
-    # apply circular mask
-    mask = Image.new("L", (size, size), 0)
-    draw = ImageDraw.Draw(mask)
-    draw.ellipse((0, 0, size, size), fill=255)
-    square.putalpha(mask)
-
-    buffer = BytesIO()
-    square.save(buffer, format="PNG")
-    target.write_bytes(buffer.getvalue())
-
-    rel_path = f"/static/userdata/character_icons/{filename}"
-    return {"path": rel_path}
+    side = min(image.width, image.height)
+    left = (image.width - side) // 2
+    top = (image.height - side) // 2
+    square = image.crop((left, top, left + side, top + side))
+    master = square.resize((largest, largest), Image.LANCZOS, reducing_gap=3.0)
+
+    for size, by_fmt in names.items():
+        icon = master if size == largest else master.resize((size, size), Image.LANCZOS)
+        icon = icon.copy()
+        # apply circular mask, keeping any transparency the upload already had
+        icon.putalpha(ImageChops.multiply(icon.getchannel("A"), _icon_mask(size)))
+        for fmt, name in by_fmt.items():
+            buffer = BytesIO()
+            if fmt == "webp":
+                icon.save(buffer, format="WEBP", quality=85, method=4)
+            else:
+                icon.save(buffer, format="PNG", optimize=True)
+            atomic_write_bytes(ICON_DIR / name, buffer.getvalue())
+    return variants
+
+
+@router.post("/characters/file/upload_icon")
+async def upload_icon(file: UploadFile = File(...)):
+    if not file.filename:
+        raise HTTPException(status_code=400, detail="No file provided")
+    content = await file.read(ICON_MAX_BYTES + 1)
+    if len(content) > ICON_MAX_BYTES:
+        raise HTTPException(status_code=413, detail="Image file too large")
+    ICON_DIR.mkdir(parents=True, exist_ok=True)
+    loop = asyncio.get_running_loop()
+    variants = await loop.run_in_executor(_icon_pool, process_icon, content)
+    # `path` stays the largest PNG so stored characters keep working everywhere
+    return {"path": variants[str(max(ICON_SIZES))]["png"], "variants": variants}
@@ -1,14 +1,17 @@
-from fastapi import APIRouter
-from fastapi.responses import StreamingResponse
+from contextlib import aclosing
+
+from fastapi import APIRouter, HTTPException, Request
 from pydantic import BaseModel
-import httpx
+import anyio
 import json
 
-LM_URL = "http://127.0.0.1:1234/v1/chat/completions"
 DEFAULT_MODEL = "dolphin3.0-llama3.1-8b"
-from .character import fetch_character
-from .archive import save_chat_archive
-from .world_info import list_enabled_world_entries
+from .archive import load_chat_history_async, save_chat_archive_async
+from .backends import open_stream, post_completion
+from .prompt import assemble_chat_messages, backend_cache_hints, history_messages as conversation_turns
+from .scheduler import PRIORITY_CHAT, client_key, enqueue, upstream_slot
+from .sse import CompactFramer, resolve_format, scan_chunk
+from .upstream import ClosingStreamingResponse, DisconnectWatch
 
 router = APIRouter()
 
@@ -18,6 +21,11 @@ class ChatMessage(BaseModel):
     content: str
 
 
+class ChatEdit(BaseModel):
+    index: int
+    content: str
+
+
 class ChatRequest(BaseModel):
     prompt: str
     model: str | None = None
@@ -26,78 +34,51 @@ class ChatRequest(BaseModel):
     language: str | None = None
     history: list[ChatMessage] | None = None
     archive_id: str | None = None
+    # incremental mode: instead of `history`, reuse the first `keep` turns stored for
+    # archive_id (fewer than stored = regenerate/truncate), with optional edits. Turns are
+    # counted like prompt.history_messages: non-empty user/assistant messages only.
+    keep: int | None = None
+    edits: list[ChatEdit] | None = None
+    # "raw" or "compact" (see sse.py); defaults to the "stream" config section
+    stream_format: str | None = None
 
 
 class ChatResponse(BaseModel):
     reply: str
     archive_id: str | None = None
-
-
-def build_system_prompt(character: dict | None) -> str | None:
-    if not character:
-        return None
-    mode = (character.get("mode") or "chat").lower()
-    name = character.get("name") or "Assistant"
-    greeting = character.get("greeting") or ""
-    persona = character.get("personality") or ""
-    gender = character.get("gender") or ""
-
-    if mode == "roleplay":
-        return (
-            "You are roleplaying as {name}. Stay fully in character using their voice, goals, and mannerisms.\n"
-            "Greeting: {greeting}\n"
-            "Persona: {persona}\n"
-            "Gender: {gender}\n"
-            "Keep replies as immersive dialogue with light action cues, using present tense and emotion-rich tone. "
-            "Use *italics* for actions and stage directions, and **bold** for strongly voiced text; do not escape or alter these markers. "
-            "Do not break character or explain that you are an assistant."
-        ).format(name=name, greeting=greeting, persona=persona, gender=gender)
-    elif mode == "chat":
-        return (
-            "You are {name}, a helpful conversational assistant.\n"
-            "Greeting: {greeting}\n"
-            "Persona: {persona}\n"
-            "Gender: {gender}\n"
-            "Respond clearly and concisely, stay on topic, and adapt tone to match the persona. "
-            "If the user provides a goal, focus on accomplishing it with numbered steps when useful. "
-            "Do not roleplay; be direct and practical."
-        ).format(name=name, greeting=greeting, persona=persona, gender=gender)
+    prompt_tokens: int | None = None
+    dropped_messages: int | None = None
+
+
+async def request_history(request: ChatRequest) -> list | None:
+    """The conversation before the new turn: sent by the client, or rebuilt from the archive.
+
+    409 tells the client the server-side state is missing or shorter than it expects,
+    so it should resend the full history.
+    """
+    if request.history is not None or request.keep is None:
+        return request.history
+    if not request.archive_id:
+        raise HTTPException(status_code=400, detail="keep requires archive_id")
+    stored = await load_chat_history_async(request.archive_id)
+    if stored is not None:
+        # the archive also holds empty replies (e.g. a cancelled stream); clients skip them
+        stored = conversation_turns(stored)
+    if stored is None or not 0 <= request.keep <= len(stored):
+        raise HTTPException(status_code=409, detail="Conversation state unavailable; send the full history")
+    turns = stored[: request.keep]
+    for edit in request.edits or []:
+        if not 0 <= edit.index < len(turns):
+            raise HTTPException(status_code=400, detail=f"Edit index out of range: {edit.index}")
+        turns[edit.index]["content"] = edit.content
+    return turns
 
 
 @router.post("/chat", response_model=ChatResponse)
-async def chat(request: ChatRequest):
-    character = fetch_character(request.character_id or 1) or {}
-    if request.mode:
-        character["mode"] = request.mode
-    entry_type = "roleplay" if (character.get("mode") == "roleplay") else "chat"
-    world_entries = list_enabled_world_entries()
-    world_context = ""
-    if world_entries:
-        joined = "\n\n".join(
-            f"- {item.get('name')}: {item.get('description') or ''}" for item in world_entries
-        )
-        world_context = "World context:\n" + joined
-    system_prompt = build_system_prompt(character)
-
-    # include recent history before the new user turn
-    history_messages = []
-    if request.history:
-        for msg in request.history:
-            role = msg.role if msg.role in ("user", "assistant") else None
-            if not role or not msg.content:
-                continue
-            history_messages.append({"role": role, "content": msg.content})
-
-    messages = []
-    if system_prompt:
-        messages.append({"role": "system", "content": system_prompt})
-    messages.append(
-        {"role": "system", "content": "Respond in the same language the user used."}
+async def chat(request: ChatRequest, http_request: Request):
+    messages, history_messages, entry_type, token_stats = await assemble_chat_messages(
+        request.character_id, request.mode, await request_history(request), request.prompt
     )
-    if world_context:
-        messages.append({"role": "system", "content": world_context})
-    messages.extend(history_messages)
-    messages.append({"role": "user", "content": request.prompt})
 
     payload = {
         "model": request.model or DEFAULT_MODEL,
@@ -105,12 +86,11 @@ async def chat(request: ChatRequest):
         "temperature": 0.7,
         "max_tokens": 513,
         "stream": False,
+        **backend_cache_hints(request.archive_id),
     }
 
-    async with httpx.AsyncClient(timeout=60.0) as client:
-        response = await client.post(LM_URL, json=payload)
-        response.raise_for_status()
-        data = response.json()
+    async with upstream_slot(client_key(http_request), PRIORITY_CHAT):
+        data = await post_completion(payload)
 
     reply_text = data["choices"][0]["message"]["content"]
 
@@ -119,7 +99,7 @@ async def chat(request: ChatRequest):
         {"role": "user", "content": request.prompt},
         {"role": "assistant", "content": reply_text},
     ]
-    archive_id = save_chat_archive(
+    archive_id = await save_chat_archive_async(
         request.archive_id,
         full_history,
         request.model or DEFAULT_MODEL,
@@ -127,43 +107,19 @@ async def chat(request: ChatRequest):
         entry_type,
     )
 
-    return ChatResponse(reply=reply_text, archive_id=archive_id)
+    return ChatResponse(
+        reply=reply_text,
+        archive_id=archive_id,
+        prompt_tokens=token_stats["prompt_tokens"],
+        dropped_messages=token_stats["dropped_messages"],
+    )
 
 
 @router.post("/chat/stream")
-async def chat_stream(request: ChatRequest):
-    character = fetch_character(request.character_id or 1) or {}
-    if request.mode:
-        character["mode"] = request.mode
-    entry_type = "roleplay" if (character.get("mode") == "roleplay") else "chat"
-    world_entries = list_enabled_world_entries()
-    world_context = ""
-    if world_entries:
-        joined = "\n\n".join(
-            f"- {item.get('name')}: {item.get('description') or ''}" for item in world_entries
-        )
-        world_context = "World context:\n" + joined
-    system_prompt = build_system_prompt(character)
-
-    # include recent history before the new user turn
-    history_messages = []
-    if request.history:
-        for msg in request.history:
-            role = msg.role if msg.role in ("user", "assistant") else None
-            if not role or not msg.content:
-                continue
-            history_messages.append({"role": role, "content": msg.content})
-
-    messages = []
-    if system_prompt:
-        messages.append({"role": "system", "content": system_prompt})
-    messages.append(
-        {"role": "system", "content": "Respond in the same language the user used."}
+async def chat_stream(request: ChatRequest, http_request: Request):
+    messages, history_messages, entry_type, token_stats = await assemble_chat_messages(
+        request.character_id, request.mode, await request_history(request), request.prompt
     )
-    if world_context:
-        messages.append({"role": "system", "content": world_context})
-    messages.extend(history_messages)
-    messages.append({"role": "user", "content": request.prompt})
 
     payload = {
         "model": request.model or DEFAULT_MODEL,
@@ -171,13 +127,29 @@ async def chat_stream(request: ChatRequest):
         "temperature": 0.7,
         "max_tokens": 513,
         "stream": True,
+        **backend_cache_hints(request.archive_id),
     }
+    framer = CompactFramer() if resolve_format(request.stream_format) == "compact" else None
+    if framer:
+        # ask for token usage in the final chunk so it can go into the done line
+        payload["stream_options"] = {"include_usage": True}
+
+    requester = client_key(http_request)
+    watch = DisconnectWatch(http_request)
 
     async def event_generator():
-        assistant_buffer = ""
-        async with httpx.AsyncClient(timeout=None) as client:
-            async with client.stream("POST", LM_URL, json=payload) as response:
-                async for line in response.aiter_lines():
+        parts: list[str] = []
+        completed = False
+        ticket = enqueue(requester, PRIORITY_CHAT)
+        try:
+            async for position in ticket.wait_with_updates():
+                if await watch.gone():
+                    return
+                yield json.dumps({"queue": {"position": position}}) + "\n"
+            # ends early when the client goes away; leaving the block then closes the
+            # upstream stream, so generation stops
+            async with open_stream(payload) as response, aclosing(watch.lines(response)) as lines:
+                async for line in lines:
                     if not line:
                         continue
 
@@ -186,27 +158,42 @@ async def chat_stream(request: ChatRequest):
                         chunk = line[6:].strip()
                         if chunk == "[DONE]":
                             break
-                        try:
-                            data = json.loads(chunk)
-                            delta = data.get("choices", [{}])[0].get("delta", {}).get("content")
-                            if delta:
-                                assistant_buffer += delta
-                        except Exception:
-                            pass
-                        # send raw JSON chunk to frontend
-                        yield chunk + "\n"
-
-        # after stream finishes, save archive entry
-        full_history = history_messages + [
-            {"role": "user", "content": request.prompt},
-            {"role": "assistant", "content": assistant_buffer},
-        ]
-        save_chat_archive(
-            request.archive_id,
-            full_history,
-            request.model or DEFAULT_MODEL,
-            request.character_id,
-            entry_type,
-        )
-
-    return StreamingResponse(event_generator(), media_type="text/event-stream")
+                        data, delta = scan_chunk(chunk)
+                        if delta:
+                            parts.append(delta)
+                        if framer is None:
+                            # send raw JSON chunk to frontend
+                            yield chunk + "\n"
+                        else:
+                            frame = framer.feed(data, delta)
+                            if frame:
+                                yield frame
+            completed = not watch.disconnected
+            if completed and framer is not None:
+                yield framer.close()
+        finally:
+            ticket.release()
+            # also runs when the client vanished mid-stream: keep what was generated
+            assistant_buffer = "".join(parts)
+            if completed or assistant_buffer:
+                assistant = {"role": "assistant", "content": assistant_buffer}
+                if not completed:
+                    assistant["truncated"] = True
+                full_history = history_messages + [
+                    {"role": "user", "content": request.prompt},
+                    assistant,
+                ]
+                with anyio.CancelScope(shield=True):
+                    await save_chat_archive_async(
+                        request.archive_id,
+                        full_history,
+                        request.model or DEFAULT_MODEL,
+                        request.character_id,
+                        entry_type,
+                    )
+
+    headers = {
+        "X-Prompt-Tokens": str(token_stats["prompt_tokens"]),
+        "X-Dropped-Messages": str(token_stats["dropped_messages"]),
+    }
+    return ClosingStreamingResponse(event_generator(), media_type="text/event-stream", headers=headers)
@@ -0,0 +1,89 @@
+from pathlib import Path
+from typing import Any, Dict, List
+import json
+import os
+
+# Chat archives are stored as a header file (<id>.json, metadata plus the messages
+# as of the last compaction) and an append-only turn log (<id>.jsonl). Each log
+# line is one record:
+#   {"keep": n, "messages": [...], "meta": {...}}
+# meaning: cut the message list to its first n items, append "messages", then
+# overlay "meta" (preview, updated_at, model, ...) onto the header fields.
+LOG_SUFFIX = ".jsonl"
+
+
+def log_path_for(entry_path: Path) -> Path:
+    return entry_path.with_suffix(LOG_SUFFIX)
+
+
+def make_record(keep: int, messages: List[dict], meta: Dict[str, Any]) -> Dict[str, Any]:
+    return {"keep": keep, "messages": messages, "meta": meta}
+
+
+def _last_line_end(fh, end: int) -> int:
+    """Offset just past the last newline before `end` (0 if there is none)."""
+    pos = end
+    while pos > 0:
+        start = max(0, pos - 4096)
+        fh.seek(start)
+        chunk = fh.read(pos - start)
+        cut = chunk.rfind(b"\n")
+        if cut >= 0:
+            return start + cut + 1
+        pos = start
+    return 0
+
+
+def append_records(path: Path, records: List[Dict[str, Any]], fsync: bool = True) -> int:
+    """Append records to the log and return the number of bytes written."""
+    payload = "".join(json.dumps(rec, ensure_ascii=False) + "\n" for rec in records)
+    encoded = payload.encode("utf-8")
+    with path.open("r+b" if path.exists() else "w+b") as fh:
+        end = fh.seek(0, os.SEEK_END)
+        if end > 0:
+            fh.seek(-1, os.SEEK_END)
+            if fh.read(1) != b"\n":
+                # drop a torn line left by an interrupted append; replay stops at it
+                fh.truncate(_last_line_end(fh, end))
+                fh.seek(0, os.SEEK_END)
+        fh.write(encoded)
+        if fsync:
+            fh.flush()
+            os.fsync(fh.fileno())
+    return len(encoded)
+
+
+def read_records(path: Path) -> List[Dict[str, Any]]:
+    if not path.exists():
+        return []
+    records: List[Dict[str, Any]] = []
+    with path.open("r", encoding="utf-8") as fh:
+        for line in fh:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                # a torn line from an interrupted append; records after it would replay
+                # onto a message list they were not written against, so stop here
+                break
+            if not isinstance(rec, dict):
+                break
+            records.append(rec)
+    return records
+
+
+def replay(data: Dict[str, Any], records: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Apply log records on top of a header dict, in place."""
+    messages = list(data.get("messages") or [])
+    for rec in records:
+        keep = rec.get("keep")
+        if isinstance(keep, int) and 0 <= keep < len(messages):
+            del messages[keep:]
+        messages.extend(m for m in rec.get("messages") or [] if isinstance(m, dict))
+        meta = rec.get("meta")
+        if isinstance(meta, dict):
+            data.update(meta)
+    data["messages"] = messages
+    return data
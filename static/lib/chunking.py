@@ -0,0 +1,72 @@
+from typing import Callable, List
+import re
+import zlib
+
+_PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+_SENTENCE_END = re.compile(r"(?<=[.!?…])\s+")
+
+# a chunk may end early after a paragraph whose hash hits this modulus once it is
+# at least half full; boundaries then depend on content, not on everything before
+# them, so editing one chapter only changes the chunks around it
+BOUNDARY_MODULUS = 4
+
+
+def _pieces(text: str, max_tokens: int, count: Callable[[str], int]) -> List[str]:
+    """Paragraphs, with paragraphs longer than max_tokens split on sentence ends."""
+    out: List[str] = []
+    for para in _PARAGRAPH_BREAK.split(text):
+        para = para.strip()
+        if not para:
+            continue
+        if count(para) <= max_tokens:
+            out.append(para)
+            continue
+        current: List[str] = []
+        size = 0
+        for sentence in _SENTENCE_END.split(para):
+            cost = count(sentence)
+            if current and size + cost > max_tokens:
+                out.append(" ".join(current))
+                current, size = [], 0
+            current.append(sentence)
+            size += cost
+        if current:
+            out.append(" ".join(current))
+    return out
+
+
+def split_chunks(text: str, max_tokens: int, count: Callable[[str], int]) -> List[str]:
+    """Split text into chunks of at most ~max_tokens on paragraph boundaries."""
+    max_tokens = max(1, max_tokens)
+    min_tokens = max_tokens // 2
+    chunks: List[str] = []
+    current: List[str] = []
+    size = 0
+    for piece in _pieces(text, max_tokens, count):
+        cost = count(piece)
+        if current and size + cost > max_tokens:
+            chunks.append("\n\n".join(current))
+            current, size = [], 0
+        current.append(piece)
+        size += cost
+        if size >= min_tokens and zlib.crc32(piece.encode("utf-8")) % BOUNDARY_MODULUS == 0:
+            chunks.append("\n\n".join(current))
+            current, size = [], 0
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+
+def clip_tokens(text: str, max_tokens: int, count: Callable[[str], int]) -> str:
+    """Longest prefix of text (cut on a word boundary if possible) that fits max_tokens."""
+    if count(text) <= max_tokens:
+        return text
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if count(text[:mid]) <= max_tokens:
+            lo = mid
+        else:
+            hi = mid - 1
+    cut = text.rfind(" ", 0, lo)
+    return text[: cut if cut > lo // 2 else lo].rstrip()
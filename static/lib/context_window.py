@@ -0,0 +1,121 @@
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import math
+import re
+
+from .preferences import config_section
+
+# defaults, overridable via the "context" section of config.json
+CONTEXT_DEFAULTS: Dict[str, Any] = {
+    "max_context_tokens": 8192,
+    # room left for the model's reply (matches the max_tokens sent upstream)
+    "reserve_tokens": 513,
+    # "heuristic" or "tiktoken" (only used when the package is installed)
+    "tokenizer": "heuristic",
+    # drop old history in multiples of this many messages, so the cut point (and with
+    # it the cached prompt prefix on the backend) only moves every few turns
+    "trim_step": 1,
+}
+
+# chat templates wrap every message in a few role/separator tokens
+MESSAGE_OVERHEAD = 4
+
+# inserted where history was dropped; fixed text, so the prompt prefix stays cacheable
+# while the cut point moves (the count goes out as stats["dropped_messages"])
+DROPPED_HISTORY_NOTE = "[Earlier messages of this conversation were omitted to fit the context window.]"
+
+_PIECE = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+
+Tokenizer = Callable[[str], int]
+_tiktoken: Optional[Tokenizer] = None
+_tiktoken_failed = False
+
+
+def heuristic_tokens(text: str) -> int:
+    """Closer to BPE counts than len/4: short words are one token, long words split
+    every ~4 chars (~2 for non-Latin scripts), punctuation counts separately."""
+    total = 0
+    for piece in _PIECE.findall(text):
+        size = len(piece)
+        if size <= 3:
+            total += 1
+        elif piece.isascii():
+            total += math.ceil(size / 4)
+        else:
+            total += math.ceil(size / 2)
+    return total
+
+
+def _tiktoken_tokenizer() -> Optional[Tokenizer]:
+    global _tiktoken, _tiktoken_failed
+    if _tiktoken is None and not _tiktoken_failed:
+        try:
+            import tiktoken
+
+            encoding = tiktoken.get_encoding("cl100k_base")
+            _tiktoken = lambda text: len(encoding.encode(text, disallowed_special=()))  # noqa: E731
+        except Exception:
+            _tiktoken_failed = True
+    return _tiktoken
+
+
+def context_settings() -> Dict[str, Any]:
+    return config_section("context", CONTEXT_DEFAULTS)
+
+
+def estimate_tokens(text: Optional[str], settings: Optional[Dict[str, Any]] = None) -> int:
+    if not text:
+        return 0
+    cfg = settings or CONTEXT_DEFAULTS
+    if cfg.get("tokenizer") == "tiktoken":
+        counter = _tiktoken_tokenizer()
+        if counter is not None:
+            return counter(text)
+    return heuristic_tokens(text)
+
+
+def message_tokens(message: Dict[str, Any], settings: Optional[Dict[str, Any]] = None) -> int:
+    return MESSAGE_OVERHEAD + estimate_tokens(message.get("content"), settings)
+
+
+def fit_to_budget(
+    system_messages: List[Dict[str, str]],
+    history: List[Dict[str, str]],
+    user_message: Dict[str, str],
+) -> Tuple[List[Dict[str, str]], Dict[str, int]]:
+    """Fit a prompt into the configured token budget.
+
+    System messages and the new user turn are always kept; history is added from
+    the most recent turn backwards until the budget runs out. Returns the message
+    list plus {"prompt_tokens", "dropped_messages", "budget"}.
+    """
+    cfg = context_settings()
+    budget = max(0, int(cfg["max_context_tokens"]) - int(cfg["reserve_tokens"]))
+    used = sum(message_tokens(m, cfg) for m in system_messages)
+    used += message_tokens(user_message, cfg)
+
+    kept: List[Dict[str, str]] = []
+    for msg in reversed(history):
+        cost = message_tokens(msg, cfg)
+        if used + cost > budget:
+            break
+        kept.append(msg)
+        used += cost
+    kept.reverse()
+    dropped = len(history) - len(kept)
+    step = max(1, int(cfg.get("trim_step") or 1))
+    while kept and dropped % step:
+        used -= message_tokens(kept.pop(0), cfg)
+        dropped += 1
+    # never open the visible history with an orphaned assistant reply
+    while kept and kept[0]["role"] == "assistant" and dropped:
+        used -= message_tokens(kept.pop(0), cfg)
+        dropped += 1
+
+    messages = list(system_messages)
+    if dropped:
+        note = {"role": "system", "content": DROPPED_HISTORY_NOTE}
+        messages.append(note)
+        used += message_tokens(note, cfg)
+    messages.extend(kept)
+    messages.append(user_message)
+    return messages, {"prompt_tokens": used, "dropped_messages": dropped, "budget": budget}
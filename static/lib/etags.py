@@ -0,0 +1,46 @@
+from typing import Any, Optional
+import re
+import secrets
+
+from fastapi import Request, Response
+
+# kept free of config imports so any module (preferences included) can use it
+
+# one entity-tag of an If-None-Match list (RFC 9110 8.8.3); opaque tags may contain commas
+ENTITY_TAG_RE = re.compile(r'\s*(?:W/)?("[^"]*")\s*(?:,|$)|\s*(\*)\s*$')
+
+REVALIDATE = "no-cache"
+
+# validators from in-process store versions must not survive a restart
+BOOT_ID = secrets.token_hex(4)
+
+
+def store_etag(name: str, version: Any) -> str:
+    """Weak validator for a response derived from an in-process store version."""
+    return f'W/"{name}-{BOOT_ID}-{version}"'
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Weak comparison of `etag` against an If-None-Match header value, "*" included."""
+    opaque = etag[2:] if etag.startswith("W/") else etag
+    pos = 0
+    while pos < len(if_none_match):
+        match = ENTITY_TAG_RE.match(if_none_match, pos)
+        if match is None:
+            return False
+        if match.group(2) or match.group(1) == opaque:
+            return True
+        pos = match.end()
+    return False
+
+
+def not_modified(request: Request, etag: str) -> Optional[Response]:
+    """A 304 for clients that already hold `etag`, otherwise None."""
+    if etag_matches(request.headers.get("if-none-match", ""), etag):
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": REVALIDATE})
+    return None
+
+
+def set_validator(response: Response, etag: str) -> None:
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = REVALIDATE
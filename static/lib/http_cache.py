@@ -0,0 +1,360 @@
+from pathlib import Path
+from mimetypes import guess_type
+from typing import Any, Dict, Optional, Tuple
+import hashlib
+import json
+import re
+import threading
+import time
+import zlib
+
+from fastapi import Response
+from fastapi.responses import FileResponse
+from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.staticfiles import NotModifiedResponse
+import anyio.to_thread
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from .etags import REVALIDATE
+from .preferences import config_section
+
+# defaults, overridable via the "http" section of config.json
+HTTP_DEFAULTS: Dict[str, Any] = {
+    "compress": True,
+    # smaller bodies are sent as-is; headers would eat most of the gain
+    "compress_min_bytes": 500,
+    # larger bodies are sent as-is rather than held in memory to be compressed
+    "compress_max_bytes": 8 * 1024 * 1024,
+    "gzip_level": 6,
+    # used only when the optional `brotli` package is installed
+    "brotli_quality": 5,
+    # serve the bundles from `python -m static.lib.asset_build` while they match the sources
+    "bundles": True,
+}
+
+INDEX_PATH = Path("index.html")
+DIST_MANIFEST_PATH = Path("static/dist/manifest.json")
+# assets whose URLs the frontend builds at runtime; their versions are embedded in the page
+RUNTIME_ASSET_DIRS = (Path("static/lang"), Path("static/inc"), Path("static/css/themes"))
+# icon uploads and build output are named by content hash
+CONTENT_HASHED_RE = re.compile(
+    r"^(userdata/character_icons/[0-9a-f]{16}_\d+\.(png|webp)|dist/\w+\.[0-9a-f]{12}\.\w+)$"
+)
+ASSET_ATTR_RE = re.compile(r'(src|href)="(/static/[^"?#]+)"')
+STYLESHEET_TAG_RE = re.compile(r'<link\s+rel="stylesheet"\s+href="(/static/[^"?#]+)"[^>]*>\s*')
+SCRIPT_TAG_RE = re.compile(r'<script\s+src="(/static/[^"?#]+)"></script>\s*')
+# precompressed siblings written by the asset build, in order of preference
+PRECOMPRESSED = ((".br", "br"), (".gz", "gzip"))
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE_INTERVAL = 2.0
+
+COMPRESSIBLE_TYPES = ("text/", "application/json", "application/javascript", "image/svg+xml")
+# compressing larger bodies inline would stall the event loop
+THREAD_COMPRESS_BYTES = 128 * 1024
+
+
+def http_settings() -> Dict[str, Any]:
+    return config_section("http", HTTP_DEFAULTS)
+
+
+# ---- fingerprinted static assets ----
+
+_asset_lock = threading.Lock()
+_asset_hashes: Dict[Path, Tuple[Tuple[int, int], str]] = {}
+
+
+def asset_version(path: Path) -> Optional[str]:
+    """Content fingerprint of a file, rehashed only when its mtime/size change."""
+    try:
+        st = path.stat()
+    except OSError:
+        return None
+    signature = (st.st_mtime_ns, st.st_size)
+    with _asset_lock:
+        cached = _asset_hashes.get(path)
+    if cached and cached[0] == signature:
+        return cached[1]
+    try:
+        digest = hashlib.sha256(path.read_bytes()).hexdigest()[:12]
+    except OSError:
+        return None
+    with _asset_lock:
+        _asset_hashes[path] = (signature, digest)
+    return digest
+
+
+def asset_url(url: str) -> str:
+    """A /static/... URL with its content fingerprint, or unchanged if the file is missing."""
+    version = asset_version(Path(url.lstrip("/")))
+    return f"{url}?v={version}" if version else url
+
+
+def runtime_asset_versions() -> Dict[str, str]:
+    versions = {}
+    for directory in RUNTIME_ASSET_DIRS:
+        if not directory.is_dir():
+            continue
+        for path in sorted(directory.iterdir()):
+            version = asset_version(path) if path.is_file() else None
+            if version:
+                versions["/" + path.as_posix()] = version
+    return versions
+
+
+class CachedStaticFiles(StaticFiles):
+    """StaticFiles with a cache policy: fingerprinted URLs are immutable, the rest revalidate.
+
+    A `?v=` that no longer matches the file (a page loaded before an edit) gets
+    the revalidating policy, so the stale URL is never pinned to new content.
+    """
+
+    def file_response(self, full_path, stat_result, scope, status_code: int = 200) -> Response:
+        response = self.precompressed_response(Path(full_path), scope, status_code)
+        if response is None:
+            response = super().file_response(full_path, stat_result, scope, status_code)
+        response.headers["Cache-Control"] = self.cache_policy(scope, Path(full_path))
+        return response
+
+    def precompressed_response(self, full_path: Path, scope, status_code: int) -> Optional[Response]:
+        """The .br/.gz sibling of a file, when one exists and the client accepts it."""
+        request_headers = Headers(scope=scope)
+        accepted = _accepted_encodings(request_headers.get("accept-encoding", ""))
+        for suffix, encoding in PRECOMPRESSED:
+            if encoding not in accepted:
+                continue
+            variant = full_path.with_name(full_path.name + suffix)
+            try:
+                variant_stat = variant.stat()
+            except OSError:
+                continue
+            response = FileResponse(
+                variant,
+                status_code=status_code,
+                stat_result=variant_stat,
+                media_type=guess_type(full_path.name)[0] or "application/octet-stream",
+                headers={"Content-Encoding": encoding, "Vary": "Accept-Encoding"},
+            )
+            if self.is_not_modified(response.headers, request_headers):
+                return NotModifiedResponse(response.headers)
+            return response
+        return None
+
+    def cache_policy(self, scope, full_path: Path) -> str:
+        if CONTENT_HASHED_RE.match(self.get_path(scope).replace("\\", "/")):
+            return IMMUTABLE
+        query = scope.get("query_string", b"").decode("latin-1")
+        requested = dict(part.partition("=")[::2] for part in query.split("&") if part).get("v")
+        if requested and requested == asset_version(full_path):
+            return IMMUTABLE
+        return REVALIDATE
+
+
+# ---- bundles from the offline asset build (asset_build.py) ----
+
+_manifest_lock = threading.Lock()
+_manifest_signature: Optional[Tuple[int, int]] = None
+_manifest: Dict[str, Any] = {}
+
+
+def current_bundles() -> Dict[str, Any]:
+    """Build manifest entries ({"css"/"js": {url, sources}}) whose sources are all unchanged."""
+    global _manifest_signature, _manifest
+    if not http_settings()["bundles"]:
+        return {}
+    try:
+        st = DIST_MANIFEST_PATH.stat()
+    except OSError:
+        return {}
+    with _manifest_lock:
+        if (st.st_mtime_ns, st.st_size) != _manifest_signature:
+            try:
+                data = json.loads(DIST_MANIFEST_PATH.read_text(encoding="utf-8"))
+            except (OSError, ValueError):
+                data = {}
+            _manifest = data if isinstance(data, dict) else {}
+            _manifest_signature = (st.st_mtime_ns, st.st_size)
+        manifest = _manifest
+    bundles = {}
+    for kind, bundle in manifest.items():
+        if not isinstance(bundle, dict) or not Path(str(bundle.get("url", "")).lstrip("/")).is_file():
+            continue
+        sources = bundle.get("sources") or {}
+        if all(asset_version(Path(url.lstrip("/"))) == version for url, version in sources.items()):
+            bundles[kind] = bundle
+    return bundles
+
+
+def _use_bundle(html: str, tag_re, bundle: Optional[Dict[str, Any]], tag: str) -> str:
+    """Replace the tags of bundled sources with one tag for the bundle, at the first one's place."""
+    if not bundle:
+        return html
+    sources = bundle.get("sources") or {}
+    placed = False
+
+    def replace(match):
+        nonlocal placed
+        if match.group(1) not in sources:
+            return match.group(0)
+        if placed:
+            return ""
+        placed = True
+        return tag.format(url=bundle["url"]) + "\n  "
+
+    return tag_re.sub(replace, html)
+
+
+# ---- index.html ----
+
+_index_lock = threading.Lock()
+_index_signature: Optional[Tuple[int, int]] = None
+_index_source = ""
+_index_html = ""
+_index_etag = ""
+_index_checked_at = 0.0
+
+
+def _render_index(source: str) -> str:
+    bundles = current_bundles()
+    html = _use_bundle(source, STYLESHEET_TAG_RE, bundles.get("css"), '<link rel="stylesheet" href="{url}" />')
+    html = _use_bundle(html, SCRIPT_TAG_RE, bundles.get("js"), '<script src="{url}"></script>')
+    html = ASSET_ATTR_RE.sub(
+        lambda m: m.group(0) if m.group(2).startswith("/static/dist/") else f'{m.group(1)}="{asset_url(m.group(2))}"',
+        html,
+    )
+    versions = json.dumps(runtime_asset_versions(), separators=(",", ":"))
+    return html.replace("</head>", f"  <script>window.ASSET_VERSIONS = {versions};</script>\n</head>", 1)
+
+
+def index_page() -> Tuple[str, str]:
+    """index.html with fingerprinted asset URLs, plus its ETag.
+
+    Held in memory; the page and the assets it references are re-checked at most
+    every REVALIDATE_INTERVAL seconds and re-rendered only when one changed.
+    """
+    global _index_signature, _index_source, _index_html, _index_etag, _index_checked_at
+    with _index_lock:
+        now = time.monotonic()
+        if _index_html and now - _index_checked_at < REVALIDATE_INTERVAL:
+            return _index_html, _index_etag
+        st = INDEX_PATH.stat()
+        signature = (st.st_mtime_ns, st.st_size)
+        if signature != _index_signature:
+            _index_source = INDEX_PATH.read_text(encoding="utf-8")
+            _index_signature = signature
+        html = _render_index(_index_source)
+        if html != _index_html:
+            _index_html = html
+            _index_etag = f'"{hashlib.sha256(html.encode("utf-8")).hexdigest()[:16]}"'
+        _index_checked_at = now
+        return _index_html, _index_etag
+
+
+# ---- compression ----
+
+def _accepted_encodings(header: str) -> set:
+    accepted = set()
+    for item in header.split(","):
+        name, _, params = item.partition(";")
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(name.strip().lower())
+    return accepted
+
+
+class CompressionMiddleware:
+    """gzip (or brotli, when installed) for complete responses.
+
+    Only bodies with a Content-Length of at most compress_max_bytes are buffered
+    and compressed; streamed chat/notebook output has none and passes through
+    token by token.
+    """
+
+    def __init__(self, app, settings: Optional[Dict[str, Any]] = None):
+        cfg = settings or http_settings()
+        self.app = app
+        self.enabled = bool(cfg["compress"])
+        self.min_bytes = int(cfg["compress_min_bytes"])
+        self.max_bytes = int(cfg["compress_max_bytes"])
+        self.gzip_level = int(cfg["gzip_level"])
+        self.brotli_quality = int(cfg["brotli_quality"])
+
+    def negotiate(self, accept_encoding: str) -> Optional[str]:
+        accepted = _accepted_encodings(accept_encoding)
+        if brotli is not None and "br" in accepted:
+            return "br"
+        if "gzip" in accepted:
+            return "gzip"
+        return None
+
+    def compressible(self, status: int, headers: Headers) -> bool:
+        if status in (204, 206, 304) or "content-encoding" in headers:
+            return False
+        media_type = headers.get("content-type", "").partition(";")[0].strip().lower()
+        if media_type == "text/event-stream" or not media_type.startswith(COMPRESSIBLE_TYPES):
+            return False
+        try:
+            return self.min_bytes <= int(headers.get("content-length", "")) <= self.max_bytes
+        except ValueError:
+            return False
+
+    def compress(self, body: bytes, encoding: str) -> bytes:
+        if encoding == "br":
+            return brotli.compress(body, quality=self.brotli_quality)
+        compressor = zlib.compressobj(self.gzip_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(body) + compressor.flush()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.enabled or scope.get("method") == "HEAD":
+            await self.app(scope, receive, send)
+            return
+        encoding = self.negotiate(Headers(scope=scope).get("accept-encoding", ""))
+        held: Optional[Dict[str, Any]] = None
+        chunks = []
+
+        async def send_compressed(message):
+            nonlocal held
+            if message["type"] == "http.response.start":
+                if self.compressible(message["status"], Headers(raw=message["headers"])):
+                    MutableHeaders(raw=message["headers"]).add_vary_header("Accept-Encoding")
+                    if encoding:
+                        # wait for the whole body before deciding on the headers
+                        held = message
+                        return
+                await send(message)
+                return
+            if held is None:
+                await send(message)
+                return
+            if message["type"] != "http.response.body":
+                start, held = held, None
+                await send(start)
+                await send(message)
+                return
+            chunks.append(message.get("body", b""))
+            if message.get("more_body", False):
+                return
+            body = b"".join(chunks)
+            if len(body) >= THREAD_COMPRESS_BYTES:
+                compressed = await anyio.to_thread.run_sync(self.compress, body, encoding)
+            else:
+                compressed = self.compress(body, encoding)
+            start, held = held, None
+            if len(compressed) < len(body):
+                headers = MutableHeaders(raw=start["headers"])
+                headers["Content-Encoding"] = encoding
+                headers["Content-Length"] = str(len(compressed))
+                body = compressed
+            await send(start)
+            await send({"type": "http.response.body", "body": body, "more_body": False})
+
+        await self.app(scope, receive, send_compressed)
@@ -1,38 +1,82 @@
-from pathlib import Path
+from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import HTMLResponse
-from fastapi.staticfiles import StaticFiles
 
 from .chat import router as chat_router
 from .notebook import router as notebook_router
-from .character import fetch_character, list_characters, router as character_files_router
-from .preferences import router as preferences_router
+from .character import (
+    character_version,
+    characters_version,
+    fetch_character,
+    list_characters,
+    router as character_files_router,
+)
+from .preferences import flush_preferences, router as preferences_router
+from .response_cache import flush_cache
 from .world_info import router as world_router
 from .archive import router as archive_router
+from .backends import router as backends_router, start_health_checks, stop_health_checks
+from .etags import REVALIDATE, not_modified, set_validator, store_etag
+from .http_cache import CachedStaticFiles, CompressionMiddleware, index_page
+from .scheduler import router as scheduler_router
+from .upstream import close_client, start_client
 
-app = FastAPI()
 
-# Serve static assets (index.html expects /static)
-app.mount("/static", StaticFiles(directory="static"), name="static")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # one pooled upstream client for the whole app lifetime
+    await start_client()
+    start_health_checks()
+    try:
+        yield
+    finally:
+        await stop_health_checks()
+        await close_client()
+        # debounced preference and response cache updates still waiting for their write
+        await run_in_threadpool(flush_preferences)
+        await run_in_threadpool(flush_cache)
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(CompressionMiddleware)
+
+# Serve static assets (index.html expects /static); fingerprinted URLs are cached as immutable
+app.mount("/static", CachedStaticFiles(directory="static"), name="static")
 
 
 @app.get("/", response_class=HTMLResponse)
-def root():
-    index_path = Path("index.html")
-    return index_path.read_text(encoding="utf-8")
+def root(request: Request):
+    html, etag = index_page()
+    cached = not_modified(request, etag)
+    if cached:
+        return cached
+    return HTMLResponse(html, headers={"ETag": etag, "Cache-Control": REVALIDATE})
 
 
 @app.get("/characters/{char_id}")
-def get_character(char_id: int):
+def get_character(char_id: int, request: Request, response: Response):
     character = fetch_character(char_id)
     if not character:
         raise HTTPException(status_code=404, detail="Character not found")
+    version = character_version(char_id)
+    if version is not None:
+        etag = store_etag("character", "{}-{}".format(*version))
+        cached = not_modified(request, etag)
+        if cached:
+            return cached
+        set_validator(response, etag)
     return character
 
 
 @app.get("/characters")
-def get_characters():
+def get_characters(request: Request, response: Response):
+    etag = store_etag("characters", characters_version())
+    cached = not_modified(request, etag)
+    if cached:
+        return cached
+    set_validator(response, etag)
     return list_characters()
 
 
@@ -42,3 +86,5 @@ app.include_router(preferences_router)
 app.include_router(character_files_router)
 app.include_router(world_router)
 app.include_router(archive_router)
+app.include_router(scheduler_router)
+app.include_router(backends_router)
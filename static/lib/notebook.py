@@ -1,18 +1,44 @@
-from fastapi import APIRouter
-from fastapi.responses import StreamingResponse
+from contextlib import aclosing
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+import asyncio
+import json
+
+import anyio
+
+from fastapi import APIRouter, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
-import httpx
 
-from .chat import DEFAULT_MODEL, LM_URL
+from .archive import save_story_archive_async
+from .backends import open_stream, post_completion
+from .chat import DEFAULT_MODEL
+from .chunking import clip_tokens, split_chunks
+from .context_window import context_settings, estimate_tokens
+from .preferences import config_section
+from .scheduler import PRIORITY_NOTEBOOK, client_key, enqueue, upstream_slot
+from .sse import CompactFramer, delta_line, resolve_format, scan_chunk
+from .response_cache import cache_get, cache_key, cache_put, cache_settings
+from .upstream import ClosingStreamingResponse, DisconnectWatch
 
 router = APIRouter()
 
+# defaults, overridable via the "summarize" section of config.json
+SUMMARIZE_DEFAULTS: Dict[str, Any] = {
+    # texts longer than this are summarized chunk by chunk, then the partial summaries are merged
+    "chunk_tokens": 3000,
+    # parallel chunk requests per summary
+    "concurrency": 2,
+    "chunk_summary_tokens": 300,
+}
+
 
 class NotebookContinueRequest(BaseModel):
     text: str
     style: str | None = None
     model: str | None = None
     language: str | None = None
+    # "raw" or "compact" (see sse.py)
+    stream_format: str | None = None
 
 
 class NotebookRewriteRequest(BaseModel):
@@ -20,20 +46,135 @@ class NotebookRewriteRequest(BaseModel):
     style: str | None = None
     model: str | None = None
     language: str | None = None
+    # save the finished result as a story archive entry
+    archive: bool = False
 
 
 class NotebookSummarizeRequest(BaseModel):
     text: str
     model: str | None = None
     language: str | None = None
+    archive: bool = False
 
 
 class NotebookResponse(BaseModel):
     text: str
 
 
+async def _cached_completion(
+    kind: str, payload: Dict[str, Any], response: Response, client: str, always: bool = False
+) -> str:
+    """Run a non-streaming completion, served from the response cache when enabled (or always)."""
+    cfg = cache_settings()
+    if not (cfg["enabled"] or always):
+        return await _complete(payload, client)
+    key = cache_key(kind, payload)
+    cached = await run_in_threadpool(cache_get, key, cfg)
+    if cached is not None:
+        response.headers["X-Cache"] = "hit"
+        return cached
+    text = await _complete(payload, client)
+    await run_in_threadpool(cache_put, key, text, cfg)
+    response.headers["X-Cache"] = "miss"
+    return text
+
+
+async def _complete(payload: Dict[str, Any], client: str) -> str:
+    async with upstream_slot(client, PRIORITY_NOTEBOOK):
+        data = await post_completion(payload)
+    return data["choices"][0]["message"]["content"]
+
+
+async def _relay_stream(
+    payload: Dict[str, Any],
+    requester: str,
+    watch: DisconnectWatch,
+    parts: Optional[List[str]] = None,
+    framer: Optional[CompactFramer] = None,
+) -> AsyncIterator[str]:
+    """Forward upstream SSE chunks one per line; collect the delta text into parts if given.
+
+    With a framer the chunks are re-framed into compact lines instead; raw chunks are
+    only parsed when their text is needed. While the request waits for an upstream
+    slot, {"queue": {"position": n}} lines are sent. Stops early (closing the upstream
+    stream) once the client has disconnected.
+    """
+    ticket = enqueue(requester, PRIORITY_NOTEBOOK)
+    try:
+        async for position in ticket.wait_with_updates():
+            if await watch.gone():
+                return
+            yield json.dumps({"queue": {"position": position}}) + "\n"
+        async with open_stream(payload) as response, aclosing(watch.lines(response)) as lines:
+            async for line in lines:
+                if not line:
+                    continue
+                if line.startswith("data: "):
+                    chunk = line[6:].strip()
+                    if chunk == "[DONE]":
+                        break
+                    if parts is None and framer is None:
+                        yield chunk + "\n"
+                        continue
+                    data, delta = scan_chunk(chunk)
+                    if parts is not None and delta:
+                        parts.append(delta)
+                    if framer is None:
+                        yield chunk + "\n"
+                    else:
+                        frame = framer.feed(data, delta)
+                        if frame:
+                            yield frame
+        if framer is not None and not watch.disconnected:
+            yield framer.close()
+    finally:
+        ticket.release()
+
+
+async def _cached_stream(
+    kind: str,
+    payload: Dict[str, Any],
+    archive: bool,
+    client: str,
+    watch: DisconnectWatch,
+    always: bool = False,
+) -> ClosingStreamingResponse:
+    """Stream a completion through the response cache (when enabled, or always), optionally
+    archiving the result.
+
+    Partial output of an interrupted stream is archived with a truncated flag and never cached.
+    """
+    cfg = cache_settings()
+    key = cache_key(kind, payload) if cfg["enabled"] or always else None
+    cached = await run_in_threadpool(cache_get, key, cfg) if key else None
+    model = payload.get("model")
+
+    async def event_generator():
+        parts: List[str] = [cached] if cached is not None else []
+        completed = False
+        try:
+            if cached is not None:
+                yield delta_line(cached)
+            else:
+                stream_payload = dict(payload, stream=True)
+                async with aclosing(_relay_stream(stream_payload, client, watch, parts)) as chunks:
+                    async for chunk in chunks:
+                        yield chunk
+            completed = not watch.disconnected
+            if completed and cached is None and key and parts:
+                await run_in_threadpool(cache_put, key, "".join(parts), cfg)
+        finally:
+            text = "".join(parts)
+            if archive and text.strip():
+                with anyio.CancelScope(shield=True):
+                    await save_story_archive_async(text, model, truncated=not completed)
+
+    headers = {"X-Cache": "hit" if cached is not None else "miss"} if key else None
+    return ClosingStreamingResponse(event_generator(), media_type="text/event-stream", headers=headers)
+
+
 @router.post("/notebook/continue")
-async def notebook_continue(req: NotebookContinueRequest):
+async def notebook_continue(req: NotebookContinueRequest, http_request: Request):
     style = req.style or ""
     prompt = ( ""
         + "You are a writing assistant for long-form fiction.\n"
@@ -55,24 +196,17 @@ async def notebook_continue(req: NotebookContinueRequest):
         "max_tokens": 513,
         "stream": True,
     }
+    framer = CompactFramer() if resolve_format(req.stream_format) == "compact" else None
+    if framer:
+        payload["stream_options"] = {"include_usage": True}
 
-    async def event_generator():
-        async with httpx.AsyncClient(timeout=None) as client:
-            async with client.stream("POST", LM_URL, json=payload) as response:
-                async for line in response.aiter_lines():
-                    if not line:
-                        continue
-                    if line.startswith("data: "):
-                        chunk = line[6:].strip()
-                        if chunk == "[DONE]":
-                            break
-                        yield chunk + "\n"
-
-    return StreamingResponse(event_generator(), media_type="text/event-stream")
+    return ClosingStreamingResponse(
+        _relay_stream(payload, client_key(http_request), DisconnectWatch(http_request), framer=framer),
+        media_type="text/event-stream",
+    )
 
 
-@router.post("/notebook/rewrite", response_model=NotebookResponse)
-async def notebook_rewrite(req: NotebookRewriteRequest):
+def _rewrite_payload(req: NotebookRewriteRequest) -> Dict[str, Any]:
     style = req.style or ""
     prompt = (
         "You are a writing assistant for long-form fiction.\n"
@@ -84,8 +218,7 @@ async def notebook_rewrite(req: NotebookRewriteRequest):
         f"{req.selection}\n"
         "[END OF PASSAGE]\n"
     )
-
-    payload = {
+    return {
         "model": req.model or DEFAULT_MODEL,
         "messages": [{"role": "user", "content": prompt}],
         "temperature": 0.7,
@@ -93,36 +226,140 @@ async def notebook_rewrite(req: NotebookRewriteRequest):
         "stream": False,
     }
 
-    async with httpx.AsyncClient(timeout=60.0) as client:
-        response = await client.post(LM_URL, json=payload)
-        response.raise_for_status()
-        data = response.json()
 
-    reply_text = data["choices"][0]["message"]["content"]
+@router.post("/notebook/rewrite", response_model=NotebookResponse)
+async def notebook_rewrite(req: NotebookRewriteRequest, response: Response, http_request: Request):
+    payload = _rewrite_payload(req)
+    reply_text = await _cached_completion("rewrite", payload, response, client_key(http_request))
+    if req.archive and reply_text.strip():
+        await save_story_archive_async(reply_text, payload["model"])
     return NotebookResponse(text=reply_text)
 
 
-@router.post("/notebook/summarize", response_model=NotebookResponse)
-async def notebook_summarize(req: NotebookSummarizeRequest):
+@router.post("/notebook/rewrite/stream")
+async def notebook_rewrite_stream(req: NotebookRewriteRequest, http_request: Request):
+    return await _cached_stream(
+        "rewrite", _rewrite_payload(req), req.archive, client_key(http_request), DisconnectWatch(http_request)
+    )
+
+
+def _summarize_payload(text: str, model: Optional[str], language: Optional[str]) -> Dict[str, Any]:
     prompt = (
-        ("Respond in " + req.language + ".\n" if req.language else "")
+        ("Respond in " + language + ".\n" if language else "")
         + "Summarize the following story in concise bullet points and then in one "
         "short paragraph:\n\n"
-        f"{req.text}"
+        f"{text}"
     )
-
-    payload = {
-        "model": req.model or DEFAULT_MODEL,
+    return {
+        "model": model or DEFAULT_MODEL,
         "messages": [{"role": "user", "content": prompt}],
         "temperature": 0.3,
         "max_tokens": 513,
         "stream": False,
     }
 
-    async with httpx.AsyncClient(timeout=60.0) as client:
-        response = await client.post(LM_URL, json=payload)
-        response.raise_for_status()
-        data = response.json()
 
-    reply_text = data["choices"][0]["message"]["content"]
+def _chunk_payload(text: str, model: Optional[str], language: Optional[str], max_tokens: int) -> Dict[str, Any]:
+    prompt = (
+        ("Respond in " + language + ".\n" if language else "")
+        + "The text below is one consecutive part of a longer story. Summarize what happens in it: "
+        "events, characters introduced, and changes in their situation, in a few short sentences. "
+        "Do not add an introduction or comment on the text.\n\n"
+        f"{text}"
+    )
+    return {
+        "model": model or DEFAULT_MODEL,
+        "messages": [{"role": "user", "content": prompt}],
+        "temperature": 0.3,
+        "max_tokens": max_tokens,
+        "stream": False,
+    }
+
+
+async def _summarize_chunks(
+    chunks: List[str], model: Optional[str], language: Optional[str], cfg: Dict[str, Any], client: str
+) -> List[str]:
+    """Summarize chunks concurrently; per-chunk results are always cached by content."""
+    limit = asyncio.Semaphore(max(1, int(cfg["concurrency"])))
+    cache_cfg = cache_settings()
+
+    async def one(chunk: str) -> str:
+        payload = _chunk_payload(chunk, model, language, int(cfg["chunk_summary_tokens"]))
+        key = cache_key("summarize-chunk", payload)
+        cached = await run_in_threadpool(cache_get, key, cache_cfg)
+        if cached is not None:
+            return cached
+        async with limit:
+            text = await _complete(payload, client)
+        await run_in_threadpool(cache_put, key, text, cache_cfg)
+        return text
+
+    return list(await asyncio.gather(*(one(chunk) for chunk in chunks)))
+
+
+def _measure(text: str, chunk_tokens: int, ctx: Dict[str, Any]) -> Tuple[int, Optional[List[str]]]:
+    """(token count of text, its chunks); chunks is None when the text fits one prompt."""
+    count = lambda value: estimate_tokens(value, ctx)  # noqa: E731
+    size = count(text)
+    if size <= chunk_tokens:
+        return size, None
+    return size, split_chunks(text, chunk_tokens, count)
+
+
+def _cap_parts(partials: List[str], chunk_tokens: int, ctx: Dict[str, Any]) -> str:
+    """Join partial summaries, each clipped to an equal share of one prompt."""
+    count = lambda value: estimate_tokens(value, ctx)  # noqa: E731
+    share = max(1, chunk_tokens // len(partials) - 8)
+    joined = "\n\n".join(
+        f"Part {i}: {clip_tokens(part.strip(), share, count)}" for i, part in enumerate(partials, 1)
+    )
+    return clip_tokens(joined, chunk_tokens, count)
+
+
+async def condense_text(
+    text: str, model: Optional[str], language: Optional[str], client: str
+) -> Tuple[str, bool]:
+    """Map-reduce text over the chunk size down to partial summaries that fit one prompt.
+
+    Returns (text, condensed); text is returned unchanged with condensed False when it
+    already fits. Counting and splitting a novel-length text takes a while, so it runs
+    in the thread pool.
+    """
+    cfg = config_section("summarize", SUMMARIZE_DEFAULTS)
+    ctx = context_settings()
+    chunk_tokens = max(256, int(cfg["chunk_tokens"]))
+    size, chunks = await run_in_threadpool(_measure, text, chunk_tokens, ctx)
+    condensed = False
+    while chunks:
+        partials = await _summarize_chunks(chunks, model, language, cfg, client)
+        reduced = "\n\n".join(f"Part {i}: {part.strip()}" for i, part in enumerate(partials, 1))
+        reduced_size, chunks = await run_in_threadpool(_measure, reduced, chunk_tokens, ctx)
+        if chunks and reduced_size >= size:
+            # the model is not shrinking the text; clip the parts to fit instead of looping forever
+            return await run_in_threadpool(_cap_parts, partials, chunk_tokens, ctx), True
+        text, size, condensed = reduced, reduced_size, True
+    return text, condensed
+
+
+@router.post("/notebook/summarize", response_model=NotebookResponse)
+async def notebook_summarize(req: NotebookSummarizeRequest, response: Response, http_request: Request):
+    client = client_key(http_request)
+    text, condensed = await condense_text(req.text, req.model, req.language, client)
+    payload = _summarize_payload(text, req.model, req.language)
+    # the final pass over chunk summaries is cached like the chunks themselves
+    reply_text = await _cached_completion("summarize", payload, response, client, always=condensed)
+    if req.archive and reply_text.strip():
+        await save_story_archive_async(reply_text, payload["model"])
     return NotebookResponse(text=reply_text)
+
+
+@router.post("/notebook/summarize/stream")
+async def notebook_summarize_stream(req: NotebookSummarizeRequest, http_request: Request):
+    """Long texts are condensed chunk by chunk first; only the final summary streams."""
+    client = client_key(http_request)
+    text, condensed = await condense_text(req.text, req.model, req.language, client)
+    payload = _summarize_payload(text, req.model, req.language)
+    return await _cached_stream(
+        "summarize", payload, req.archive, client, DisconnectWatch(http_request),
+        always=condensed,
+    )
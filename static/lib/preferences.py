@@ -1,12 +1,31 @@
 from pathlib import Path
-from typing import Any, Dict
+from typing import Any, Dict, Optional, Tuple
 import json
+import re
+import threading
+import time
 
-from fastapi import APIRouter
+from fastapi import APIRouter, Request, Response
 from pydantic import BaseModel
 
+from .etags import not_modified, set_validator, store_etag
+from .storage import atomic_write_json, path_lock
+
 CONFIG_PATH = Path("static/userdata/config.json")
 
+# defaults, overridable via the "preferences" section of config.json
+PREFERENCES_DEFAULTS: Dict[str, Any] = {
+    # updates arriving within this window are written to disk once
+    "write_delay_ms": 500,
+    # per-client profiles kept under "profiles"; the least recently updated go first
+    "max_profiles": 64,
+}
+
+PREFERENCE_FIELDS = ("theme", "language", "character_id")
+CLIENT_ID_RE = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+# config.json may be edited by hand; re-stat it at most this often
+REVALIDATE_INTERVAL = 2.0
+
 router = APIRouter()
 
 
@@ -14,9 +33,31 @@ class Preferences(BaseModel):
     theme: str | None = None
     language: str | None = None
     character_id: int | None = None
+    # store version, also sent as the ETag; ignored on update
+    version: int | None = None
 
 
-def _load_config() -> Dict[str, Any]:
+# in-memory copy of config.json; _version grows on every change, ours or on disk
+_lock = threading.RLock()
+_config: Dict[str, Any] = {}
+_signature: Optional[Tuple[int, int]] = None
+_checked_at = 0.0
+_loaded = False
+_version = 0
+# updates not yet on disk: profile id ("" = global) -> fields
+_pending: Dict[str, Dict[str, Any]] = {}
+_flush_timer: Optional[threading.Timer] = None
+
+
+def _stat_signature() -> Optional[Tuple[int, int]]:
+    try:
+        st = CONFIG_PATH.stat()
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+def _read_config() -> Dict[str, Any]:
     if CONFIG_PATH.exists():
         try:
             data = json.loads(CONFIG_PATH.read_text(encoding="utf-8"))
@@ -27,33 +68,179 @@ def _load_config() -> Dict[str, Any]:
     return {}
 
 
-def _save_config(data: Dict[str, Any]) -> None:
-    CONFIG_PATH.parent.mkdir(parents=True, exist_ok=True)
-    CONFIG_PATH.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+def _apply(cfg: Dict[str, Any], profile: str, fields: Dict[str, Any]) -> None:
+    if not profile:
+        cfg.update(fields)
+        return
+    profiles = cfg.get("profiles")
+    if not isinstance(profiles, dict):
+        profiles = cfg["profiles"] = {}
+    entry = profiles.get(profile) if isinstance(profiles.get(profile), dict) else {}
+    entry.update(fields)
+    entry["updated_at"] = int(time.time() * 1000)
+    profiles[profile] = entry
+
+
+def _trim_profiles(cfg: Dict[str, Any], limit: int) -> None:
+    profiles = cfg.get("profiles")
+    if not isinstance(profiles, dict) or len(profiles) <= limit:
+        return
+    by_age = sorted(profiles, key=lambda key: (profiles[key] or {}).get("updated_at") or 0)
+    for key in by_age[: len(profiles) - limit]:
+        del profiles[key]
+
+
+def _revalidate(force: bool = False) -> None:
+    """Reload config.json when it changed on disk, keeping updates that are not written yet."""
+    global _config, _signature, _checked_at, _loaded, _version
+    if not force and _loaded and time.monotonic() - _checked_at < REVALIDATE_INTERVAL:
+        return
+    with _lock:
+        now = time.monotonic()
+        signature = _stat_signature()
+        if not _loaded or signature != _signature:
+            cfg = _read_config()
+            for profile, fields in _pending.items():
+                _apply(cfg, profile, fields)
+            _config = cfg
+            _signature = signature
+            _version += 1
+        _checked_at = now
+        _loaded = True
+
+
+def _load_config() -> Dict[str, Any]:
+    """The cached config. Shared; callers must not modify it."""
+    _revalidate()
+    return _config
+
+
+def config_section(name: str, defaults: Dict[str, Any]) -> Dict[str, Any]:
+    """Defaults overlaid with the known keys of a config.json section."""
+    settings = dict(defaults)
+    overrides = _load_config().get(name)
+    if isinstance(overrides, dict):
+        for key, value in overrides.items():
+            if key in settings and value is not None:
+                settings[key] = value
+    return settings
+
+
+def preferences_version() -> int:
+    _revalidate()
+    return _version
+
+
+def flush_preferences() -> None:
+    """Write pending updates now (read-modify-write, so hand edits to other keys survive)."""
+    global _signature, _flush_timer
+    with _lock:
+        if _flush_timer is not None:
+            _flush_timer.cancel()
+            _flush_timer = None
+        written = {profile: dict(fields) for profile, fields in _pending.items()}
+    if not written:
+        return
+    limit = int(config_section("preferences", PREFERENCES_DEFAULTS)["max_profiles"])
+    # the disk write happens outside _lock so config_section() readers never wait on it
+    try:
+        with path_lock(CONFIG_PATH):
+            cfg = _read_config()
+            for profile, fields in written.items():
+                _apply(cfg, profile, fields)
+            _trim_profiles(cfg, limit)
+            atomic_write_json(CONFIG_PATH, cfg)
+            signature = _stat_signature()
+    except OSError:
+        # the updates stay pending; try again after another delay (and at shutdown)
+        with _lock:
+            _schedule_flush()
+        raise
+    with _lock:
+        # updates that arrived during the write stay pending for the next flush
+        for profile, fields in written.items():
+            pending = _pending.get(profile, {})
+            for key, value in fields.items():
+                if key in pending and pending[key] == value:
+                    del pending[key]
+            if not pending:
+                _pending.pop(profile, None)
+        _signature = signature
+
+
+def _schedule_flush() -> None:
+    """Start the debounce timer unless one is pending. Call with _lock held."""
+    global _flush_timer
+    if _flush_timer is None:
+        delay = max(0.0, float(config_section("preferences", PREFERENCES_DEFAULTS)["write_delay_ms"]) / 1000)
+        _flush_timer = threading.Timer(delay, flush_preferences)
+        _flush_timer.daemon = True
+        _flush_timer.start()
+
+
+def update_preferences_fields(profile: str, fields: Dict[str, Any]) -> None:
+    """Apply an update in memory and schedule one debounced write for the burst."""
+    global _config, _version
+    _revalidate()
+    with _lock:
+        # copy on write: readers may still hold the previous dict
+        cfg = json.loads(json.dumps(_config))
+        _apply(cfg, profile, fields)
+        _pending.setdefault(profile, {}).update(fields)
+        _config = cfg
+        _version += 1
+        _schedule_flush()
+
+
+def _profile_id(request: Request) -> str:
+    """Per-client profile from the X-Client-Id header; without one the global preferences apply."""
+    raw = request.headers.get("x-client-id") or ""
+    return raw if CLIENT_ID_RE.match(raw) else ""
+
+
+def _preferences_for(profile: str) -> Preferences:
+    with _lock:
+        cfg = _load_config()
+        values = {field: cfg.get(field) for field in PREFERENCE_FIELDS}
+        profiles = cfg.get("profiles")
+        if profile and isinstance(profiles, dict) and isinstance(profiles.get(profile), dict):
+            # fields a client never set fall back to the global ones
+            values.update({k: v for k, v in profiles[profile].items() if k in PREFERENCE_FIELDS and v is not None})
+        return Preferences(**values, version=_version)
+
+
+def _etag(version: int, profile: str) -> str:
+    # the profile id is part of the tag: one client's validator never matches another's
+    # response ("@" cannot occur in an id, so "" for the global profile stays distinct)
+    return store_etag("prefs", f"{version}@{profile}")
 
 
 @router.get("/preferences", response_model=Preferences)
-def get_preferences():
-    cfg = _load_config()
-    return Preferences(
-        theme=cfg.get("theme"),
-        language=cfg.get("language"),
-        character_id=cfg.get("character_id"),
-    )
+def get_preferences(request: Request, response: Response):
+    profile = _profile_id(request)
+    cached = not_modified(request, _etag(preferences_version(), profile))
+    if cached:
+        cached.headers["Vary"] = "X-Client-Id"
+        return cached
+    prefs = _preferences_for(profile)
+    set_validator(response, _etag(prefs.version, profile))
+    response.headers["Vary"] = "X-Client-Id"
+    return prefs
 
 
 @router.post("/preferences", response_model=Preferences)
-def update_preferences(update: Preferences):
-    cfg = _load_config()
+def update_preferences(update: Preferences, request: Request, response: Response):
+    fields: Dict[str, Any] = {}
     if update.theme is not None:
-        cfg["theme"] = update.theme
+        fields["theme"] = update.theme
     if update.language is not None:
-        cfg["language"] = update.language
+        fields["language"] = update.language
     if update.character_id is not None:
-        cfg["character_id"] = int(update.character_id)
-    _save_config(cfg)
-    return Preferences(
-        theme=cfg.get("theme"),
-        language=cfg.get("language"),
-        character_id=cfg.get("character_id"),
-    )
+        fields["character_id"] = int(update.character_id)
+    profile = _profile_id(request)
+    if fields:
+        update_preferences_fields(profile, fields)
+    prefs = _preferences_for(profile)
+    set_validator(response, _etag(prefs.version, profile))
+    response.headers["Vary"] = "X-Client-Id"
+    return prefs
@@ -0,0 +1,168 @@
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+import threading
+import zlib
+
+from .character import character_version, fetch_character_async
+from .context_window import fit_to_budget
+from .preferences import config_section
+from .world_info import select_world_entries_async, world_scan_depth
+
+LANGUAGE_INSTRUCTION = "Respond in the same language the user used."
+SYSTEM_PROMPT_CACHE_SIZE = 256
+
+# defaults, overridable via the "prompt" section of config.json
+PROMPT_DEFAULTS: Dict[str, Any] = {
+    # "classic": persona, language and world context as separate leading system messages.
+    # "stable": one static system message first and the per-turn world context folded into
+    # the new user turn, so the prefix (system + history) is byte-identical across turns and
+    # llama.cpp / LM Studio can reuse their KV cache instead of re-prefilling. Nothing
+    # follows the history but the user turn, which every chat template accepts.
+    "layout": "classic",
+    # send llama.cpp's cache_prompt flag
+    "cache_prompt": False,
+    # when > 0, pin each conversation to id_slot = crc32(archive_id) % slots
+    "slots": 0,
+}
+
+_TEMPLATES = {
+    "roleplay": (
+        "You are roleplaying as {name}. Stay fully in character using their voice, goals, and mannerisms.\n"
+        "Greeting: {greeting}\n"
+        "Persona: {persona}\n"
+        "Gender: {gender}\n"
+        "Keep replies as immersive dialogue with light action cues, using present tense and emotion-rich tone. "
+        "Use *italics* for actions and stage directions, and **bold** for strongly voiced text; do not escape or alter these markers. "
+        "Do not break character or explain that you are an assistant."
+    ),
+    "chat": (
+        "You are {name}, a helpful conversational assistant.\n"
+        "Greeting: {greeting}\n"
+        "Persona: {persona}\n"
+        "Gender: {gender}\n"
+        "Respond clearly and concisely, stay on topic, and adapt tone to match the persona. "
+        "If the user provides a goal, focus on accomplishing it with numbered steps when useful. "
+        "Do not roleplay; be direct and practical."
+    ),
+}
+
+
+def build_system_prompt(character: dict | None) -> str | None:
+    if not character:
+        return None
+    mode = (character.get("mode") or "chat").lower()
+    template = _TEMPLATES.get(mode)
+    if template is None:
+        return None
+    return template.format(
+        name=character.get("name") or "Assistant",
+        greeting=character.get("greeting") or "",
+        persona=character.get("personality") or "",
+        gender=character.get("gender") or "",
+    )
+
+
+# rendered system prompts keyed by (character id, character version, mode)
+_system_cache: "OrderedDict[Tuple, Optional[str]]" = OrderedDict()
+_system_lock = threading.Lock()
+
+
+def cached_system_prompt(character: dict, version: Any) -> Optional[str]:
+    if not character:
+        return None
+    key = (character.get("id"), version, (character.get("mode") or "chat").lower())
+    with _system_lock:
+        if key in _system_cache:
+            _system_cache.move_to_end(key)
+            return _system_cache[key]
+    rendered = build_system_prompt(character)
+    with _system_lock:
+        _system_cache[key] = rendered
+        while len(_system_cache) > SYSTEM_PROMPT_CACHE_SIZE:
+            _system_cache.popitem(last=False)
+    return rendered
+
+
+def render_world_context(entries: Iterable[dict]) -> str:
+    joined = "\n\n".join(
+        f"- {item.get('name')}: {item.get('description') or ''}" for item in entries
+    )
+    return "World context:\n" + joined if joined else ""
+
+
+async def world_context_block(turns: List[Dict[str, str]], prompt: str) -> str:
+    """World context for entries triggered by the recent conversation window.
+
+    Entry loading and the key matcher are cached per world version in world_info.
+    """
+    depth = world_scan_depth()
+    window = turns[-depth:] if depth > 0 else []
+    scan_text = "\n".join([m["content"] for m in window] + [prompt])
+    return render_world_context(await select_world_entries_async(scan_text))
+
+
+def prompt_settings() -> Dict[str, Any]:
+    return config_section("prompt", PROMPT_DEFAULTS)
+
+
+def backend_cache_hints(archive_id: Optional[str], settings: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Extra payload fields that let local servers reuse a conversation's KV cache."""
+    cfg = settings or prompt_settings()
+    hints: Dict[str, Any] = {}
+    if cfg.get("cache_prompt"):
+        hints["cache_prompt"] = True
+    slots = int(cfg.get("slots") or 0)
+    if slots > 0 and archive_id:
+        hints["id_slot"] = zlib.crc32(archive_id.encode("utf-8")) % slots
+    return hints
+
+
+def history_messages(history: Optional[Iterable[Any]]) -> List[Dict[str, str]]:
+    """Keep only non-empty user/assistant turns (models or stored dicts), as plain dicts."""
+    out: List[Dict[str, str]] = []
+    for msg in history or ():
+        if isinstance(msg, dict):
+            role, content = msg.get("role"), msg.get("content")
+        else:
+            role = getattr(msg, "role", None)
+            content = getattr(msg, "content", None)
+        if role in ("user", "assistant") and content:
+            out.append({"role": role, "content": content})
+    return out
+
+
+async def assemble_chat_messages(
+    character_id: Optional[int],
+    mode: Optional[str],
+    history: Optional[Iterable[Any]],
+    prompt: str,
+) -> Tuple[List[Dict[str, str]], List[Dict[str, str]], str, Dict[str, int]]:
+    """Build the upstream message list for a chat turn, trimmed to the token budget.
+
+    Returns (messages, full filtered history, archive entry type, token stats).
+    """
+    char_id = character_id or 1
+    character = await fetch_character_async(char_id) or {}
+    if mode:
+        character["mode"] = mode
+    entry_type = "roleplay" if (character.get("mode") == "roleplay") else "chat"
+    system_prompt = cached_system_prompt(character, character_version(char_id))
+    turns = history_messages(history)
+    world_context = await world_context_block(turns, prompt)
+
+    user_message = {"role": "user", "content": prompt}
+    if prompt_settings().get("layout") == "stable":
+        static = "\n\n".join(part for part in (system_prompt, LANGUAGE_INSTRUCTION) if part)
+        if world_context:
+            user_message["content"] = f"{world_context}\n\n{prompt}"
+        messages, stats = fit_to_budget([{"role": "system", "content": static}], turns, user_message)
+        return messages, turns, entry_type, stats
+
+    system_messages: List[Dict[str, str]] = []
+    if system_prompt:
+        system_messages.append({"role": "system", "content": system_prompt})
+    system_messages.append({"role": "system", "content": LANGUAGE_INSTRUCTION})
+    if world_context:
+        system_messages.append({"role": "system", "content": world_context})
+    messages, stats = fit_to_budget(system_messages, turns, user_message)
+    return messages, turns, entry_type, stats
@@ -0,0 +1,138 @@
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional
+import hashlib
+import json
+import threading
+
+from .preferences import config_section
+from .storage import atomic_write_json, path_lock
+
+CACHE_PATH = Path("static/userdata/notebook_cache.json")
+
+# bump when the notebook prompt templates change in a way the rendered prompt
+# text would not reveal (e.g. a different output post-processing)
+TEMPLATE_VERSION = 1
+
+# defaults, overridable via the "notebook_cache" section of config.json
+CACHE_DEFAULTS: Dict[str, Any] = {
+    "enabled": False,
+    "max_entries": 256,
+    # total size of cached replies, in characters
+    "max_chars": 2_000_000,
+    # keep the cache in static/userdata/notebook_cache.json across restarts
+    "persist": False,
+    # puts arriving within this window are persisted with one write
+    "write_delay_ms": 1000,
+}
+
+_entries: "OrderedDict[str, str]" = OrderedDict()
+_size = 0
+_loaded = False
+_lock = threading.Lock()
+# pending debounced write of the persisted cache
+_dirty = False
+_flush_timer: Optional[threading.Timer] = None
+
+
+def cache_settings() -> Dict[str, Any]:
+    return config_section("notebook_cache", CACHE_DEFAULTS)
+
+
+def cache_key(kind: str, payload: Dict[str, Any]) -> str:
+    """Content address of a completion: endpoint, template version and the full upstream payload.
+
+    The payload carries the model, sampling options and the rendered prompt, so the
+    text, style and language are all part of the key.
+    """
+    material = json.dumps([kind, TEMPLATE_VERSION, payload], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+def _evict(cfg: Dict[str, Any]) -> None:
+    global _size
+    max_entries = max(0, int(cfg["max_entries"]))
+    max_chars = max(0, int(cfg["max_chars"]))
+    while _entries and (len(_entries) > max_entries or _size > max_chars):
+        _, value = _entries.popitem(last=False)
+        _size -= len(value)
+
+
+def _load(cfg: Dict[str, Any]) -> None:
+    global _loaded, _size
+    _loaded = True
+    if not cfg["persist"] or not CACHE_PATH.exists():
+        return
+    try:
+        data = json.loads(CACHE_PATH.read_text(encoding="utf-8"))
+    except Exception:
+        return
+    if not isinstance(data, list):
+        return
+    for item in data:
+        if isinstance(item, list) and len(item) == 2 and all(isinstance(v, str) for v in item):
+            key, value = item
+            _size -= len(_entries.pop(key, ""))
+            _entries[key] = value
+            _size += len(value)
+    _evict(cfg)
+
+
+def cache_get(key: str, settings: Optional[Dict[str, Any]] = None) -> Optional[str]:
+    cfg = settings or cache_settings()
+    with _lock:
+        if not _loaded:
+            _load(cfg)
+        value = _entries.get(key)
+        if value is not None:
+            _entries.move_to_end(key)
+        return value
+
+
+def flush_cache() -> None:
+    """Write the cache to disk if puts are pending. Blocking."""
+    global _dirty, _flush_timer
+    with _lock:
+        if _flush_timer is not None:
+            _flush_timer.cancel()
+            _flush_timer = None
+        if not _dirty:
+            return
+        _dirty = False
+    try:
+        # snapshot under the file lock so concurrent writers land in order
+        with path_lock(CACHE_PATH):
+            with _lock:
+                snapshot = [[k, v] for k, v in _entries.items()]
+            atomic_write_json(CACHE_PATH, snapshot, fsync=False)
+    except OSError:
+        with _lock:
+            _dirty = True
+            _schedule_flush(cache_settings())
+        raise
+
+
+def _schedule_flush(cfg: Dict[str, Any]) -> None:
+    """Start the debounce timer unless one is pending. Call with _lock held."""
+    global _flush_timer
+    if _flush_timer is None:
+        delay = max(0.0, float(cfg["write_delay_ms"]) / 1000)
+        _flush_timer = threading.Timer(delay, flush_cache)
+        _flush_timer.daemon = True
+        _flush_timer.start()
+
+
+def cache_put(key: str, value: str, settings: Optional[Dict[str, Any]] = None) -> None:
+    """Store a reply; when persistence is on, a burst of puts is written to disk once."""
+    global _size, _dirty
+    cfg = settings or cache_settings()
+    with _lock:
+        if not _loaded:
+            _load(cfg)
+        _size -= len(_entries.pop(key, ""))
+        _entries[key] = value
+        _size += len(value)
+        _evict(cfg)
+        if cfg["persist"]:
+            _dirty = True
+            _schedule_flush(cfg)
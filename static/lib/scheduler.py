@@ -0,0 +1,217 @@
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Deque, Dict, List, Optional
+import asyncio
+import time
+
+from fastapi import APIRouter, Request
+
+from .backends import backend_capacity
+from .preferences import config_section
+
+# defaults, overridable via the "scheduler" section of config.json
+SCHEDULER_DEFAULTS: Dict[str, Any] = {
+    # upstream requests allowed at once per available backend (0 = unlimited); a
+    # single-GPU server is fastest with one or two, beyond that requests share the GPU
+    "max_in_flight": 2,
+    # how often queued streams get a position update, in seconds
+    "position_interval": 1.0,
+}
+
+# lower value is served first
+PRIORITY_CHAT = 0
+PRIORITY_NOTEBOOK = 1
+PRIORITY_NAMES = {PRIORITY_CHAT: "chat", PRIORITY_NOTEBOOK: "notebook"}
+
+router = APIRouter()
+
+
+class Ticket:
+    """One upstream request waiting for (or holding) a slot."""
+
+    def __init__(self, client: str, priority: int):
+        self.client = client
+        self.priority = priority
+        self.enqueued_at = time.monotonic()
+        self.started_at: Optional[float] = None
+        self.granted = asyncio.get_running_loop().create_future()
+        self.released = False
+
+    def position(self) -> int:
+        """1-based place in the dispatch order, 0 once the slot is granted."""
+        if self.granted.done():
+            return 0
+        for index, ticket in enumerate(_dispatch_order(), 1):
+            if ticket is self:
+                return index
+        return 0
+
+    async def wait(self) -> None:
+        try:
+            await self.granted
+        except asyncio.CancelledError:
+            self.release()
+            raise
+
+    async def wait_with_updates(self) -> AsyncIterator[int]:
+        """Wait for the slot, yielding the queue position whenever it changes."""
+        interval = float(config_section("scheduler", SCHEDULER_DEFAULTS)["position_interval"])
+        last = None
+        try:
+            while not self.granted.done():
+                position = self.position()
+                if position and position != last:
+                    last = position
+                    yield position
+                try:
+                    await asyncio.wait_for(asyncio.shield(self.granted), timeout=max(0.05, interval))
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            self.release()
+            raise
+
+    def release(self) -> None:
+        if self.released:
+            return
+        self.released = True
+        now = time.monotonic()
+        if self.granted.done() and not self.granted.cancelled():
+            _record(self.priority, "service", now - (self.started_at or now))
+            _state["in_flight"] -= 1
+        else:
+            self.granted.cancel()
+            _remove_waiter(self)
+        _dispatch()
+
+
+# per priority: client -> waiting tickets; client order is the round-robin order
+_queues: Dict[int, "OrderedDict[str, Deque[Ticket]]"] = {}
+_state = {"in_flight": 0}
+_metrics: Dict[str, Dict[str, float]] = {}
+
+
+def _max_in_flight() -> int:
+    per_backend = max(0, int(config_section("scheduler", SCHEDULER_DEFAULTS)["max_in_flight"]))
+    return per_backend * backend_capacity()
+
+
+def _dispatch_order() -> List[Ticket]:
+    """Waiting tickets in the order they would be granted (priority, then round-robin by client)."""
+    order: List[Ticket] = []
+    for priority in sorted(_queues):
+        lanes = [list(q) for q in _queues[priority].values()]
+        depth = 0
+        while True:
+            row = [lane[depth] for lane in lanes if depth < len(lane)]
+            if not row:
+                break
+            order.extend(row)
+            depth += 1
+    return order
+
+
+def _next_waiter() -> Optional[Ticket]:
+    for priority in sorted(_queues):
+        clients = _queues[priority]
+        while clients:
+            client, waiting = next(iter(clients.items()))
+            ticket = waiting.popleft()
+            # rotate the client to the back so other clients go next
+            del clients[client]
+            if waiting:
+                clients[client] = waiting
+            if not clients:
+                del _queues[priority]
+            return ticket
+    return None
+
+
+def _remove_waiter(ticket: Ticket) -> None:
+    clients = _queues.get(ticket.priority)
+    if not clients or ticket.client not in clients:
+        return
+    waiting = clients[ticket.client]
+    try:
+        waiting.remove(ticket)
+    except ValueError:
+        return
+    if not waiting:
+        del clients[ticket.client]
+    if not clients:
+        del _queues[ticket.priority]
+
+
+def _dispatch() -> None:
+    limit = _max_in_flight()
+    while not limit or _state["in_flight"] < limit:
+        ticket = _next_waiter()
+        if ticket is None:
+            return
+        if ticket.granted.done():
+            continue
+        ticket.started_at = time.monotonic()
+        _record(ticket.priority, "wait", ticket.started_at - ticket.enqueued_at)
+        _state["in_flight"] += 1
+        ticket.granted.set_result(None)
+
+
+def _record(priority: int, kind: str, seconds: float) -> None:
+    stats = _metrics.setdefault(PRIORITY_NAMES.get(priority, str(priority)), {})
+    stats[f"{kind}_count"] = stats.get(f"{kind}_count", 0) + 1
+    stats[f"{kind}_total"] = stats.get(f"{kind}_total", 0.0) + seconds
+    stats[f"{kind}_max"] = max(stats.get(f"{kind}_max", 0.0), seconds)
+
+
+def enqueue(client: str, priority: int) -> Ticket:
+    """Queue an upstream request; the caller must release() the ticket when done."""
+    ticket = Ticket(client, priority)
+    _queues.setdefault(priority, OrderedDict()).setdefault(client, deque()).append(ticket)
+    _dispatch()
+    return ticket
+
+
+@asynccontextmanager
+async def upstream_slot(client: str, priority: int):
+    ticket = enqueue(client, priority)
+    try:
+        await ticket.wait()
+        yield ticket
+    finally:
+        ticket.release()
+
+
+def client_key(request: Request) -> str:
+    """Identify the caller for fair queueing by its remote address.
+
+    X-Client-Id is chosen by the client, so a caller rotating it would get a lane per
+    request; it only names the caller when the transport gives no peer address.
+    """
+    if request.client and request.client.host:
+        return request.client.host
+    explicit = request.headers.get("x-client-id")
+    return "id:" + explicit[:64] if explicit else "anonymous"
+
+
+def scheduler_metrics() -> Dict[str, Any]:
+    classes = {}
+    for name, stats in _metrics.items():
+        summary = {}
+        for kind in ("wait", "service"):
+            count = stats.get(f"{kind}_count", 0)
+            summary[f"{kind}_count"] = int(count)
+            summary[f"{kind}_avg_ms"] = round(stats.get(f"{kind}_total", 0.0) / count * 1000, 1) if count else 0.0
+            summary[f"{kind}_max_ms"] = round(stats.get(f"{kind}_max", 0.0) * 1000, 1)
+        classes[name] = summary
+    queued = sum(len(q) for clients in _queues.values() for q in clients.values())
+    return {
+        "in_flight": _state["in_flight"],
+        "max_in_flight": _max_in_flight(),
+        "queued": queued,
+        "classes": classes,
+    }
+
+
+@router.get("/upstream/metrics")
+async def get_scheduler_metrics():
+    return scheduler_metrics()
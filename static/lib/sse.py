@@ -0,0 +1,121 @@
+from json.decoder import scanstring
+from typing import Any, Dict, List, Optional, Tuple
+import json
+import re
+import time
+
+from .preferences import config_section
+
+# defaults, overridable via the "stream" section of config.json
+STREAM_DEFAULTS: Dict[str, Any] = {
+    # "raw": forward upstream OpenAI chunks as-is; "compact": {"d": text} deltas plus
+    # one final {"done": true, ...} line. Clients can pick per request (stream_format).
+    "format": "raw",
+    # compact deltas arriving within this window are merged into one line
+    "flush_interval_ms": 40,
+}
+
+STREAM_FORMATS = ("raw", "compact")
+
+
+def stream_settings() -> Dict[str, Any]:
+    return config_section("stream", STREAM_DEFAULTS)
+
+
+def resolve_format(requested: Optional[str], settings: Optional[Dict[str, Any]] = None) -> str:
+    cfg = settings or stream_settings()
+    fmt = requested or cfg["format"]
+    return fmt if fmt in STREAM_FORMATS else "raw"
+
+
+def parse_chunk(chunk: str) -> Optional[Dict[str, Any]]:
+    try:
+        data = json.loads(chunk)
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def chunk_delta(data: Optional[Dict[str, Any]]) -> str:
+    try:
+        return data["choices"][0].get("delta", {}).get("content") or ""
+    except (LookupError, AttributeError, TypeError):
+        return ""
+
+
+# keys that only matter when they carry a value; a chunk with either one is parsed in full
+_METADATA_RE = re.compile(r'"(?:finish_reason|usage)"\s*:\s*(?!null\b)')
+_DELTA_CONTENT_RE = re.compile(r'"delta"\s*:\s*\{\s*(?:"role"\s*:\s*"[a-z]*"\s*,\s*)?"content"\s*:\s*')
+
+
+def scan_chunk(chunk: str) -> Tuple[Optional[Dict[str, Any]], str]:
+    """(parsed chunk or None, delta text) for one upstream stream chunk.
+
+    Ordinary token chunks are only scanned for their delta string; json.loads runs
+    for chunks carrying a finish_reason or usage (what CompactFramer needs) and for
+    anything the scan does not recognise. Keys inside the text cannot match, since
+    their quotes arrive escaped.
+    """
+    if not _METADATA_RE.search(chunk):
+        match = _DELTA_CONTENT_RE.search(chunk)
+        if match:
+            start = match.end()
+            if chunk.startswith('"', start):
+                try:
+                    return None, scanstring(chunk, start + 1)[0]
+                except ValueError:
+                    pass
+            elif chunk.startswith("null", start):
+                return None, ""
+    data = parse_chunk(chunk)
+    return data, chunk_delta(data)
+
+
+def delta_line(text: str) -> str:
+    """A single chunk in the upstream (raw) framing, for text that did not come from a stream."""
+    return json.dumps({"choices": [{"delta": {"content": text}}]}, ensure_ascii=False) + "\n"
+
+
+class CompactFramer:
+    """Turns parsed upstream chunks into compact lines, coalescing small deltas.
+
+    A pending delta is flushed when a chunk arrives after the flush window has
+    passed, so the added latency is at most one inter-token gap.
+    """
+
+    def __init__(self, settings: Optional[Dict[str, Any]] = None):
+        cfg = settings or stream_settings()
+        self.interval = max(0.0, float(cfg["flush_interval_ms"]) / 1000)
+        self.pending: List[str] = []
+        self.flushed_at = time.monotonic()
+        self.finish_reason: Optional[str] = None
+        self.usage: Optional[Dict[str, Any]] = None
+
+    def feed(self, data: Optional[Dict[str, Any]], delta: str) -> Optional[str]:
+        if data:
+            choices = data.get("choices") or [{}]
+            if isinstance(choices, list) and choices and isinstance(choices[0], dict):
+                self.finish_reason = choices[0].get("finish_reason") or self.finish_reason
+            if isinstance(data.get("usage"), dict):
+                self.usage = data["usage"]
+        if delta:
+            self.pending.append(delta)
+        if self.pending and time.monotonic() - self.flushed_at >= self.interval:
+            return self.flush()
+        return None
+
+    def flush(self) -> Optional[str]:
+        self.flushed_at = time.monotonic()
+        if not self.pending:
+            return None
+        text = "".join(self.pending)
+        self.pending.clear()
+        return json.dumps({"d": text}, ensure_ascii=False) + "\n"
+
+    def close(self) -> str:
+        """Remaining text plus the final metadata line."""
+        tail = self.flush() or ""
+        done: Dict[str, Any] = {"done": True, "finish_reason": self.finish_reason}
+        if self.usage:
+            done["usage"] = self.usage
+        return tail + json.dumps(done, ensure_ascii=False) + "\n"
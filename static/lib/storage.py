@@ -0,0 +1,80 @@
+from pathlib import Path
+from typing import Any, Dict
+import json
+import os
+import tempfile
+import threading
+import weakref
+
+# defaults for the "storage" section of config.json. This module sits below preferences,
+# so callers read the section themselves (see archive.storage_settings).
+STORAGE_DEFAULTS: Dict[str, Any] = {
+    # fsync archive writes and chat turn appends before reporting them saved; turning it
+    # off risks the last turns on a power loss in exchange for throughput
+    # (tests/bench_storage.py measures both)
+    "fsync": True,
+}
+
+# per-path re-entrant locks; callers hold one across a read-modify-write of a file.
+# An entry lives only while someone holds a reference to its lock, so paths that
+# were touched once (old archives, deleted characters) do not accumulate.
+_locks: "weakref.WeakValueDictionary[str, threading.RLock]" = weakref.WeakValueDictionary()
+_locks_guard = threading.Lock()
+
+
+def path_lock(path: Path) -> threading.RLock:
+    key = os.path.abspath(path)
+    with _locks_guard:
+        lock = _locks.get(key)
+        if lock is None:
+            lock = _locks[key] = threading.RLock()
+    return lock
+
+
+def _fsync_dir(directory: Path) -> None:
+    # makes the rename itself durable on POSIX; directories cannot be opened on Windows
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def atomic_write_bytes(path: Path, data: bytes, fsync: bool = True) -> None:
+    """Write via temp file + fsync + rename so readers never see a partial file."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path_lock(path):
+        fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fh:
+                fh.write(data)
+                if fsync:
+                    fh.flush()
+                    os.fsync(fh.fileno())
+            # mkstemp creates 0600 files; keep the mode plain write_text would have produced
+            try:
+                mode = path.stat().st_mode & 0o777
+            except OSError:
+                mode = 0o644
+            os.chmod(tmp_name, mode)
+            os.replace(tmp_name, path)
+        except BaseException:
+            try:
+                os.unlink(tmp_name)
+            except OSError:
+                pass
+            raise
+    if fsync:
+        _fsync_dir(path.parent)
+
+
+def atomic_write_json(path: Path, data: Any, fsync: bool = True) -> int:
+    """Atomically write pretty-printed JSON; returns the number of bytes written."""
+    encoded = json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
+    atomic_write_bytes(path, encoded, fsync=fsync)
+    return len(encoded)
@@ -0,0 +1,176 @@
+from typing import Any, AsyncIterator, Dict, Optional
+import asyncio
+import time
+
+from fastapi import Request
+from fastapi.responses import StreamingResponse
+import anyio
+import httpx
+
+from .preferences import config_section
+
+# defaults, overridable via the "upstream" section of config.json
+UPSTREAM_DEFAULTS: Dict[str, Any] = {
+    "max_connections": 32,
+    "max_keepalive_connections": 16,
+    "keepalive_expiry": 60.0,
+    "http2": False,
+    "connect_timeout": 5.0,
+    "read_timeout": 60.0,
+    "write_timeout": 30.0,
+    "pool_timeout": 10.0,
+}
+
+# how often a streaming response polls for a vanished client, in seconds
+DISCONNECT_CHECK_INTERVAL = 0.25
+
+_client: Optional[httpx.AsyncClient] = None
+
+
+def _upstream_settings() -> Dict[str, Any]:
+    return config_section("upstream", UPSTREAM_DEFAULTS)
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def request_timeout(settings: Optional[Dict[str, Any]] = None) -> httpx.Timeout:
+    """Per-phase timeout for regular (non-streaming) completions."""
+    cfg = settings or _upstream_settings()
+    return httpx.Timeout(
+        connect=cfg["connect_timeout"],
+        read=cfg["read_timeout"],
+        write=cfg["write_timeout"],
+        pool=cfg["pool_timeout"],
+    )
+
+
+def stream_timeout(settings: Optional[Dict[str, Any]] = None) -> httpx.Timeout:
+    """Streams may run for minutes, so only connect/write/pool are bounded."""
+    cfg = settings or _upstream_settings()
+    return httpx.Timeout(
+        connect=cfg["connect_timeout"],
+        read=None,
+        write=cfg["write_timeout"],
+        pool=cfg["pool_timeout"],
+    )
+
+
+def _build_client() -> httpx.AsyncClient:
+    cfg = _upstream_settings()
+    limits = httpx.Limits(
+        max_connections=int(cfg["max_connections"]),
+        max_keepalive_connections=int(cfg["max_keepalive_connections"]),
+        keepalive_expiry=float(cfg["keepalive_expiry"]),
+    )
+    http2 = bool(cfg["http2"]) and _http2_available()
+    return httpx.AsyncClient(limits=limits, timeout=request_timeout(cfg), http2=http2)
+
+
+async def start_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None or _client.is_closed:
+        _client = _build_client()
+    return _client
+
+
+async def close_client() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def get_client() -> httpx.AsyncClient:
+    """Return the shared upstream client, creating it lazily outside the app lifespan."""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = _build_client()
+    return _client
+
+
+# end of DisconnectWatch.lines(): upstream finished or the client went away
+_END = object()
+
+
+class DisconnectWatch:
+    """Throttled check whether the browser behind a streaming response went away.
+
+    Streams read upstream through lines(), which ends once gone() turns true, so leaving
+    the read loop closes the upstream connection and the model server stops generating.
+    """
+
+    def __init__(self, request: Request, interval: float = DISCONNECT_CHECK_INTERVAL):
+        self.request = request
+        self.interval = interval
+        self.disconnected = False
+        self._checked_at = 0.0
+
+    async def gone(self) -> bool:
+        if self.disconnected:
+            return True
+        now = time.monotonic()
+        if now - self._checked_at < self.interval:
+            return False
+        self._checked_at = now
+        self.disconnected = await self.request.is_disconnected()
+        return self.disconnected
+
+    async def lines(self, response: httpx.Response) -> AsyncIterator[str]:
+        """Upstream lines until the stream ends or the client disconnects.
+
+        A reader task feeds the lines through a queue while a second task polls the
+        client, so an abandoned request gives up its upstream slot during a long prefill
+        or a stall, not only when the next line arrives. Upstream errors are re-raised.
+        """
+        queue: "asyncio.Queue[Any]" = asyncio.Queue()
+
+        async def read() -> None:
+            try:
+                async for line in response.aiter_lines():
+                    queue.put_nowait(line)
+                queue.put_nowait(_END)
+            except Exception as exc:
+                queue.put_nowait(exc)
+
+        async def poll() -> None:
+            while not await self.gone():
+                await asyncio.sleep(self.interval)
+            queue.put_nowait(_END)
+
+        tasks = [asyncio.ensure_future(read()), asyncio.ensure_future(poll())]
+        try:
+            while True:
+                item = await queue.get()
+                if item is _END:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+class ClosingStreamingResponse(StreamingResponse):
+    """StreamingResponse that always closes its body generator when the response ends.
+
+    With ASGI spec 2.4 servers a failed send leaves the generator suspended at a yield
+    until garbage collection; closing it right away releases the upstream stream (and the
+    generator's finally blocks, e.g. archiving partial output, run immediately).
+    """
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            close = getattr(self.body_iterator, "aclose", None)
+            if close is not None:
+                with anyio.CancelScope(shield=True):
+                    await close()
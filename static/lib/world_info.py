@@ -2,15 +2,46 @@ from pathlib import Path
 import json
 import re
 import time
-from typing import List, Optional
+import threading
+from typing import Dict, List, Optional, Pattern, Tuple
 
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 
+from .context_window import context_settings, estimate_tokens
+from .etags import not_modified, set_validator, store_etag
+from .preferences import config_section
+from .storage import atomic_write_json, path_lock
+
 router = APIRouter()
 
 WORLD_DIR = Path("static/userdata/world_info")
 
+# defaults, overridable via the "world" section of config.json
+WORLD_DEFAULTS = {
+  # how many recent messages (plus the new prompt) are scanned for trigger keys
+  "scan_depth": 4,
+  # upper bound on world-context tokens injected per request; 0 = use budget_share
+  "token_cap": 0,
+  # without a token_cap, world context may take this fraction of the context budget
+  # (max_context_tokens - reserve_tokens), so triggered entries cannot crowd out the
+  # whole history; 0 = no cap at all
+  "budget_share": 0.25,
+}
+
+# re-check file mtimes at most this often when the directory mtime is unchanged
+REVALIDATE_INTERVAL = 2.0
+
+# in-memory store: path -> (stat signature, entry); _version grows on every change
+_store_lock = threading.RLock()
+_files: Dict[Path, Tuple[Optional[Tuple[int, int]], dict]] = {}
+_sorted: List[dict] = []
+_version = 0
+_dir_mtime: Optional[int] = None
+_checked_at = 0.0
+_loaded = False
+
 
 def _slugify(name: str) -> str:
   # simple file-safe slug from entry name
@@ -22,16 +53,17 @@ class WorldEntry(BaseModel):
   name: str
   description: str | None = None
   enabled: bool = True
+  # ignored on save; the server counts tokens with the configured estimator
   tokens: int | None = None
   slug: str | None = None
   previous_slug: str | None = None
+  # trigger keys; entries without keys are always injected while enabled
+  keys: list[str] | None = None
+  priority: int | None = None
 
 
 def _estimate_tokens(text: Optional[str]) -> int:
-  if not text:
-    return 0
-  # rough heuristic: 1 token ~= 4 chars
-  return max(0, round(len(text) / 4))
+  return estimate_tokens(text, context_settings())
 
 
 def _list_world_files() -> List[Path]:
@@ -47,38 +79,211 @@ def _load_entry(path: Path) -> Optional[dict]:
       slug = path.stem
       data.setdefault("slug", slug)
       data.setdefault("created_at", data.get("updated_at") or int(path.stat().st_mtime))
-      data.setdefault("tokens", _estimate_tokens(data.get("description") or ""))
+      # recounted on load: stored values may come from an older or client-side estimate
+      data["tokens"] = _estimate_tokens(data.get("description") or "")
       data.setdefault("enabled", True)
+      data.setdefault("keys", [])
+      data.setdefault("priority", 0)
       return data
   except Exception:
     return None
   return None
 
 
+def _stat_signature(path: Path) -> Optional[Tuple[int, int]]:
+  try:
+    st = path.stat()
+  except OSError:
+    return None
+  return (st.st_mtime_ns, st.st_size)
+
+
+def _dir_signature() -> Optional[int]:
+  try:
+    return WORLD_DIR.stat().st_mtime_ns
+  except OSError:
+    return None
+
+
+def _changed() -> None:
+  global _sorted, _version
+  _sorted = sorted((entry for _, entry in _files.values()), key=lambda x: x.get("created_at") or 0)
+  _version += 1
+
+
+def _revalidate() -> None:
+  """Sync the store with disk, reparsing only files whose mtime/size changed."""
+  global _dir_mtime, _checked_at, _loaded
+  with _store_lock:
+    now = time.monotonic()
+    dir_mtime = _dir_signature()
+    if _loaded and dir_mtime == _dir_mtime and now - _checked_at < REVALIDATE_INTERVAL:
+      return
+    seen = set()
+    changed = not _loaded
+    for path in _list_world_files():
+      seen.add(path)
+      sig = _stat_signature(path)
+      cached = _files.get(path)
+      if cached and cached[0] == sig:
+        continue
+      entry = _load_entry(path)
+      if entry is None:
+        changed = _files.pop(path, None) is not None or changed
+        continue
+      _files[path] = (sig, entry)
+      changed = True
+    for path in list(_files):
+      if path not in seen:
+        del _files[path]
+        changed = True
+    if changed:
+      _changed()
+    _dir_mtime = dir_mtime
+    _checked_at = now
+    _loaded = True
+
+
+def _store_put(path: Path, entry: dict) -> None:
+  global _dir_mtime
+  with _store_lock:
+    # record the write first so the revalidation below does not reparse it
+    _files[path] = (_stat_signature(path), entry)
+    _revalidate()
+    _changed()
+    _dir_mtime = _dir_signature()
+
+
+def _store_drop(path: Path) -> None:
+  global _dir_mtime
+  with _store_lock:
+    dropped = _files.pop(path, None) is not None
+    _revalidate()
+    if dropped:
+      _changed()
+    _dir_mtime = _dir_signature()
+
+
+def world_version() -> int:
+  """Monotonic version of the world-info store; grows whenever any entry changes."""
+  _revalidate()
+  return _version
+
+
+def world_entries() -> List[dict]:
+  """All entries sorted by creation time, served from the in-memory store."""
+  _revalidate()
+  return _sorted
+
+
 @router.get("/world")
-def list_world_entries():
-  items = []
-  for path in _list_world_files():
-    entry = _load_entry(path)
-    if entry:
-      items.append(entry)
-  return sorted(items, key=lambda x: x.get("created_at") or 0)
+def list_world_entries(request: Request, response: Response):
+  with _store_lock:
+    _revalidate()
+    etag = store_etag("world", _version)
+    items = _sorted
+  cached = not_modified(request, etag)
+  if cached:
+    return cached
+  set_validator(response, etag)
+  return items
 
 
 def list_enabled_world_entries() -> List[dict]:
   """Return only enabled world info entries."""
-  return [item for item in list_world_entries() if item.get("enabled")]
+  return [item for item in world_entries() if item.get("enabled")]
+
+
+def _clean_keys(keys: Optional[List[str]]) -> List[str]:
+  seen = []
+  for key in keys or []:
+    key = str(key).strip()
+    if key and key.lower() not in (k.lower() for k in seen):
+      seen.append(key)
+  return seen
+
+
+# (world version, enabled entries, compiled key matcher, lowercased key -> slugs)
+_matcher_cache: Optional[Tuple[int, List[dict], Optional[Pattern], Dict[str, List[str]]]] = None
+_matcher_lock = threading.Lock()
+
+
+def _build_matcher(entries: List[dict]) -> Tuple[Optional[Pattern], Dict[str, List[str]]]:
+  key_map: Dict[str, List[str]] = {}
+  for entry in entries:
+    for key in _clean_keys(entry.get("keys")):
+      key_map.setdefault(key.lower(), []).append(entry["slug"])
+  if not key_map:
+    return None, key_map
+  # one alternation for all keys, longest first so "dark forest" beats "forest"
+  alternation = "|".join(re.escape(k) for k in sorted(key_map, key=len, reverse=True))
+  return re.compile(rf"(?<!\w)(?:{alternation})(?!\w)", re.IGNORECASE), key_map
+
+
+def _world_matcher() -> Tuple[List[dict], Optional[Pattern], Dict[str, List[str]]]:
+  """Enabled entries plus their key matcher, rebuilt only when the world version changes."""
+  global _matcher_cache
+  version = world_version()
+  with _matcher_lock:
+    cached = _matcher_cache
+    if cached is not None and cached[0] == version:
+      return cached[1], cached[2], cached[3]
+    entries = list_enabled_world_entries()
+    matcher, key_map = _build_matcher(entries)
+    _matcher_cache = (version, entries, matcher, key_map)
+    return entries, matcher, key_map
+
+
+def select_world_entries(scan_text: str, token_cap: Optional[int] = None) -> List[dict]:
+  """Enabled entries relevant to scan_text, highest priority first, within the token cap.
+
+  Keyless entries are always candidates; keyed entries only when a key occurs in the text.
+  """
+  settings = config_section("world", WORLD_DEFAULTS)
+  cap = int(token_cap if token_cap is not None else settings["token_cap"])
+  if cap <= 0:
+    ctx = context_settings()
+    budget = max(0, int(ctx["max_context_tokens"]) - int(ctx["reserve_tokens"]))
+    cap = int(budget * max(0.0, float(settings["budget_share"])))
+  entries, matcher, key_map = _world_matcher()
+  triggered = set()
+  if matcher is not None and scan_text:
+    for match in matcher.finditer(scan_text):
+      triggered.update(key_map.get(match.group(0).lower(), ()))
+  candidates = [e for e in entries if not e.get("keys") or e["slug"] in triggered]
+  candidates.sort(key=lambda e: (-(e.get("priority") or 0), e.get("created_at") or 0))
+
+  if cap <= 0:
+    return candidates
+  selected = []
+  used = 0
+  for entry in candidates:
+    cost = entry["tokens"]
+    if used + cost > cap:
+      continue
+    selected.append(entry)
+    used += cost
+  return selected
+
+
+async def select_world_entries_async(scan_text: str, token_cap: Optional[int] = None) -> List[dict]:
+  return await run_in_threadpool(select_world_entries, scan_text, token_cap)
+
+
+def world_scan_depth() -> int:
+  return int(config_section("world", WORLD_DEFAULTS)["scan_depth"])
 
 
 @router.get("/world/{slug}")
 def get_world_entry(slug: str):
   target = WORLD_DIR / f"{_slugify(slug)}.json"
+  _revalidate()
+  cached = _files.get(target)
+  if cached:
+    return cached[1]
   if not target.exists():
     raise HTTPException(status_code=404, detail="World entry not found")
-  entry = _load_entry(target)
-  if not entry:
-    raise HTTPException(status_code=500, detail="Failed to parse world entry")
-  return entry
+  raise HTTPException(status_code=500, detail="Failed to parse world entry")
 
 
 @router.post("/world")
@@ -93,6 +298,7 @@ def save_world_entry(payload: WorldEntry):
       existing = _load_entry(prev_target) or {}
       created_at = existing.get("created_at") or existing.get("updated_at")
       prev_target.unlink()
+      _store_drop(prev_target)
     else:
       created_at = None
   else:
@@ -105,24 +311,30 @@ def save_world_entry(payload: WorldEntry):
   if created_at is None:
     created_at = int(time.time())
 
-  tokens = payload.tokens if payload.tokens is not None else _estimate_tokens(payload.description or "")
+  tokens = _estimate_tokens(payload.description or "")
   data = {
     "name": payload.name.strip() or "Untitled entry",
     "description": payload.description or "",
     "enabled": bool(payload.enabled),
     "tokens": tokens,
     "slug": safe_slug,
+    "keys": _clean_keys(payload.keys),
+    "priority": int(payload.priority or 0),
     "updated_at": int(time.time()),
     "created_at": created_at,
   }
-  target.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+  with path_lock(target):
+    atomic_write_json(target, data)
+    _store_put(target, data)
   return data
 
 
 @router.delete("/world/{slug}")
 def delete_world_entry(slug: str):
   target = WORLD_DIR / f"{_slugify(slug)}.json"
-  if target.exists():
-    target.unlink()
-    return {"deleted": True}
+  with path_lock(target):
+    if target.exists():
+      target.unlink()
+      _store_drop(target)
+      return {"deleted": True}
   return {"deleted": False}
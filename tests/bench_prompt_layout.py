@@ -0,0 +1,104 @@
+"""Time-to-first-token of the "classic" and "stable" prompt layouts.
+
+Run from the project root (not collected by pytest):
+
+    python -m tests.bench_prompt_layout
+
+A 40-turn chat goes through /chat/stream against a mock backend that, like
+llama.cpp's prompt cache, only charges prefill for the part of the prompt after
+the prefix it shares with the previous request. World entries are triggered by
+the topic, which changes every four turns. Runs in a temporary copy of
+static/, so userdata is left alone.
+"""
+from pathlib import Path
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import httpx
+
+ROOT = Path(__file__).resolve().parent.parent
+# simulated prefill cost per prompt character (~80 us per token)
+PER_CHAR = 0.00002
+TURNS = 40
+
+_cache = {"text": ""}
+
+
+def _flat(messages):
+    return "".join(f"<|{m['role']}|>{m['content']}<|end|>" for m in messages)
+
+
+def _handler(request):
+    body = json.loads(request.content)
+    text = _flat(body["messages"])
+    prev = _cache["text"]
+    shared, limit = 0, min(len(prev), len(text))
+    while shared < limit and prev[shared] == text[shared]:
+        shared += 1
+    _cache["text"] = text
+    delay = (len(text) - shared) * PER_CHAR
+
+    async def stream():
+        await asyncio.sleep(delay)
+        yield ("data: " + json.dumps({"choices": [{"delta": {"content": "ok"}}]}) + "\n\n").encode()
+        yield b"data: [DONE]\n\n"
+
+    return httpx.Response(200, content=stream(), headers={"content-type": "text/event-stream"})
+
+
+def _run(client, config_path, layout, trim_step):
+    config_path.write_text(json.dumps({
+        "prompt": {"layout": layout, "cache_prompt": True},
+        "context": {"max_context_tokens": 4096, "trim_step": trim_step},
+    }))
+    _cache["text"] = ""
+    history, ttfts = [], []
+    for turn in range(TURNS):
+        topic = ["the castle", "the forest", "nothing much"][(turn // 4) % 3]
+        prompt = f"tell me about {topic} " + "x " * 60
+        started = time.perf_counter()
+        first = None
+        with client.stream("POST", "/chat/stream", json={"prompt": prompt, "history": history}) as response:
+            for _ in response.iter_lines():
+                if first is None:
+                    first = time.perf_counter() - started
+        ttfts.append(first)
+        history += [{"role": "user", "content": prompt}, {"role": "assistant", "content": "ok " * 80}]
+    ttfts.sort()
+    print(f"{layout:8} trim_step {trim_step}: mean TTFT {sum(ttfts) / len(ttfts) * 1000:6.1f} ms,"
+          f" p90 {ttfts[int(len(ttfts) * 0.9)] * 1000:6.1f} ms")
+
+
+def main():
+    workdir = tempfile.mkdtemp()
+    try:
+        shutil.copytree(ROOT / "static", Path(workdir) / "static", ignore=shutil.ignore_patterns("userdata"))
+        shutil.copy(ROOT / "index.html", workdir)
+        os.chdir(workdir)
+        sys.path.insert(0, str(ROOT))
+        from fastapi.testclient import TestClient
+
+        from static.lib import upstream
+        from static.lib.main import app
+        from static.lib.preferences import CONFIG_PATH
+
+        upstream._client = httpx.AsyncClient(transport=httpx.MockTransport(_handler))
+        CONFIG_PATH.parent.mkdir(parents=True, exist_ok=True)
+        with TestClient(app) as client:
+            client.post("/world", json={"name": "Castle", "description": "castle lore " * 40, "keys": ["castle"]})
+            client.post("/world", json={"name": "Forest", "description": "forest lore " * 40, "keys": ["forest"]})
+            for trim_step in (1, 8):
+                for layout in ("classic", "stable"):
+                    _run(client, CONFIG_PATH, layout, trim_step)
+    finally:
+        os.chdir(ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
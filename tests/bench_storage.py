@@ -0,0 +1,90 @@
+"""Write throughput of the userdata storage helpers.
+
+Run from the project root (not collected by pytest):
+
+    python -m tests.bench_storage
+
+Compares a plain write_text of an archive-sized JSON file with
+storage.atomic_write_json, with and without fsync, and then times chat turns
+through archive.save_chat_archive with the "storage" fsync setting on and off.
+Rounds are interleaved and the median rate is reported, since single runs on a
+shared disk are noisy. Runs in a temporary directory.
+"""
+from pathlib import Path
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = Path(__file__).resolve().parent.parent
+WRITES = 300
+TURNS = 200
+ROUNDS = 7
+
+
+def _rate(fn, count):
+    started = time.perf_counter()
+    for i in range(count):
+        fn(i)
+    return count / (time.perf_counter() - started)
+
+
+def main():
+    workdir = tempfile.mkdtemp()
+    try:
+        os.chdir(workdir)
+        sys.path.insert(0, str(ROOT))
+        from static.lib import archive
+        from static.lib.preferences import CONFIG_PATH, _revalidate
+        from static.lib.storage import atomic_write_json
+
+        data = {"messages": [{"role": "user", "content": "x" * 300}] * 140}
+        target = Path(workdir) / "entry.json"
+        size = len(json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8"))
+
+        def plain(_):
+            target.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+
+        files = {
+            "write_text": plain,
+            "atomic + fsync": lambda _: atomic_write_json(target, data),
+            "atomic, no fsync": lambda _: atomic_write_json(target, data, fsync=False),
+        }
+        rates = {name: [] for name in files}
+        for _ in range(ROUNDS):
+            for name, fn in files.items():
+                rates[name].append(_rate(fn, WRITES))
+        print(f"whole-file writes of a {size / 1024:.1f} KB archive ({WRITES} per round, median of {ROUNDS}):")
+        for name, values in rates.items():
+            print(f"  {name:18} {statistics.median(values):7.0f}/s")
+
+        CONFIG_PATH.parent.mkdir(parents=True, exist_ok=True)
+        turn_rates = {True: [], False: []}
+        history = [{"role": "user", "content": "hello " * 50}]
+        for round_no in range(ROUNDS):
+            for fsync in (True, False):
+                CONFIG_PATH.write_text(json.dumps({"storage": {"fsync": fsync}}), encoding="utf-8")
+                _revalidate(force=True)
+                entry_id = f"bench_{round_no}_{int(fsync)}"
+                messages = list(history)
+                archive.save_chat_archive(entry_id, messages, "m", None)
+
+                def turn(i):
+                    messages.extend([{"role": "assistant", "content": f"reply {i} " * 40},
+                                     {"role": "user", "content": f"next {i}"}])
+                    archive.save_chat_archive(entry_id, messages, "m", None)
+
+                turn_rates[fsync].append(_rate(turn, TURNS))
+        print(f"chat turns through save_chat_archive ({TURNS} per round, median of {ROUNDS}):")
+        for fsync, values in turn_rates.items():
+            print(f"  storage.fsync {str(fsync).lower():5}  {statistics.median(values):7.0f}/s")
+    finally:
+        os.chdir(ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""Cost of prompt assembly with and without the rendered-prompt caches.
+
+Run from the project root (not collected by pytest):
+
+    python -m tests.bench_system_prompt
+
+A roleplay character, 40 world entries and a 200-turn history go through
+prompt.assemble_chat_messages, once with the caches warm and once with the
+system prompt cache and the world matcher cache emptied before every call.
+cached_system_prompt is also timed on its own against build_system_prompt.
+Rounds are interleaved and the median is reported. Runs in a temporary
+directory, so userdata is left alone.
+"""
+from pathlib import Path
+import asyncio
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = Path(__file__).resolve().parent.parent
+CALLS = 500
+ROUNDS = 7
+
+
+def _per_call_us(fn, count):
+    started = time.perf_counter()
+    for _ in range(count):
+        fn()
+    return (time.perf_counter() - started) / count * 1e6
+
+
+def main():
+    workdir = tempfile.mkdtemp()
+    try:
+        os.chdir(workdir)
+        sys.path.insert(0, str(ROOT))
+        from static.lib import prompt, world_info
+        from static.lib.character import CHAR_DIR, character_version, fetch_character
+
+        CHAR_DIR.mkdir(parents=True)
+        (CHAR_DIR / "1.json").write_text(json.dumps({
+            "id": 1,
+            "name": "Mira",
+            "mode": "roleplay",
+            "greeting": "Welcome, traveller.",
+            "personality": "A sharp-tongued innkeeper with a soft spot for strays. " * 20,
+            "gender": "female",
+        }), encoding="utf-8")
+        world_info.WORLD_DIR.mkdir(parents=True)
+        for i in range(40):
+            (world_info.WORLD_DIR / f"entry_{i}.json").write_text(json.dumps({
+                "name": f"Place {i}",
+                "description": f"lore about place {i} " * 30,
+                "keys": [f"place{i}", f"landmark{i}"],
+                "enabled": True,
+                "created_at": i,
+            }), encoding="utf-8")
+        history = [
+            {"role": "user" if i % 2 == 0 else "assistant", "content": f"turn {i} near place{i % 40} " * 8}
+            for i in range(200)
+        ]
+        character = fetch_character(1)
+        version = character_version(1)
+        loop = asyncio.new_event_loop()
+
+        def assemble():
+            loop.run_until_complete(prompt.assemble_chat_messages(1, None, history, "what about place7?"))
+
+        def assemble_cold():
+            prompt._system_cache.clear()
+            world_info._matcher_cache = None
+            assemble()
+
+        cases = {
+            "build_system_prompt": lambda: prompt.build_system_prompt(character),
+            "cached_system_prompt": lambda: prompt.cached_system_prompt(character, version),
+            "assemble, caches cold": assemble_cold,
+            "assemble, caches warm": assemble,
+        }
+        timings = {name: [] for name in cases}
+        for _ in range(ROUNDS):
+            for name, fn in cases.items():
+                timings[name].append(_per_call_us(fn, CALLS))
+        loop.close()
+        print(f"per call ({CALLS} per round, median of {ROUNDS}):")
+        for name, values in timings.items():
+            print(f"  {name:22} {statistics.median(values):8.1f} us")
+    finally:
+        os.chdir(ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+from static.lib import backends, upstream
+
+SETTINGS = {
+    "servers": [
+        {"url": "http://a/v1/chat/completions", "models": ["m"]},
+        {"url": "http://b/v1/chat/completions", "models": ["other"]},
+    ],
+    "health_interval": 0,
+    "failure_threshold": 3,
+    "cooldown": 30.0,
+    "retries": 0,
+}
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    """Two backends; model "m" is only served by A, whose cooldown just ended."""
+    monkeypatch.setattr(backends, "backend_settings", lambda: SETTINGS)
+    backends._backends.clear()
+    backends._sync_backends(SETTINGS)
+    a = backends._backends["http://a/v1/chat/completions"]
+    a.failures = 3
+    a.open_until = time.monotonic() - 1
+    yield a
+    backends._backends.clear()
+    upstream._client = None
+
+
+def use_handler(handler):
+    upstream._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+def test_trial_500_reopens_circuit(pool):
+    use_handler(lambda request: httpx.Response(500, json={"error": "boom"}))
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(backends.post_completion({"model": "m"}))
+    assert pool.trial is False
+    assert pool.open_until > time.monotonic()
+    assert pool.outstanding == 0
+
+
+def test_stream_trial_500_is_not_success(pool):
+    use_handler(lambda request: httpx.Response(500, text="boom"))
+
+    async def run():
+        async with backends.open_stream({"model": "m", "stream": True}) as response:
+            return response.status_code
+
+    assert asyncio.run(run()) == 500
+    assert pool.trial is False
+    assert pool.failures == 4
+    assert pool.open_until > time.monotonic()
+
+
+def test_trial_cancelled_gives_slot_back(pool):
+    async def hang(request):
+        await asyncio.sleep(3600)
+
+    use_handler(hang)
+
+    async def run():
+        task = asyncio.create_task(backends.post_completion({"model": "m"}))
+        await asyncio.sleep(0.05)
+        assert pool.trial is True
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(run())
+    assert pool.trial is False
+    assert pool.outstanding == 0
+    # no outcome was recorded, so the next request gets another trial
+    assert pool.available(time.monotonic())
+    assert backends.pick_backend("m") is pool
+
+
+def test_trial_4xx_keeps_circuit_half_open(pool):
+    use_handler(lambda request: httpx.Response(400, json={"error": "bad request"}))
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(backends.post_completion({"model": "m"}))
+    assert pool.trial is False
+    assert pool.failures == 3
+    assert pool.available(time.monotonic())
+
+
+def test_trial_success_closes_circuit(pool):
+    use_handler(lambda request: httpx.Response(200, json={"choices": [{"message": {"content": "ok"}}]}))
+    asyncio.run(backends.post_completion({"model": "m"}))
+    assert pool.open_until == 0.0
+    assert pool.failures == 0
+
+
+@pytest.fixture
+def pair(monkeypatch):
+    """Two healthy backends serving "m", with one retry."""
+    settings = dict(SETTINGS, retries=1, servers=[
+        {"url": "http://a/v1/chat/completions", "models": ["m"]},
+        {"url": "http://b/v1/chat/completions", "models": ["m"]},
+    ])
+    monkeypatch.setattr(backends, "backend_settings", lambda: settings)
+    backends._backends.clear()
+    backends._sync_backends(settings)
+    yield
+    backends._backends.clear()
+    upstream._client = None
+
+
+def test_dropped_connection_is_not_retried(pair):
+    hosts = []
+
+    def handler(request):
+        hosts.append(request.url.host)
+        raise httpx.RemoteProtocolError("server disconnected", request=request)
+
+    use_handler(handler)
+    with pytest.raises(httpx.RemoteProtocolError):
+        asyncio.run(backends.post_completion({"model": "m"}))
+    # the first backend may already have run the request
+    assert len(hosts) == 1
+
+
+@pytest.mark.parametrize("fail", [
+    lambda request: httpx.Response(503, text="loading"),
+    lambda request: (_ for _ in ()).throw(httpx.ConnectError("refused", request=request)),
+])
+def test_refused_request_fails_over(pair, fail):
+    hosts = []
+
+    def handler(request):
+        hosts.append(request.url.host)
+        if len(hosts) == 1:
+            return fail(request)
+        return httpx.Response(200, json={"choices": [{"message": {"content": "ok"}}]})
+
+    use_handler(handler)
+    asyncio.run(backends.post_completion({"model": "m"}))
+    assert len(hosts) == 2 and hosts[0] != hosts[1]
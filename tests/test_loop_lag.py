@@ -0,0 +1,87 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+from static.lib import archive, character
+
+TICK = 0.001
+# a blocking call of the sizes below stalls the loop for well over this
+MAX_LAG = 0.05
+
+
+@pytest.fixture
+def userdata(tmp_path, monkeypatch):
+    """Fresh userdata under tmp_path, with the in-process caches emptied."""
+    monkeypatch.chdir(tmp_path)
+    archive._chat_states.clear()
+    archive._chat_sessions.clear()
+    monkeypatch.setattr(character, "_loaded", False)
+    monkeypatch.setattr(character, "_dir_mtime", None)
+    character._files.clear()
+    character._by_id.clear()
+    character._versions.clear()
+    yield tmp_path
+    archive._chat_states.clear()
+    archive._chat_sessions.clear()
+    character._files.clear()
+    character._by_id.clear()
+    character._versions.clear()
+
+
+async def max_loop_lag(work):
+    """Longest gap between 1 ms ticks while `work` (a coroutine) runs."""
+    lag = 0.0
+    done = asyncio.Event()
+
+    async def ticker():
+        nonlocal lag
+        last = time.perf_counter()
+        while not done.is_set():
+            await asyncio.sleep(TICK)
+            now = time.perf_counter()
+            lag = max(lag, now - last - TICK)
+            last = now
+
+    task = asyncio.create_task(ticker())
+    await asyncio.sleep(TICK)
+    try:
+        await work
+    finally:
+        done.set()
+        await task
+    return lag
+
+
+def big_chat(turns=4000):
+    return [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": f"turn {i} " + "lorem ipsum " * 120}
+        for i in range(turns)
+    ]
+
+
+def test_save_chat_archive_async_keeps_loop_responsive(userdata):
+    messages = big_chat()
+    started = time.perf_counter()
+    archive.save_chat_archive("blocking", messages, "m", None)
+    assert time.perf_counter() - started > MAX_LAG * 2, "fixture too small to show blocking"
+
+    lag = asyncio.run(max_loop_lag(archive.save_chat_archive_async("offloaded", messages, "m", None)))
+    assert lag < MAX_LAG
+
+
+def test_fetch_character_async_keeps_loop_responsive(userdata):
+    character.CHAR_DIR.mkdir(parents=True)
+    persona = "a long persona " * 400
+    for i in range(1, 3001):
+        (character.CHAR_DIR / f"char_{i}.json").write_text(
+            json.dumps({"id": i, "name": f"Character {i}", "personality": persona}), encoding="utf-8"
+        )
+
+    async def first_fetch():
+        # a cold index reads and parses every character file
+        assert (await character.fetch_character_async(3000))["name"] == "Character 3000"
+
+    lag = asyncio.run(max_loop_lag(first_fetch()))
+    assert lag < MAX_LAG
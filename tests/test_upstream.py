@@ -0,0 +1,69 @@
+import asyncio
+import time
+
+import httpx
+
+from static.lib.upstream import DisconnectWatch
+
+
+class LeavingRequest:
+    """Stands in for a Request whose client disconnects after `after` seconds."""
+
+    def __init__(self, after):
+        self.started = time.monotonic()
+        self.after = after
+
+    async def is_disconnected(self):
+        return time.monotonic() - self.started > self.after
+
+
+def test_disconnect_ends_a_stalled_read():
+    closed = asyncio.Event()
+
+    def handler(request):
+        async def stream():
+            try:
+                yield b'data: {"choices": [{"delta": {"content": "a"}}]}\n\n'
+                # a long prefill or a hung backend: no further line arrives
+                await asyncio.sleep(3600)
+            finally:
+                closed.set()
+
+        return httpx.Response(200, content=stream())
+
+    async def run():
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        watch = DisconnectWatch(LeavingRequest(0.1), interval=0.05)
+        started = time.monotonic()
+        async with client.stream("POST", "http://a/v1/chat/completions") as response:
+            lines = [line async for line in watch.lines(response)]
+        await asyncio.wait_for(closed.wait(), 1)
+        return lines, time.monotonic() - started, watch.disconnected
+
+    lines, elapsed, disconnected = asyncio.run(run())
+    assert lines == ['data: {"choices": [{"delta": {"content": "a"}}]}', ""]
+    assert disconnected
+    assert elapsed < 1
+
+
+def test_upstream_errors_reach_the_reader():
+    def handler(request):
+        async def stream():
+            yield b"data: x\n\n"
+            raise httpx.ReadError("connection reset")
+
+        return httpx.Response(200, content=stream())
+
+    async def run():
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        watch = DisconnectWatch(LeavingRequest(3600))
+        seen = []
+        async with client.stream("POST", "http://a/v1/chat/completions") as response:
+            try:
+                async for line in watch.lines(response):
+                    seen.append(line)
+            except httpx.ReadError:
+                return seen
+        raise AssertionError("ReadError was swallowed")
+
+    assert asyncio.run(run())[0] == "data: x"